@@ -0,0 +1,163 @@
+# detector.py
+# Сравнение детекторов рекламы на корпусе сообщений:
+#   regex   — is_ad_message(text) (старый путь: всё регулярками)
+#   entity  — is_ad_message(text, entities) (entities от Telegram + регулярки для остального)
+#
+# Печатает время на сообщение для обоих путей, матрицу совпадений вердиктов
+# и примеры расхождений. Отдельно — имена файлов (NAME_CASES) через строгий is_ad_name.
+#
+# Примеры:
+#   python bench/detector.py                         # синтетический корпус
+#   python bench/detector.py --updates recorded/     # сообщения (с entities) из записанных Update
+#   python bench/detector.py --db mc_bot.db          # + тексты из deleted_ads_log (entities размечаются приближённо)
+
+import argparse
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from aiogram.types import MessageEntity  # noqa: E402
+
+import bot as botmod  # noqa: E402
+from replay import AD_TEXTS, CLEAN_TEXTS, load_updates  # noqa: E402
+
+# грубое приближение того, что размечает Telegram
+TG_URL_RE = re.compile(r"(?:https?://)?(?:[a-z0-9\-]+\.)+[a-z]{2,}(?::\d{2,5})?(?:/[^\s]*)?", re.I)
+TG_PHONE_RE = re.compile(r"\+\d[\d\-\s()]{9,}\d")
+TG_MENTION_RE = re.compile(r"@[a-z0-9_]{5,32}", re.I)
+
+
+def u16len(s: str) -> int:
+    return len(s.encode("utf-16-le")) // 2
+
+
+def tokenize_like_telegram(text: str) -> list[MessageEntity]:
+    out = []
+    for kind, rx in (("url", TG_URL_RE), ("phone_number", TG_PHONE_RE), ("mention", TG_MENTION_RE)):
+        for m in rx.finditer(text):
+            out.append(MessageEntity(type=kind, offset=u16len(text[:m.start()]), length=u16len(m.group(0))))
+    return out
+
+
+def synthetic_corpus() -> list[tuple[str, list[MessageEntity]]]:
+    corpus = []
+    for t in CLEAN_TEXTS + AD_TEXTS:
+        corpus.append((t, tokenize_like_telegram(t)))
+    # эмодзи перед ссылкой — проверка UTF-16 смещений
+    t = "🔥🔥 лучший сервер https://t.me/best_mc_server 🔥"
+    corpus.append((t, tokenize_like_telegram(t)))
+    # скрытые ссылки: видимый текст невинный, реклама в url (старый детектор их не видит)
+    for visible, url in (("жми сюда", "https://t.me/spam_channel"), ("тут гайд", "http://play.spamcraft.net"),
+                         ("видео", "https://youtu.be/xyz"), ("наш сайт", "https://shop.example.com")):
+        t = f"смотрите {visible} 👍"
+        corpus.append((t, [MessageEntity(type="text_link", offset=u16len("смотрите "), length=u16len(visible), url=url)]))
+    # длинные сообщения с несколькими ссылками
+    long_text = " ".join(CLEAN_TEXTS) * 3 + " https://youtube.com/watch?v=1 и https://youtu.be/2"
+    corpus.append((long_text, tokenize_like_telegram(long_text)))
+    return corpus
+
+
+# имена файлов / теги трека: (строка, реклама ли) — проверяются строгим is_ad_name
+NAME_CASES = [
+    ("server.properties", False), ("mc.jar", False), ("Server.log", False), ("play.mp3", False),
+    ("mine.zip", False), ("srv.tar.gz", False), ("world.schem", False), ("Imagine Dragons Believer", False),
+    ("t.me/spam_channel.apk", True), ("https://play.spamcraft.net", True), ("play.spamcraft.net:25565.txt", True),
+]
+
+
+def check_names() -> list[tuple[str, bool, str]]:
+    wrong = []
+    for name, expected in NAME_CASES:
+        ad, reason = botmod.is_ad_name(name)
+        if ad != expected:
+            wrong.append((name, ad, reason))
+    return wrong
+
+
+def corpus_from_updates(paths: list[str]) -> list[tuple[str, list[MessageEntity]]]:
+    out = []
+    for upd in load_updates(paths):
+        msg = upd.get("message") or upd.get("edited_message") or {}
+        text = msg.get("text") or msg.get("caption")
+        if not text:
+            continue
+        ents = msg.get("entities") or msg.get("caption_entities") or []
+        out.append((text, [MessageEntity(**e) for e in ents]))
+    return out
+
+
+def corpus_from_db(path: str) -> list[tuple[str, list[MessageEntity]]]:
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT text_snip FROM deleted_ads_log WHERE text_snip != ''").fetchall()
+    con.close()
+    return [(r[0], tokenize_like_telegram(r[0])) for r in rows]
+
+
+def timeit(fn, corpus, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for text, ents in corpus:
+            fn(text, ents)
+    return (time.perf_counter() - start) / (repeat * len(corpus))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Regex vs entity-based ad detector")
+    ap.add_argument("--updates", action="append", default=[])
+    ap.add_argument("--db", help="SQLite с deleted_ads_log")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--show", type=int, default=15, help="сколько расхождений показать")
+    args = ap.parse_args()
+
+    corpus = synthetic_corpus()
+    if args.updates:
+        corpus += corpus_from_updates(args.updates)
+    if args.db:
+        corpus += corpus_from_db(args.db)
+
+    regex = lambda text, ents: botmod.is_ad_message(text)  # noqa: E731
+    entity = lambda text, ents: botmod.is_ad_message(text, ents)  # noqa: E731
+
+    t_regex = timeit(regex, corpus, args.repeat)
+    t_entity = timeit(entity, corpus, args.repeat)
+
+    matrix = Counter()
+    diffs = []
+    for text, ents in corpus:
+        a, ra = regex(text, ents)
+        b, rb = entity(text, ents)
+        matrix[(a, b)] += 1
+        if a != b or (a and ra != rb):
+            diffs.append((text, ra or "-", rb or "-"))
+
+    print(f"corpus: {len(corpus)} messages")
+    print(f"regex : {t_regex * 1e6:8.2f} µs/msg")
+    print(f"entity: {t_entity * 1e6:8.2f} µs/msg  ({t_regex / t_entity:.2f}x)")
+    print()
+    print("verdicts (regex → entity):")
+    for (a, b), n in sorted(matrix.items()):
+        print(f"  {'ad' if a else 'clean':5} → {'ad' if b else 'clean':5}: {n}")
+    if diffs:
+        print()
+        print(f"differences ({len(diffs)}):")
+        for text, ra, rb in diffs[:args.show]:
+            print(f"  [{ra}] → [{rb}]  {text[:80]!r}")
+
+    wrong = check_names()
+    print()
+    print(f"file names: {len(NAME_CASES) - len(wrong)}/{len(NAME_CASES)} as expected")
+    for name, ad, reason in wrong:
+        print(f"  {name!r}: {'ad' if ad else 'clean'} [{reason or '-'}]")
+    if wrong:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+# domains.py
+# Индекс репутации доменов (bot.DomainIndex): сборка, открытие через mmap и поиск.
+#
+# Генерирует блок-лист из N синтетических доменов серверов (+ немного allow), строит
+# индекс и печатает: размер файла, время сборки и открытия, рост RSS после открытия,
+# мкс на lookup (попадание / промах / поддомен) без кэша и с LRU-кэшем domain_tier().
+#
+# Примеры:
+#   python bench/domains.py
+#   python bench/domains.py --domains 1000000 --lookups 200000
+
+import argparse
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import bot as botmod  # noqa: E402
+
+TLDS = ["net", "ru", "com", "org", "su", "me", "pro", "fun", "gg"]
+WORDS = ["craft", "mine", "block", "world", "pvp", "sky", "land", "cube", "hard", "vanilla", "magic", "zone"]
+
+
+def synthetic_domains(n: int, seed: int = 1) -> list[str]:
+    rnd = random.Random(seed)
+    out = set()
+    while len(out) < n:
+        name = "".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 3))) + str(rnd.randint(0, 9999))
+        out.add(f"{name}.{rnd.choice(TLDS)}")
+    return sorted(out)
+
+
+def rss_kb() -> int:
+    # текущий RSS (Linux); иначе — пиковый, что хуже, но лучше чем ничего
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") // 1024
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed_lookups(fn, hosts: list[str]) -> float:
+    start = time.perf_counter()
+    for h in hosts:
+        fn(h)
+    return (time.perf_counter() - start) / len(hosts) * 1e6
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Domain index build/open/lookup benchmark")
+    ap.add_argument("--domains", type=int, default=300_000)
+    ap.add_argument("--lookups", type=int, default=50_000)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="mcbot-domains-")
+    try:
+        domains = synthetic_domains(args.domains)
+        block = os.path.join(tmp, "block.txt")
+        allow = os.path.join(tmp, "allow.txt")
+        Path(block).write_text("\n".join(domains), encoding="utf-8")
+        Path(allow).write_text("\n".join(domains[:100]), encoding="utf-8")
+        out = os.path.join(tmp, "domains.idx")
+
+        start = time.perf_counter()
+        n = botmod.build_domain_index(out, [allow], [block])
+        build_s = time.perf_counter() - start
+
+        rss_before = rss_kb()
+        start = time.perf_counter()
+        botmod.domain_index_load(out)
+        open_ms = (time.perf_counter() - start) * 1000
+        rss_after = rss_kb()
+        index = botmod.DOMAIN_INDEX
+
+        rnd = random.Random(2)
+        hits = [rnd.choice(domains) for _ in range(args.lookups)]
+        subs = ["play." + h for h in hits]
+        misses = [f"nope{i}.example.{rnd.choice(TLDS)}" for i in range(args.lookups)]
+        # реальный трафик: одни и те же сервера рекламируют снова и снова
+        popular = [rnd.choice(hits[:500]) for _ in range(args.lookups)]
+
+        print(f"domains: {n}, file {os.path.getsize(out) / 1e6:.1f} MB, build {build_s:.2f} s")
+        print(f"open: {open_ms:.2f} ms, RSS growth {max(0, rss_after - rss_before) / 1024:.1f} MB")
+        print(f"lookup hit      : {timed_lookups(index.lookup, hits):6.2f} µs")
+        print(f"lookup subdomain: {timed_lookups(index.lookup, subs):6.2f} µs")
+        print(f"lookup miss     : {timed_lookups(index.lookup, misses):6.2f} µs")
+        botmod.DOMAIN_TIER_CACHE.clear()
+        print(f"domain_tier (LRU, popular hosts): {timed_lookups(botmod.domain_tier, popular):6.2f} µs")
+        index.close()
+        botmod.DOMAIN_INDEX = None
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# fake_bot_api.py
+# Локальная заглушка Telegram Bot API для бенчмарков.
+# Отвечает на /bot<token>/<method> правдоподобными ответами и считает вызовы по методам.
+# Задержку сети можно имитировать через latency_ms.
+
+import asyncio
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {"id": 8563240122, "is_bot": True, "first_name": "mc_bot", "username": "mc_test_bot"}
+
+ADMIN_RIGHTS = {
+    "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+    "can_delete_messages": True, "can_manage_video_chats": True, "can_restrict_members": True,
+    "can_promote_members": False, "can_change_info": True, "can_invite_users": True,
+    "can_post_stories": False, "can_edit_stories": False, "can_delete_stories": False,
+    "can_send_welcome_messages": False, "can_post_messages": False, "can_edit_messages": False,
+    "can_pin_messages": True, "can_manage_topics": False,
+}
+
+
+def _chat(chat_id: int) -> dict:
+    chat_type = "private" if chat_id > 0 else "supergroup"
+    return {"id": chat_id, "type": chat_type, "title": None if chat_id > 0 else f"chat {chat_id}"}
+
+
+class FakeBotAPI:
+    def __init__(self, latency_ms: float = 0.0, host: str = "127.0.0.1", port: int = 0):
+        self.latency = latency_ms / 1000
+        self.host = host
+        self.port = port
+        self.calls: Counter = Counter()
+        self.first_call_ts: dict[str, float] = {}
+        self.connections: set = set()   # (host, port) клиента — сколько TCP-соединений открыли
+        self.bios: dict[int, str] = {}   # user_id -> bio, которое отдаёт getChat
+        self._message_id = 10_000
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def total_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset(self):
+        self.calls.clear()
+        self.first_call_ts.clear()
+        self.connections.clear()
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        app.router.add_get("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.base_url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        self.connections.add(request.transport.get_extra_info("peername") if request.transport else None)
+        self.first_call_ts.setdefault(method, time.perf_counter())
+        form = await request.post() if request.can_read_body else {}
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == "getUpdates":
+            # long polling: ничего нового, но не крутимся в цикле
+            await asyncio.sleep(0.05)
+        return web.json_response({"ok": True, "result": self._result(method, form)})
+
+    def _result(self, method: str, form) -> object:
+        raw_chat = str(form.get("chat_id", 0) or 0) if form else "0"
+        if raw_chat.startswith("@"):
+            # getChat("@username"): пользователь с постоянным id по имени
+            if method == "getChat":
+                return {"id": 900_000_000 + sum(map(ord, raw_chat)), "type": "private",
+                        "username": raw_chat[1:], "accent_color_id": 0, "max_reaction_count": 11,
+                        "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                                "unique_gifts": False, "premium_subscription": False,
+                                                "gifts_from_channels": False}}
+            raw_chat = "0"
+        chat_id = int(raw_chat)
+        if method in ("sendMessage", "sendSticker", "sendPhoto", "forwardMessage"):
+            self._message_id += 1
+            return {"message_id": self._message_id, "date": int(time.time()), "chat": _chat(chat_id),
+                    "from": BOT_USER, "text": form.get("text", "") if form else ""}
+        if method == "copyMessage":
+            self._message_id += 1
+            return {"message_id": self._message_id}
+        if method == "getMe":
+            return BOT_USER
+        if method == "getUpdates":
+            return []
+        if method == "getChat":
+            bio = {"bio": self.bios[chat_id]} if chat_id in self.bios else {}
+            return {**_chat(chat_id), **bio, "accent_color_id": 0, "max_reaction_count": 11,
+                    "accepted_gift_types": {"unlimited_gifts": False, "limited_gifts": False,
+                                            "unique_gifts": False, "premium_subscription": False,
+                                            "gifts_from_channels": False},
+                    "permissions": {"can_send_messages": True, "can_send_other_messages": True,
+                                    "can_send_polls": True, "can_add_web_page_previews": True}}
+        if method == "getChatMemberCount":
+            return 42
+        if method == "getChatMember":
+            return {"status": "administrator", "user": BOT_USER, **ADMIN_RIGHTS}
+        if method == "getChatAdministrators":
+            return [{"status": "administrator", "user": BOT_USER, **ADMIN_RIGHTS}]
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        return True
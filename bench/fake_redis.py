@@ -0,0 +1,182 @@
+# fake_redis.py
+# Локальная заглушка Redis (протокол RESP2) для проверки RedisStore без настоящего сервера.
+# Поддерживает только команды, которые использует bot.py: строки-хэши, HINCRBY, ZSET для /mclist и фильтров,
+# MULTI/EXEC (pipeline с транзакцией), WATCH/UNWATCH. Данные живут в памяти процесса.
+#
+#   python bench/fake_redis.py --port 6390      # отдельным процессом
+#   MCBOT: STORE_URL = "redis://127.0.0.1:6390/0"
+
+import argparse
+import asyncio
+from collections import Counter
+
+
+class RespError(Exception):
+    pass
+
+
+class FakeRedis:
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.hashes: dict[str, dict[str, str]] = {}
+        self.zsets: dict[str, dict[str, float]] = {}
+        self.calls: Counter = Counter()
+        self.versions: Counter = Counter()   # ключ -> номер записи, для WATCH
+        self._server: asyncio.AbstractServer | None = None
+
+    @property
+    def url(self) -> str:
+        return f"redis://{self.host}:{self.port}/0"
+
+    async def start(self) -> str:
+        self._server = await asyncio.start_server(self._client, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    # ----- протокол -----
+    async def _read_command(self, reader: asyncio.StreamReader) -> list[str] | None:
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            return line.decode().split()   # inline-команда (redis-cli, telnet)
+        args = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            args.append((await reader.readexactly(size + 2))[:-2].decode())
+        return args
+
+    def _encode(self, value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, RespError):
+            return f"-ERR {value}\r\n".encode()
+        if isinstance(value, bool):
+            return f":{int(value)}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, list):
+            return f"*{len(value)}\r\n".encode() + b"".join(self._encode(v) for v in value)
+        if value == "OK" or value == "QUEUED" or value == "PONG":
+            return f"+{value}\r\n".encode()
+        data = str(value).encode()
+        return b"$%d\r\n%s\r\n" % (len(data), data)
+
+    async def _client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        queued: list[list[str]] | None = None
+        watched: dict[str, int] = {}
+        try:
+            while True:
+                args = await self._read_command(reader)
+                if args is None:
+                    break
+                cmd = args[0].upper()
+                if cmd == "MULTI":
+                    queued, reply = [], "OK"
+                elif cmd == "EXEC":
+                    if any(self.versions[k] != v for k, v in watched.items()):
+                        reply = None   # наблюдаемый ключ изменился — транзакция отменена
+                    else:
+                        reply = [self._run(a) for a in (queued or [])]
+                    queued, watched = None, {}
+                elif cmd == "DISCARD":
+                    queued, watched, reply = None, {}, "OK"
+                elif cmd == "WATCH" and queued is None:
+                    watched.update((k, self.versions[k]) for k in args[1:])
+                    reply = "OK"
+                elif cmd == "UNWATCH" and queued is None:
+                    watched, reply = {}, "OK"
+                elif queued is not None:
+                    queued.append(args)
+                    reply = "QUEUED"
+                else:
+                    reply = self._run(args)
+                writer.write(self._encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    # ----- команды -----
+    def _run(self, args: list[str]):
+        cmd, a = args[0].upper(), args[1:]
+        self.calls[cmd] += 1
+        if cmd in ("HSET", "HSETNX", "HDEL", "HINCRBY", "ZADD") and a:
+            self.versions[a[0]] += 1
+        try:
+            if cmd == "PING":
+                return "PONG"
+            if cmd in ("CLIENT", "SELECT"):
+                return "OK"
+            if cmd == "FLUSHDB":
+                self.versions.update(list(self.hashes) + list(self.zsets))
+                self.hashes.clear()
+                self.zsets.clear()
+                return "OK"
+            if cmd == "HGET":
+                return self.hashes.get(a[0], {}).get(a[1])
+            if cmd == "HMGET":
+                h = self.hashes.get(a[0], {})
+                return [h.get(f) for f in a[1:]]
+            if cmd == "HSET":
+                h = self.hashes.setdefault(a[0], {})
+                added = sum(1 for f in a[1::2] if f not in h)
+                h.update(zip(a[1::2], a[2::2]))
+                return added
+            if cmd == "HSETNX":
+                h = self.hashes.setdefault(a[0], {})
+                if a[1] in h:
+                    return 0
+                h[a[1]] = a[2]
+                return 1
+            if cmd == "HDEL":
+                h = self.hashes.get(a[0], {})
+                return sum(1 for f in a[1:] if h.pop(f, None) is not None)
+            if cmd == "HEXISTS":
+                return int(a[1] in self.hashes.get(a[0], {}))
+            if cmd == "HGETALL":
+                return [x for kv in self.hashes.get(a[0], {}).items() for x in kv]
+            if cmd == "HINCRBY":
+                h = self.hashes.setdefault(a[0], {})
+                h[a[1]] = str(int(h.get(a[1], 0)) + int(a[2]))
+                return int(h[a[1]])
+            if cmd == "ZADD":
+                z = self.zsets.setdefault(a[0], {})
+                added = sum(1 for m in a[2::2] if m not in z)
+                z.update((m, float(s)) for s, m in zip(a[1::2], a[2::2]))
+                return added
+            if cmd == "ZCARD":
+                return len(self.zsets.get(a[0], {}))
+            if cmd == "ZREVRANGE":
+                items = sorted(self.zsets.get(a[0], {}).items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+                start, stop = int(a[1]), int(a[2])
+                return [m for m, _ in items[start:(None if stop == -1 else stop + 1)]]
+            if cmd == "ZRANGEBYSCORE":
+                lo = float("-inf") if a[1] == "-inf" else float(a[1])
+                hi = float("inf") if a[2] == "+inf" else float(a[2])
+                items = sorted(self.zsets.get(a[0], {}).items(), key=lambda kv: (kv[1], kv[0]))
+                return [m for m, score in items if lo <= score <= hi]
+            return RespError(f"unknown command '{cmd}'")
+        except (IndexError, ValueError) as e:
+            return RespError(str(e))
+
+
+async def _serve(host: str, port: int):
+    fake = FakeRedis(host, port)
+    print(await fake.start(), flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="In-memory RESP stand-in for RedisStore")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6390)
+    args = ap.parse_args()
+    asyncio.run(_serve(args.host, args.port))
@@ -0,0 +1,95 @@
+# http_session.py
+# Пропускная способность HTTP-сессии к Bot API: вызовов в секунду при N одновременных запросах.
+#
+# Сравнивает стандартную AiohttpSession aiogram и TunedAiohttpSession из bot.py на двух
+# задержках заглушки fake_bot_api.py:
+#   remote — как до api.telegram.org (десятки мс),
+#   local  — как до своего Local Bot API server рядом с ботом (BOT_API_URL).
+# Для каждого прогона печатает calls/s, p50/p99 одного вызова и сколько TCP-соединений открыл клиент.
+# Заглушка крутится в том же процессе, поэтому на больших concurrency упираемся в CPU, а не в сеть.
+#
+# Примеры:
+#   python bench/http_session.py
+#   python bench/http_session.py --calls 5000 --concurrency 20 200 --remote-ms 80 --pool 200
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+from replay import percentile  # noqa: E402
+
+import bot as botmod  # noqa: E402
+
+CHAT = -1001000000001
+
+
+async def run_calls(session, calls: int, concurrency: int) -> dict:
+    from aiogram import Bot
+
+    bot = Bot(botmod.TOKEN, session=session)
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            start = time.perf_counter()
+            # та же смесь, что у модерации: удаление + ответ
+            if i % 2:
+                await bot.delete_message(CHAT, 1000 + i)
+            else:
+                await bot.send_message(CHAT, "⚠️ Реклама запрещена.")
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await bot.delete_message(CHAT, 1)   # прогрев: соединение и DNS
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    elapsed = time.perf_counter() - start
+    await session.close()
+    latencies.sort()
+    return {"calls_per_sec": calls / elapsed, "p50": percentile(latencies, 50), "p99": percentile(latencies, 99)}
+
+
+async def run(args) -> None:
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    botmod.HTTP_POOL_SIZE = args.pool
+    print(f"{'session':8} {'server':7} {'conc':>5} {'calls/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'conns':>6}")
+    for server, latency in (("remote", args.remote_ms), ("local", args.local_ms)):
+        fake = FakeBotAPI(latency_ms=latency)
+        base = await fake.start()
+        try:
+            for concurrency in args.concurrency:
+                sessions = {
+                    "default": AiohttpSession(api=TelegramAPIServer.from_base(base)),
+                    "tuned": botmod.TunedAiohttpSession(base),
+                }
+                for name, session in sessions.items():
+                    fake.reset()
+                    r = await run_calls(session, args.calls, concurrency)
+                    print(f"{name:8} {server:7} {concurrency:5} {r['calls_per_sec']:9.0f} "
+                          f"{r['p50']:8.2f} {r['p99']:8.2f} {len(fake.connections):6}")
+        finally:
+            await fake.stop()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Bot API session throughput against a local stand-in server")
+    ap.add_argument("--calls", type=int, default=2000)
+    ap.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 200])
+    ap.add_argument("--remote-ms", type=float, default=60.0, help="задержка до публичного Bot API")
+    ap.add_argument("--local-ms", type=float, default=1.0, help="задержка до своего Bot API сервера")
+    ap.add_argument("--pool", type=int, default=botmod.HTTP_POOL_SIZE, help="HTTP_POOL_SIZE для tuned")
+    args = ap.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+# replay.py
+# Офлайн-бенчмарк пайплайна модерации.
+#
+# Прогоняет записанные или синтетические Update (JSON) через настоящий `dp` из bot.py,
+# но с локальной заглушкой Bot API (fake_bot_api.py) и временной SQLite базой.
+#
+# Примеры:
+#   python bench/replay.py --synthetic 2000
+#   python bench/replay.py --updates recorded/ --updates flood.jsonl
+#   python bench/replay.py --synthetic 2000 --save-baseline bench/baseline.json
+#   python bench/replay.py --synthetic 2000 --baseline bench/baseline.json --tolerance 0.15
+#
+# Формат входа: каталог с *.json (один Update на файл или список Update'ов) и/или *.jsonl.
+# С --baseline код выхода 1, если какая-то метрика хуже базовой больше чем на tolerance.
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+DB_WRITE_OPS = ("insert", "update", "delete", "replac")
+
+CLEAN_TEXTS = [
+    "привет всем", "кто играет сегодня вечером?", "я построил дом из кварца",
+    "ахаха лол", "где найти алмазы на 1.20?", "го в бедварс", "спасибо за помощь!",
+    "вот видео https://youtu.be/dQw4w9WgXcQ", "у кого есть зачарованная кирка",
+    "сервер лагает или у меня?", "кто знает как сделать ферму железа",
+]
+AD_TEXTS = [
+    "заходи на наш сервер play.craftworld.net", "лучший сервер mc.funcraft.ru:25565 бесплатно",
+    "подпишитесь на канал t.me/mc_news_channel", "продам аккаунт недорого", "наш айпи 185.22.33.44",
+    "новый канал https://t.me/joinchat/abcdef", "куплю донат, пиши +7 900 123-45-67",
+    "сайт сервера https://craftzone.example.org", "реклама моего сервера #реклама",
+]
+
+
+def synthetic_updates(n: int, seed: int = 1) -> list[dict]:
+    # смесь: обычный чат, реклама, подписи к фото, редактирования и флуд одним пользователем
+    rnd = random.Random(seed)
+    chats = [-1001000000001, -1001000000002, -1001000000003]
+    users = [{"id": 100000 + i, "is_bot": False, "first_name": f"user{i}", "username": f"user_{i}"}
+             for i in range(500)]
+    out: list[dict] = []
+    sent: list[dict] = []
+    message_id = 1
+    now = int(time.time())
+    while len(out) < n:
+        roll = rnd.random()
+        chat_id = rnd.choice(chats)
+        chat = {"id": chat_id, "type": "supergroup", "title": f"MC chat {chat_id % 10}"}
+        if roll < 0.08 and sent:
+            # редактирование одного из прошлых сообщений
+            prev = rnd.choice(sent)
+            edited = dict(prev, edit_date=now + len(out))
+            key = "text" if "text" in edited else "caption"
+            edited[key] = edited[key] + (" " + rnd.choice(AD_TEXTS) if rnd.random() < 0.3 else " upd")
+            out.append({"update_id": len(out) + 1, "edited_message": edited})
+            continue
+        if roll < 0.13:
+            # флуд: один пользователь, пачка одинаковых сообщений
+            user = rnd.choice(users)
+            for _ in range(rnd.randint(5, 15)):
+                msg = {"message_id": message_id, "date": now, "chat": chat, "from": user, "text": "ааааааа"}
+                message_id += 1
+                out.append({"update_id": len(out) + 1, "message": msg})
+            continue
+        user = rnd.choice(users)
+        text = rnd.choice(AD_TEXTS) if roll < 0.25 else rnd.choice(CLEAN_TEXTS)
+        msg = {"message_id": message_id, "date": now, "chat": chat, "from": user}
+        message_id += 1
+        if roll > 0.9:
+            msg["photo"] = [{"file_id": f"ph{message_id}", "file_unique_id": f"u{message_id}", "width": 90, "height": 90}]
+            msg["caption"] = text
+        else:
+            msg["text"] = text
+        sent.append(msg)
+        out.append({"update_id": len(out) + 1, "message": msg})
+    return out[:n]
+
+
+def load_updates(paths: list[str]) -> list[dict]:
+    out: list[dict] = []
+    for raw in paths:
+        p = Path(raw)
+        files = sorted(p.rglob("*.json*")) if p.is_dir() else [p]
+        for f in files:
+            if f.suffix == ".jsonl":
+                out.extend(json.loads(line) for line in f.read_text(encoding="utf-8").splitlines() if line.strip())
+            else:
+                data = json.loads(f.read_text(encoding="utf-8"))
+                out.extend(data if isinstance(data, list) else [data])
+    return out
+
+
+def percentile(sorted_values: list[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    idx = min(len(sorted_values) - 1, max(0, round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def db_writes(botmod) -> int:
+    return int(sum(v for (op,), v in botmod.M_DB_QUERIES.values.items() if op in DB_WRITE_OPS))
+
+
+async def run(updates: list[dict], concurrency: int, api_latency_ms: float) -> dict:
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.types import Update
+
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+    tmp = tempfile.mkdtemp(prefix="mcbot-bench-")
+    fake = FakeBotAPI(latency_ms=api_latency_ms)
+    base = await fake.start()
+
+    import bot as botmod
+    botmod.DB_PATH = os.path.join(tmp, "bench.db")
+    botmod.METRICS_ENABLED = False
+    bot, dp = botmod.bot, botmod.dp
+    bot.session.api = TelegramAPIServer.from_base(base)
+    botmod.STORE.warm()
+
+    parsed = [Update.model_validate(u, context={"bot": bot}) for u in updates]
+    fake.reset()
+    writes_before = db_writes(botmod)
+
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(upd):
+        async with sem:
+            start = time.perf_counter()
+            await dp.feed_update(bot, upd)
+            latencies.append(time.perf_counter() - start)
+
+    started = time.perf_counter()
+    if concurrency <= 1:
+        for upd in parsed:
+            await one(upd)
+    else:
+        await asyncio.gather(*(one(u) for u in parsed))
+    botmod.flush_write_behind()
+    elapsed = time.perf_counter() - started
+
+    api_calls = fake.total_calls
+    writes = db_writes(botmod) - writes_before
+    calls_by_method = dict(fake.calls.most_common())
+    await bot.session.close()
+    await fake.stop()
+    shutil.rmtree(tmp, ignore_errors=True)
+
+    lat = sorted(x * 1000 for x in latencies)
+    n = max(1, len(parsed))
+    return {
+        "updates": len(parsed),
+        "seconds": round(elapsed, 4),
+        "updates_per_sec": round(len(parsed) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(lat, 50), 3),
+        "p95_ms": round(percentile(lat, 95), 3),
+        "p99_ms": round(percentile(lat, 99), 3),
+        "mean_ms": round(statistics.fmean(lat), 3) if lat else 0.0,
+        "api_calls_per_update": round(api_calls / n, 4),
+        "db_writes_per_update": round(writes / n, 4),
+        "api_calls_by_method": calls_by_method,
+    }
+
+
+# метрика -> True, если "больше = лучше"
+GATED = {
+    "updates_per_sec": True,
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "api_calls_per_update": False,
+    "db_writes_per_update": False,
+}
+
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list[str]:
+    problems = []
+    for key, higher_is_better in GATED.items():
+        if key not in baseline:
+            continue
+        base, cur = float(baseline[key]), float(result[key])
+        if higher_is_better:
+            bad = cur < base * (1 - tolerance)
+        else:
+            # маленькие значения (0.0x) сравниваем ещё и с абсолютным допуском
+            bad = cur > base * (1 + tolerance) + 1e-3
+        if bad:
+            problems.append(f"{key}: {cur} vs baseline {base}")
+    return problems
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Replay benchmark for the moderation pipeline")
+    ap.add_argument("--updates", action="append", default=[], help="каталог/файл с Update JSON (можно несколько)")
+    ap.add_argument("--synthetic", type=int, default=0, help="сгенерировать N синтетических апдейтов")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--concurrency", type=int, default=1, help="сколько апдейтов обрабатывать одновременно")
+    ap.add_argument("--api-latency-ms", type=float, default=0.0, help="искусственная задержка заглушки API")
+    ap.add_argument("--baseline", help="JSON с базовыми числами; при регрессии код выхода 1")
+    ap.add_argument("--save-baseline", help="сохранить результат как базовый")
+    ap.add_argument("--tolerance", type=float, default=0.10, help="допустимое ухудшение (доля)")
+    args = ap.parse_args()
+
+    updates = load_updates(args.updates)
+    if args.synthetic or not updates:
+        updates += synthetic_updates(args.synthetic or 1000, args.seed)
+
+    result = asyncio.run(run(updates, args.concurrency, args.api_latency_ms))
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        problems = compare(result, baseline, args.tolerance)
+        if problems:
+            print("REGRESSION:\n  " + "\n  ".join(problems), file=sys.stderr)
+            sys.exit(1)
+        print("OK: no regressions vs baseline", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
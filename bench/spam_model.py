@@ -0,0 +1,133 @@
+# spam_model.py
+# Задержка спам-модели (bot.SpamModel / SpamScorer) на сообщение.
+#
+#   batch  — прямой вызов model.scores() пачками разного размера: мкс на сообщение
+#   micro  — SpamScorer.score() под нагрузкой: N сообщений в секунду приходят вразнобой,
+#            скорер собирает их в пачки за SPAM_BATCH_WINDOW_MS; p50/p99 ожидания + размер пачек
+#
+# Без --model обучает временную модель на синтетике (тексты из replay.py).
+# Нужен numpy.
+#
+# Примеры:
+#   python bench/spam_model.py
+#   python bench/spam_model.py --model spam_model.npz --db mc_bot.db --rate 300
+
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import bot as botmod  # noqa: E402
+from replay import AD_TEXTS, CLEAN_TEXTS, percentile  # noqa: E402
+
+
+def synthetic_messages(n: int, seed: int = 1) -> list[str]:
+    rnd = random.Random(seed)
+    pool = CLEAN_TEXTS * 4 + AD_TEXTS
+    out = []
+    for _ in range(n):
+        words = " ".join(rnd.choice(pool) for _ in range(rnd.randint(1, 4)))
+        out.append(words[: rnd.randint(10, 300)])
+    return out
+
+
+def train_synthetic(tmp: str) -> str:
+    botmod.DB_PATH = os.path.join(tmp, "train.db")
+    rnd = random.Random(2)
+    con = botmod.db()
+    for i in range(300):
+        con.execute(
+            "INSERT INTO deleted_ads_log(chat_id, chat_title, user_id, username, text_snip, reason, created_ts) "
+            "VALUES (0, '', 0, '', ?, 'bench', 0)", (rnd.choice(AD_TEXTS) + " " + rnd.choice(CLEAN_TEXTS),))
+        con.execute("INSERT INTO clean_samples(key, text, created_ts) VALUES (?, ?, 0)",
+                    (str(i), " ".join(rnd.sample(CLEAN_TEXTS, 2))))
+    con.commit()
+    con.close()
+    path = os.path.join(tmp, "model.npz")
+    botmod.train_spam_model(path, epochs=100)
+    return path
+
+
+def messages_from_db(path: str) -> list[str]:
+    con = sqlite3.connect(path)
+    rows = con.execute("SELECT text_snip FROM deleted_ads_log WHERE text_snip != '' LIMIT 5000").fetchall()
+    con.close()
+    return [r[0] for r in rows]
+
+
+def bench_batches(model, messages: list[str], repeat: int):
+    print("batch size  µs/msg")
+    for size in (1, 4, 16, 64):
+        batches = [messages[i:i + size] for i in range(0, len(messages) - size + 1, size)]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for b in batches:
+                model.scores(b)
+        per_msg = (time.perf_counter() - start) / (repeat * len(batches) * size)
+        print(f"{size:10}  {per_msg * 1e6:7.1f}")
+
+
+async def bench_micro(messages: list[str], rate: float) -> None:
+    scorer = botmod.SpamScorer()
+    scorer.model = botmod.SPAM_SCORER.model
+    waits: list[float] = []
+    batch_sizes: list[int] = []
+    flush = scorer._flush
+
+    def counting_flush():
+        batch_sizes.append(len(scorer.pending))
+        flush()
+    scorer._flush = counting_flush
+
+    async def one(text: str):
+        start = time.perf_counter()
+        await scorer.score(text)
+        waits.append((time.perf_counter() - start) * 1000)
+
+    rnd = random.Random(3)
+    tasks = []
+    for text in messages:
+        tasks.append(asyncio.create_task(one(text)))
+        await asyncio.sleep(rnd.expovariate(rate))
+    await asyncio.gather(*tasks)
+    waits.sort()
+    sizes = [s for s in batch_sizes if s]
+    print(f"micro-batching at ~{rate:.0f} msg/s (window {botmod.SPAM_BATCH_WINDOW_MS} ms): "
+          f"p50 {percentile(waits, 50):.2f} ms, p99 {percentile(waits, 99):.2f} ms, "
+          f"mean batch {sum(sizes) / max(len(sizes), 1):.1f}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Spam model latency per message")
+    ap.add_argument("--model", help="готовая модель .npz (иначе обучим временную)")
+    ap.add_argument("--db", help="взять тексты из deleted_ads_log этой базы")
+    ap.add_argument("--messages", type=int, default=2000)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--rate", type=float, default=500, help="сообщений в секунду для micro-batching")
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="mcbot-spam-")
+    try:
+        path = args.model or train_synthetic(tmp)
+        botmod.SPAM_SCORER.load(path)
+        if botmod.SPAM_SCORER.model is None:
+            sys.exit("model not loaded (numpy missing?)")
+        messages = messages_from_db(args.db) if args.db else synthetic_messages(args.messages)
+        bench_batches(botmod.SPAM_SCORER.model, messages, args.repeat)
+        asyncio.run(bench_micro(messages[:1000], args.rate))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
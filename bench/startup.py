@@ -0,0 +1,125 @@
+# startup.py
+# Бенчмарк холодного старта: сколько проходит от запуска процесса до первого getUpdates.
+#
+# Бот запускается отдельным процессом (чтобы честно посчитать импорты) против
+# локальной заглушки Bot API (fake_bot_api.py); время первого getUpdates берём из заглушки.
+#
+#   fresh  — новая база: схема создаётся, команды регистрируются (в фоне)
+#   warm   — та же база второй раз: хэш команд совпал, set_my_commands не вызывается
+#   legacy — старый порядок: команды (3 запроса) и delete_webhook до поллинга
+#
+# Примеры:
+#   python bench/startup.py
+#   python bench/startup.py --runs 5 --api-latency-ms 80
+
+import argparse
+import asyncio
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+
+def child(base_url: str, db_path: str, legacy: bool):
+    t0 = time.perf_counter()
+    import bot as botmod
+    from aiogram.client.telegram import TelegramAPIServer
+    print(f"IMPORT {time.perf_counter() - t0:.4f}", flush=True)
+
+    botmod.DB_PATH = db_path
+    botmod.METRICS_ENABLED = False
+    botmod.bot.session.api = TelegramAPIServer.from_base(base_url)
+
+    async def legacy_main():
+        # как было до отложенной регистрации: три set_my_commands подряд, потом вебхук
+        from aiogram.types import BotCommandScopeAllGroupChats, BotCommandScopeAllPrivateChats, BotCommandScopeDefault
+        botmod.db().close()
+        await botmod.bot.set_my_commands([], scope=BotCommandScopeAllPrivateChats())
+        await botmod.bot.set_my_commands([], scope=BotCommandScopeDefault())
+        await botmod.bot.set_my_commands([], scope=BotCommandScopeAllGroupChats())
+        await botmod.bot.delete_webhook(drop_pending_updates=True)
+        await botmod.dp.start_polling(botmod.bot)
+
+    asyncio.run(legacy_main() if legacy else botmod.main())
+
+
+async def measure(mode: str, db_path: str, api_latency_ms: float, timeout: float, settle: float = 0.5) -> dict:
+    fake = FakeBotAPI(latency_ms=api_latency_ms)
+    base = await fake.start()
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable, __file__, "--child", base, db_path, *(["--legacy"] if mode == "legacy" else []),
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+    )
+    import_s = None
+    try:
+        line = await asyncio.wait_for(proc.stdout.readline(), timeout)
+        if line.startswith(b"IMPORT "):
+            import_s = float(line.split()[1])
+        deadline = started + timeout
+        while "getUpdates" not in fake.first_call_ts and time.perf_counter() < deadline:
+            await asyncio.sleep(0.002)
+        # даём фоновой регистрации команд доработать (и записать хэш для warm-прогона)
+        await asyncio.sleep(settle)
+    finally:
+        first = fake.first_call_ts.get("getUpdates")
+        proc.terminate()
+        await proc.wait()
+        await fake.stop()
+    return {
+        "mode": mode,
+        "to_first_getupdates_s": round(first - started, 4) if first else None,
+        "import_s": import_s,
+        "set_my_commands": fake.calls.get("setMyCommands", 0),
+    }
+
+
+async def run(runs: int, api_latency_ms: float, timeout: float) -> list[dict]:
+    results = []
+    for _ in range(runs):
+        tmp = tempfile.mkdtemp(prefix="mcbot-startup-")
+        db_path = os.path.join(tmp, "startup.db")
+        try:
+            results.append(await measure("fresh", db_path, api_latency_ms, timeout))
+            results.append(await measure("warm", db_path, api_latency_ms, timeout))
+            results.append(await measure("legacy", os.path.join(tmp, "legacy.db"), api_latency_ms, timeout))
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--child":
+        child(sys.argv[2], sys.argv[3], "--legacy" in sys.argv)
+        return
+
+    ap = argparse.ArgumentParser(description="Cold start benchmark: process start -> first getUpdates")
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--api-latency-ms", type=float, default=50.0, help="задержка заглушки API (сеть до Telegram)")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    args = ap.parse_args()
+
+    results = asyncio.run(run(args.runs, args.api_latency_ms, args.timeout))
+    for mode in ("fresh", "warm", "legacy"):
+        rows = [r for r in results if r["mode"] == mode and r["to_first_getupdates_s"] is not None]
+        if not rows:
+            print(f"{mode:6}: no getUpdates within timeout")
+            continue
+        total = statistics.median(r["to_first_getupdates_s"] for r in rows)
+        imp = statistics.median(r["import_s"] or 0 for r in rows)
+        last = rows[-1]
+        print(f"{mode:6}: first getUpdates {total * 1000:8.1f} ms  (import {imp * 1000:7.1f} ms, "
+              f"after import {(total - imp) * 1000:7.1f} ms)  setMyCommands calls: {last['set_my_commands']}")
+
+
+if __name__ == "__main__":
+    main()
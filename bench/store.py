@@ -0,0 +1,149 @@
+# store.py
+# Проверка и замер хранилищ разрешений/страйков (STORE в bot.py).
+#
+# 1) Одинаковый сценарий (выдать/снять разрешение, страйки, /mclist, транзакция) прогоняется на
+#    SqliteStore и RedisStore — результаты должны совпасть.
+# 2) Замер операций на сообщение: permit_get (один pipeline) и counter_incr.
+#
+# Без --redis-url поднимает локальную заглушку fake_redis.py в отдельном потоке.
+# Для RedisStore нужен пакет redis (pip install redis); без него проверяется только SQLite.
+# Настоящий Redis — только пустая база (номер БД в URL): сценарий пишет по фиксированным ключам.
+#
+# Примеры:
+#   python bench/store.py
+#   python bench/store.py --redis-url redis://127.0.0.1:6379/15 --ops 20000
+
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from fake_redis import FakeRedis  # noqa: E402
+
+import bot as botmod  # noqa: E402
+
+CHAT = -1001000000001
+
+
+def scenario(store) -> list:
+    out = []
+    store.permit_set(CHAT, 1, None)
+    store.permit_set(CHAT, 2, 2_000_000_000)
+    store.permit_touch(CHAT, 1, 1_700_000_000)
+    store.permit_touch(CHAT, 3, 1_700_000_000)   # разрешения нет — ничего не меняется
+    out.append(store.permit_get(CHAT, 1))
+    out.append(store.permit_get(CHAT, 3))
+    out.append(sorted(store.permits_list(CHAT)))
+    store.permit_remove(CHAT, 2)
+    out.append(sorted(store.permits_list(CHAT)))
+    out.append([store.counter_incr("ad_strikes", CHAT, 7) for _ in range(3)])
+    store.counter_set("ad_strikes", CHAT, 7, 0)
+    out.append(store.counter_get("ad_strikes", CHAT, 7))
+    out.append(store.counter_incr("cooldown_strikes", CHAT, 7, 5))
+    for i in range(15):
+        store.mc_upsert((CHAT, 100 + i, f"u{i}", "mute", None, "test", 1_700_000_000 + i, 1, 1))
+    store.mc_upsert((CHAT, 100, "u0", "mute", 5, "again", 1_700_000_100, 1, 0))   # перезапись той же строки
+    out.append(store.mc_list(CHAT, 0, 10))
+    out.append(store.mc_list(CHAT, 10, 10))
+    with store.transaction():   # массовые действия: всё одним коммитом / MULTI-EXEC
+        store.permit_set(CHAT, 50, None)
+        store.counter_set("admin_warns", CHAT, 50, 2)
+        store.mc_upsert((CHAT, 50, "u50", "mute", None, "auto", 1_700_000_200, 0, 1))
+    out.append((store.permit_get(CHAT, 50), store.counter_get("admin_warns", CHAT, 50)))
+    out.append(sorted(tuple(r) for r in store.mc_find(CHAT, 1_700_000_100)))
+    return out
+
+
+def normalize(results: list) -> list:
+    # строки mc_list сравниваем как кортежи независимо от того, что вернул драйвер
+    out = []
+    for r in results:
+        if isinstance(r, tuple) and len(r) == 2 and isinstance(r[0], list):
+            r = ([tuple(x) for x in r[0]], r[1])
+        out.append(r)
+    return out
+
+
+def bench(store, ops: int) -> dict:
+    for uid in range(100):
+        store.permit_set(CHAT, uid, None)
+    start = time.perf_counter()
+    for i in range(ops):
+        store.permit_get(CHAT, i % 200)
+    t_get = (time.perf_counter() - start) / ops
+    start = time.perf_counter()
+    for i in range(ops):
+        store.counter_incr("cooldown_strikes", CHAT, i % 200)
+    t_incr = (time.perf_counter() - start) / ops
+    return {"permit_get_us": round(t_get * 1e6, 2), "counter_incr_us": round(t_incr * 1e6, 2)}
+
+
+def start_fake_redis() -> str:
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        async def serve():
+            fake = FakeRedis()
+            holder["url"] = await fake.start()
+            ready.set()
+            await asyncio.Event().wait()
+        asyncio.run(serve())
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait(5)
+    return holder["url"]
+
+
+def main():
+    ap = argparse.ArgumentParser(description="SqliteStore vs RedisStore: consistency + per-op latency")
+    ap.add_argument("--redis-url", help="настоящий Redis (по умолчанию — fake_redis.py)")
+    ap.add_argument("--ops", type=int, default=5000)
+    args = ap.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="mcbot-store-")
+    try:
+        stores = {}
+        botmod.DB_PATH = os.path.join(tmp, "scenario.db")
+        stores["sqlite"] = botmod.SqliteStore()
+        try:
+            stores["redis"] = botmod.RedisStore(args.redis_url or start_fake_redis())
+            stores["redis"].warm()
+        except RuntimeError as e:
+            print(f"redis: skipped ({e})")
+
+        results = {name: normalize(scenario(s)) for name, s in stores.items()}
+        if len(results) == 2:
+            same = results["sqlite"] == results["redis"]
+            print(f"scenario: {'OK, results match' if same else 'MISMATCH'}")
+            if not same:
+                for i, (a, b) in enumerate(zip(results["sqlite"], results["redis"])):
+                    if a != b:
+                        print(f"  step {i}: sqlite={a!r}\n          redis ={b!r}")
+                sys.exit(1)
+
+        botmod.DB_PATH = os.path.join(tmp, "bench.db")
+        sqlite_warm = botmod.SqliteStore()
+        sqlite_warm.warm()
+        runs = {"sqlite (cold)": botmod.SqliteStore(), "sqlite (warm)": sqlite_warm}
+        if "redis" in stores:
+            runs["redis"] = stores["redis"]
+        for name, store in runs.items():
+            print(f"{name:14}: {bench(store, args.ops)}")
+        for s in list(stores.values()) + list(runs.values()):
+            s.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
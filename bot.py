@@ -4,25 +4,50 @@
 # - Исключение: YouTube ссылки НЕ считаются рекламой
 # - Ловит рекламу даже через РЕДАКТИРОВАНИЕ сообщения (edited_message)
 # - Ловит IP-адреса и адреса Minecraft серверов (play.example.com / mc.example.net:25565)
+# - Проверяет не только текст: кнопки-ссылки, контакты, места, опросы, стикерпаки, пересылки из каналов
+# - Опционально: QR-коды и текст (OCR) на картинках — локально, без внешних сервисов
+# - Опционально: спам-модель по n-граммам (numpy), обучается на логе удалённой рекламы
+# - Разрешения/страйки/наказания: локальная SQLite или общий Redis (несколько экземпляров бота)
 # - Кнопки (callback_data) работают
 # - Подсказки "/" в группах убраны (set_my_commands пусто для групп)
 # - В ЛС есть меню с кнопками + админские кнопки
 
+import abc
+import asyncio
+import contextvars
+import hashlib
+import html
+import json
 import os
+import random
 import re
+import secrets
 import sqlite3
+import struct
+import threading
+import time
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
 
 import logging
 logging.basicConfig(level=logging.INFO)
 
-from aiogram import Bot, Dispatcher, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import PRODUCTION, TelegramAPIServer
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
+from aiogram.dispatcher.event.bases import SkipHandler
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
 from aiogram.filters import Command
 from aiogram.types import (
-    Message, CallbackQuery,
+    Message, CallbackQuery, ChatMemberUpdated,
     InlineKeyboardMarkup, InlineKeyboardButton,
     ChatPermissions,
     BotCommand,
@@ -32,6 +57,7 @@ from aiogram.types import (
 )
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
 
 
 # =========================
@@ -44,6 +70,12 @@ TOKEN = "8563240122:AAHSDsS6eJOg-NbvUO-wwmu2TQypI8wLz80"
 ADMIN_IDS = {8085895186}
 
 DB_PATH = "mc_bot.db"
+
+# общее хранилище разрешений/страйков/наказаний (для нескольких экземпляров бота):
+# "" — локальная SQLite (DB_PATH), "redis://host:6379/0" — Redis (нужен пакет redis)
+STORE_URL = ""
+STORE_POOL_SIZE = 10
+STORE_TIMEOUT_SECONDS = 2.0
 HASHTAG = "#реклама"
 
 # анти-реклама: стадии наказаний (без разрешения)
@@ -65,6 +97,152 @@ AD_WARN_STICKER_ID = None
 # /mclist — по 10 записей
 MC_LIST_PAGE_SIZE = 10
 
+# username → user_id: сколько держим в памяти и как часто сбрасываем в БД
+USERNAME_CACHE_SIZE = 50_000
+WRITE_BEHIND_FLUSH_SECONDS = 30
+
+# редактирования: последний вердикт по (chat_id, message_id) и контекст вокруг изменённого куска
+EDIT_CACHE_SIZE = 20_000
+EDIT_CONTEXT_CHARS = 64
+
+# вердикты по пересланным постам (один пост канала, пересланный в 30 чатов, проверяем один раз)
+FORWARD_CACHE_SIZE = 20_000
+
+# картинки: QR-коды и (опционально) OCR локально, в пуле процессов.
+# Нужны Pillow + pyzbar (или opencv-python) для QR, pytesseract + tesseract для OCR.
+IMAGE_SCAN_ENABLED = False
+IMAGE_OCR_ENABLED = False
+IMAGE_OCR_LANG = "rus+eng"
+IMAGE_SCAN_WORKERS = 2
+IMAGE_SCAN_QUEUE_SIZE = 32       # больше — новые картинки не сканируем (флуд)
+IMAGE_SCAN_TIMEOUT_SECONDS = 10
+IMAGE_MIN_SIDE = 320             # берём самый маленький размер фото не меньше этого
+IMAGE_CACHE_SIZE = 50_000
+
+# support: входящие пересылаются админам не чаще раза в N секунд на пользователя,
+# остальное копится в инбоксе и приходит одной сводкой
+SUPPORT_DEBOUNCE_SECONDS = 30
+SUPPORT_PAGE_SIZE = 8
+SUPPORT_THREAD_PREVIEW = 10
+SUPPORT_HISTORY_DAYS = 180       # переписку старше удаляем (поддержка — не архив)
+
+# анти-флуд в ЛС: token bucket на пользователя (админы не ограничены)
+PRIVATE_BURST = 5                   # сколько сообщений подряд можно сразу
+PRIVATE_RATE_PER_MINUTE = 6         # скорость восстановления
+
+# готовые экраны (/mclist, список разрешений): кэш по версии данных
+VIEW_CACHE_SIZE = 2_000
+VIEW_CACHE_TTL_SECONDS = 60          # статусы "Активно/Неактивно" зависят от времени
+
+# спам-модель (n-граммы, нужен numpy): доп. сигнал, если правила ничего не нашли.
+# Обучение: python bot.py train-spam (из deleted_ads_log + выборки чистых сообщений)
+SPAM_MODEL_PATH = "spam_model.npz"
+SPAM_THRESHOLD = 0.9
+SPAM_HASH_BITS = 18
+SPAM_BATCH_WINDOW_MS = 3          # сколько ждать соседей для общего прохода
+SPAM_BATCH_MAX = 64
+SPAM_CLEAN_SAMPLE_RATE = 0.02     # доля чистых сообщений, которые сохраняем для обучения
+SPAM_CLEAN_SAMPLE_MAX = 20_000
+
+# репутация доменов: свои сервера (не реклама) и блок-листы (всегда реклама).
+# Сборка: python bot.py build-domains --allow partners.txt --block list1.txt list2.txt
+DOMAIN_INDEX_PATH = "domains.idx"
+DOMAIN_CACHE_SIZE = 50_000
+
+# доверие: старые участники без нарушений проходят облегчённую проверку (только t.me и IP)
+TRUST_CLEAN_MESSAGES = 50                  # столько чистых сообщений в чате...
+TRUST_MIN_AGE_SECONDS = 7 * 24 * 60 * 60   # ...и столько времени с первого сообщения
+TRUST_SAMPLE_RATE = 0.05                   # доля сообщений доверенных, которые всё равно проверяем полностью
+
+# флуд в группах: одно и то же много раз или очередь сообщений подряд — та же лестница мутов
+FLOOD_RING_SIZE = 16                # сколько последних сообщений помним на (чат, юзер)
+FLOOD_WINDOW_SECONDS = 60           # старше — уже не считаются
+FLOOD_DUPLICATES = 4                # столько одинаковых сообщений в окне — флуд
+FLOOD_BURST_MESSAGES = 8            # столько сообщений...
+FLOOD_BURST_SECONDS = 5             # ...за столько секунд — флуд
+FLOOD_MAX_TRACKERS = 50_000         # потолок памяти; молчащих дольше окна выкидываем раньше
+
+# проверка новых участников: реклама в имени, username и (опционально) в био.
+# Вердикт кэшируется по user_id для всех чатов; во время рейда запросы идут пачками с лимитом.
+JOIN_SCREEN_ENABLED = True
+JOIN_SCREEN_BIO = True                      # био — через get_chat по пользователю (один запрос на человека)
+JOIN_SCREEN_ACTION = "flag"                 # "flag" — только сообщить админам, "restrict" — мут на JOIN_SCREEN_RESTRICT_SECONDS
+JOIN_SCREEN_RESTRICT_SECONDS = 60 * 60
+JOIN_SCREEN_CACHE_SIZE = 100_000
+JOIN_SCREEN_TTL_SECONDS = 24 * 60 * 60
+JOIN_SCREEN_BATCH = 50                      # сколько входов разбираем за раз (и сводим в одно сообщение админам)
+JOIN_SCREEN_QUEUE_MAX = 10_000
+JOIN_SCREEN_RATE_PER_SECOND = 10            # get_chat/restrict во время рейда
+JOIN_SCREEN_CONCURRENCY = 4
+
+# повторная доставка апдейтов: после рестарта забираем накопившиеся апдейты,
+# а уже обработанные отсекает журнал update_id (DEDUPE_LEDGER_SIZE последних ключей).
+# Ключ попадает в БД до того, как хендлер что-то сделал (один commit на пачку апдейтов)
+DROP_PENDING_UPDATES = False
+DEDUPE_LEDGER_SIZE = 50_000
+
+# HTTP к Bot API. BOT_API_URL — свой Local Bot API server (telegram-bot-api), например
+# "http://127.0.0.1:8081"; "" — публичный api.telegram.org. Перед переездом на свой сервер
+# бота один раз разлогинивают из облака (bot.log_out()), иначе сервер не примет токен.
+BOT_API_URL = ""
+BOT_API_LOCAL_FILES = False        # сервер запущен с --local и файлы лежат на этой же машине
+HTTP_POOL_SIZE = 100               # одновременных соединений к Bot API
+HTTP_KEEPALIVE_SECONDS = 60        # сколько держать простаивающее соединение
+HTTP_DNS_CACHE_SECONDS = 600
+HTTP_TIMEOUT_SECONDS = 30          # по умолчанию для методов без своего таймаута
+HTTP_METHOD_TIMEOUTS = {           # быстрые действия модерации не должны висеть по 30 с
+    "deleteMessage": 10,
+    "sendMessage": 15,
+    "copyMessage": 15,
+    "restrictChatMember": 10,
+    "banChatMember": 10,
+    "getChatMember": 10,
+    "getChatAdministrators": 10,
+    "answerCallbackQuery": 5,
+}
+
+# исходящие сообщения: общий лимит Bot API и параллельность
+SEND_RATE_PER_SECOND = 25
+SEND_CONCURRENCY = 8
+
+# массовые действия из ЛС (снять муты/баны/варны, разрешения пачкой)
+BULK_MAX_TARGETS = 500                 # пар (чат, пользователь) за один запуск
+BULK_AUTO_WINDOW_SECONDS = 60 * 60     # фильтр "авто-наказания за последний час"
+BULK_PROGRESS_SECONDS = 2              # как часто обновлять сообщение с прогрессом
+BULK_PICK_PAGE_SIZE = 10               # строк на странице выбора из /mclist
+
+# FSM (диалоги в ЛС): состояния хранятся в SQLite, брошенные протухают
+FSM_STATE_TTL_SECONDS = 24 * 60 * 60
+FSM_CACHE_SIZE = 10_000
+
+# метаданные чатов (название, права по умолчанию, права бота, число участников)
+CHAT_META_CACHE_SIZE = 10_000
+CHAT_META_TTL_SECONDS = 60 * 60        # через сколько перечитывать get_chat
+KNOWN_CHATS_TOUCH_SECONDS = 60 * 60    # как часто обновлять updated_ts в known_chats
+
+# админы чатов (для групповых команд): get_chat_administrators + правки из chat_member
+CHAT_ADMINS_CACHE_SIZE = 10_000
+CHAT_ADMINS_TTL_SECONDS = 60 * 60      # страховка на случай пропущенных chat_member
+
+# предупреждение "дай мне права" — не чаще раза в N секунд на чат
+RIGHTS_WARN_INTERVAL_SECONDS = 6 * 60 * 60
+# get_chat_member для прав бота не удался — столько не спрашиваем снова
+BOT_RIGHTS_RETRY_SECONDS = 60
+
+# метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108
+
+# трассировка апдейтов (JSON-логи по стадиям) и профайлер медленных апдейтов;
+# это значения при старте — в ЛС админ переключает их кнопками без рестарта
+TRACE_ENABLED = False
+PROFILE_ENABLED = False
+TRACE_SLOW_MS = 500              # апдейт медленнее этого — "медленный"
+PROFILE_SAMPLE_RATE = 0.1        # доля апдейтов, которые идут под cProfile (когда включён)
+PROFILE_DIR = "profiles"
+PROFILE_KEEP = 10                # сколько последних медленных захватов помнить
+
 
 # =========================
 # УТИЛИТЫ
@@ -130,16 +308,205 @@ def hashtag_at_end(text: str) -> bool:
 def has_hashtag(text: str) -> bool:
     return HASHTAG in (text or "").lower()
 
+# фоновые задачи "запустил и забыл": держим ссылку, пока идут (иначе GC может
+# собрать задачу на полпути), ошибки — в лог
+BACKGROUND_TASKS: set = set()
+
+def _background_done(task):
+    BACKGROUND_TASKS.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("background task failed", exc_info=task.exception())
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_background_done)
+    return task
+
 def mention_html(user_id: int, full_name: str) -> str:
     safe_name = (full_name or "Пользователь").replace("<", "").replace(">", "")
     return f'<a href="tg://user?id={user_id}">{safe_name}</a>'
 
 
+# =========================
+# КЭШИ
+# =========================
+_MISSING = object()
+
+class LRUCache:
+    """
+    LRU-кэш поверх OrderedDict.
+    ttl (секунды) — опционально: протухшие записи считаются отсутствующими.
+    """
+
+    def __init__(self, maxsize: int, ttl: float | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+        if item is _MISSING:
+            return default
+        value, expires = item
+        if expires is not None and expires <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+
+    def clear(self):
+        self._data.clear()
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+# =========================
+# МЕТРИКИ (Prometheus text format)
+# =========================
+# Всё в памяти процесса: inc/observe — это dict-lookup и пара сложений,
+# gauge'и считаются только в момент запроса /metrics.
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+METRICS: list = []
+
+def _labels_str(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for n, v in zip(names, values):
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+        pairs.append(f'{n}="{v}"')
+    return "{" + ",".join(pairs) + "}"
+
+class Counter:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values: dict[tuple, float] = {}
+        METRICS.append(self)
+
+    def inc(self, *label_values, value: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for lv, v in self.values.items():
+            out.append(f"{self.name}{_labels_str(self.labels, lv)} {v}")
+        return out
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name, self.doc, self.labels, self.buckets = name, doc, labels, buckets
+        self.values: dict[tuple, list] = {}   # labels -> [counts по бакетам (+Inf последний), sum]
+        METRICS.append(self)
+
+    def observe(self, value: float, *label_values):
+        item = self.values.get(label_values)
+        if item is None:
+            item = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        item[0][bisect_left(self.buckets, value)] += 1
+        item[1] += value
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        names = self.labels + ("le",)
+        for lv, (counts, total) in self.values.items():
+            acc = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                out.append(f"{self.name}_bucket{_labels_str(names, lv + (le,))} {acc}")
+            out.append(f"{self.name}_sum{_labels_str(self.labels, lv)} {total}")
+            out.append(f"{self.name}_count{_labels_str(self.labels, lv)} {acc}")
+        return out
+
+class Gauge:
+    """Значение считается функцией в момент запроса: fn() -> число или {label: число}."""
+
+    def __init__(self, name: str, doc: str, fn, label: str | None = None):
+        self.name, self.doc, self.fn, self.label = name, doc, fn, label
+        METRICS.append(self)
+
+    def render(self) -> list[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.fn()
+        except Exception:
+            return out
+        if self.label:
+            for k, v in value.items():
+                out.append(f"{self.name}{_labels_str((self.label,), (k,))} {v}")
+        else:
+            out.append(f"{self.name} {value}")
+        return out
+
+def metrics_render() -> str:
+    lines = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+M_UPDATES = Counter("mcbot_updates_total", "Updates by type", ("type",))
+M_AD_VERDICTS = Counter("mcbot_ad_verdicts_total", "Detector verdicts by reason", ("reason",))
+M_TRUST_TIER = Counter("mcbot_trust_tier_total", "Checked messages by trust tier (new/trusted/sampled/escalated)", ("tier",))
+M_API_ERRORS = Counter("mcbot_api_errors_total", "Failed Telegram API calls by method", ("method",))
+M_DB_QUERIES = Counter("mcbot_db_queries_total", "SQLite statements by kind", ("op",))
+M_DETECT_SECONDS = Histogram("mcbot_detect_seconds", "Ad detection time")
+M_DB_SECONDS = Histogram("mcbot_db_query_seconds", "SQLite statement time", ("op",))
+M_API_SECONDS = Histogram("mcbot_telegram_request_seconds", "Telegram API call latency", ("method",))
+M_HANDLER_SECONDS = Histogram("mcbot_handler_seconds", "End-to-end update handling time", ("type",))
+
+
+# ----- трассировка по стадиям -----
+DIAG = {"trace": TRACE_ENABLED, "profile": PROFILE_ENABLED}
+
+_TRACE: contextvars.ContextVar[dict | None] = contextvars.ContextVar("mcbot_trace", default=None)
+trace_log = logging.getLogger("mcbot.trace")
+
+def trace_add(stage: str, seconds: float):
+    tr = _TRACE.get()
+    if tr is not None:
+        stages = tr["stages"]
+        stages[stage] = stages.get(stage, 0.0) + seconds * 1000
+
+class trace_stage:
+    """with trace_stage("detect"): ... — время стадии попадает в трассу текущего апдейта."""
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        trace_add(self.name, time.perf_counter() - self.start)
+        return False
+
+
 # =========================
 # АНТИ-РЕКЛАМА (детект)
 # =========================
 
 KW = ["продам", "куплю", "сдам", "прайс", "подпишитесь", "подписывайтесь"]
+KW_RE = re.compile("|".join(re.escape(w) for w in KW))
 
 URL_RE = re.compile(r"(https?://[^\s]+|www\.[^\s]+)", re.I)
 TME_RE = re.compile(r"(https?://)?t\.me/[\w_]{3,}", re.I)
@@ -178,6 +545,117 @@ def url_host(u: str) -> str | None:
     except Exception:
         return None
 
+# ----- репутация доменов: свои сервера (allow) и блок-листы (block) -----
+# Файл строится заранее (python bot.py build-domains ...) и открывается через mmap:
+# ничего не копируется в память Python, открытие — миллисекунды при любом размере списка.
+# Формат: заголовок, (n+1) смещений uint32, затем записи "tier-байт + домен с перевёрнутыми
+# метками" (play.example.com -> com.example.play), отсортированные побайтно.
+# Запись действует и на поддомены; самое точное совпадение побеждает.
+DOMAIN_INDEX_MAGIC = b"MCDOM1\0\0"
+DOMAIN_TIERS = {1: "allow", 2: "block"}
+
+class DomainIndex:
+    def __init__(self, path: str):
+        import mmap
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mm[:8] != DOMAIN_INDEX_MAGIC:
+            raise ValueError(f"{path}: not a domain index")
+        (self.n,) = struct.unpack_from("<I", self.mm, 8)
+        self.offsets = 12
+        self.blob = 12 + 4 * (self.n + 1)
+
+    def _find(self, key: bytes) -> str | None:
+        mm, blob, offsets = self.mm, self.blob, self.offsets
+        lo, hi = 0, self.n
+        while lo < hi:
+            mid = (lo + hi) // 2
+            a, b = struct.unpack_from("<II", mm, offsets + 4 * mid)
+            k = mm[blob + a + 1:blob + b]
+            if k < key:
+                lo = mid + 1
+            elif k > key:
+                hi = mid
+            else:
+                return DOMAIN_TIERS.get(mm[blob + a])
+        return None
+
+    def lookup(self, host: str) -> str | None:
+        labels = host.strip(".").split(".")[::-1]
+        for i in range(len(labels), 0, -1):
+            tier = self._find(".".join(labels[:i]).encode())
+            if tier:
+                return tier
+        return None
+
+    def close(self):
+        self.mm.close()
+
+DOMAIN_INDEX: DomainIndex | None = None
+DOMAIN_TIER_CACHE = LRUCache(DOMAIN_CACHE_SIZE)
+
+def domain_index_load(path: str = DOMAIN_INDEX_PATH):
+    # при старте и из maintenance: подхватываем пересобранный файл без рестарта
+    global DOMAIN_INDEX
+    if not os.path.exists(path):
+        return
+    if DOMAIN_INDEX is not None and DOMAIN_INDEX.path == path and DOMAIN_INDEX.mtime == os.path.getmtime(path):
+        return
+    old, DOMAIN_INDEX = DOMAIN_INDEX, DomainIndex(path)
+    DOMAIN_TIER_CACHE.clear()
+    if old is not None:
+        old.close()
+    logging.info("domain index loaded: %s (%d domains)", path, DOMAIN_INDEX.n)
+
+def domain_tier(host: str) -> str | None:
+    if DOMAIN_INDEX is None or not host:
+        return None
+    tier = DOMAIN_TIER_CACHE.get(host)
+    if tier is None:
+        tier = DOMAIN_INDEX.lookup(host) or ""
+        DOMAIN_TIER_CACHE.set(host, tier)
+    return tier or None
+
+def _domain_list_entries(path: str):
+    # понимает: домен на строку, hosts-файлы ("0.0.0.0 domain"), adblock ("||domain^"), "*.domain", "domain:port"
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip().lower()
+            if not line or line.startswith("!"):
+                continue
+            parts = line.split()
+            d = parts[-1] if len(parts) > 1 else parts[0]
+            d = d.removeprefix("||").removeprefix("*.").split("^", 1)[0].split("/", 1)[0]
+            d = d.split(":", 1)[0].strip(".")
+            if "." in d:
+                yield d
+
+def build_domain_index(out_path: str, allow_paths: list[str], block_paths: list[str]) -> int:
+    entries: dict[bytes, int] = {}
+    for tier, paths in ((2, block_paths), (1, allow_paths)):   # allow пишем последним — он главнее
+        for p in paths:
+            for d in _domain_list_entries(p):
+                entries[".".join(d.split(".")[::-1]).encode()] = tier
+    keys = sorted(entries)
+    offsets, blob, pos = [], bytearray(), 0
+    for k in keys:
+        offsets.append(pos)
+        blob.append(entries[k])
+        blob += k
+        pos += 1 + len(k)
+    offsets.append(pos)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(DOMAIN_INDEX_MAGIC)
+        f.write(struct.pack("<I", len(keys)))
+        f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+        f.write(blob)
+    os.replace(tmp, out_path)   # работающий бот держит mmap старого файла — подменяем атомарно
+    return len(keys)
+
+
 def is_youtube_url(text: str) -> bool:
     for m in URL_RE.finditer(text or ""):
         host = url_host(m.group(0))
@@ -185,6 +663,29 @@ def is_youtube_url(text: str) -> bool:
             return True
     return False
 
+def is_ad_name(text: str | None, links: bool = True) -> tuple[bool, str]:
+    """
+    Строгая проверка для имён файлов, тегов трека, имён и био участников:
+    только t.me, явные ссылки (http://, www.), домен:порт и домены из блок-листа.
+    Эвристики сообщений (play./mc./server., ключевые слова, телефоны) здесь дают
+    ложные срабатывания: server.properties, mc.jar, play.mp3.
+    links=False — обычные ссылки не считаются (в био своя страница — норма).
+    """
+    low = (text or "").lower()
+    if "." not in low:
+        return False, ""
+    if TME_RE.search(low):
+        return True, "ссылка t.me"
+    for m in URL_RE.finditer(low) if links else ():
+        host = url_host(m.group(0)) or ""
+        if host and host not in YOUTUBE_HOSTS and domain_tier(host) != "allow":
+            return True, "ссылка"
+    for m in DOMAIN_PORT_RE.finditer(low):
+        tier = domain_tier(m.group(1))
+        if tier == "block" or (m.group(2) and tier != "allow"):
+            return True, "адрес сервера/IP"
+    return False, ""
+
 def contains_mc_address(text: str) -> bool:
     t = (text or "").lower()
 
@@ -194,6 +695,11 @@ def contains_mc_address(text: str) -> bool:
     for m in DOMAIN_PORT_RE.finditer(t):
         domain = m.group(1)
         port = m.group(2)
+        tier = domain_tier(domain)
+        if tier == "allow":
+            continue
+        if tier == "block":
+            return True
         if port:
             return True
         if MC_HINT_RE.search(domain):
@@ -201,15 +707,29 @@ def contains_mc_address(text: str) -> bool:
 
     return False
 
-def is_ad_message(text: str | None) -> tuple[bool, str]:
+def is_ad_message(text: str | None, entities: list | None = None) -> tuple[bool, str]:
     """
     Возвращает (True/False, причина)
     @username НЕ считаем рекламой.
     Исключение: YouTube ссылки разрешаем (не реклама).
+    Если переданы entities (msg.entities / msg.caption_entities) — сначала смотрим их,
+    регулярками сканируем только то, что Telegram не разметил.
     """
+    if entities:
+        return is_ad_by_entities(text or "", entities)
+
     t = (text or "").strip()
     low = t.lower()
 
+    if "." not in low and "://" not in low:
+        # без точки и схемы не бывает ни ссылок, ни доменов, ни IP — остаются телефон и ключевые слова
+        if PHONE_RE.search(low):
+            return True, "номер телефона"
+        m = KW_RE.search(low)
+        if m:
+            return True, f'ключевое слово: "{m.group(0)}"'
+        return False, ""
+
     if is_youtube_url(low):
         if TME_RE.search(low) or IPV4_RE.search(low) or contains_mc_address(low):
             return True, "ссылка/адрес (кроме YouTube)"
@@ -224,21 +744,325 @@ def is_ad_message(text: str | None) -> tuple[bool, str]:
     if contains_mc_address(low):
         return True, "адрес сервера/IP"
 
-    for w in KW:
-        if w in low:
-            return True, f'ключевое слово: "{w}"'
+    m = KW_RE.search(low)
+    if m:
+        return True, f'ключевое слово: "{m.group(0)}"'
+
+    for m in URL_RE.finditer(low):
+        if domain_tier(url_host(m.group(0)) or "") != "allow":
+            return True, "ссылка"
+
+    return False, ""
+
+
+# ----- детект по entities от Telegram -----
+TELEGRAM_HOSTS = {"t.me", "telegram.me", "telegram.dog"}
+
+# приоритет причин — как порядок проверок в is_ad_message
+AD_REASON_PRIORITY = {"ссылка t.me": 0, "номер телефона": 1, "адрес сервера/IP": 2}
+
+def ad_reason_rank(reason: str) -> int:
+    if reason in AD_REASON_PRIORITY:
+        return AD_REASON_PRIORITY[reason]
+    return 3 if reason.startswith("ключевое слово") else 4
+
+# эти куски текста Telegram уже разобрал — регулярками по ним не ходим
+TOKENIZED_ENTITY_TYPES = {"url", "phone_number", "mention", "email", "hashtag", "cashtag", "bot_command"}
+
+def split_host_port(url: str) -> tuple[str | None, str | None]:
+    u = url.strip()
+    if "://" not in u:
+        u = "http://" + u
+    try:
+        netloc = urlparse(u).netloc.lower().split("@")[-1]
+    except Exception:
+        return None, None
+    host, _, port = netloc.partition(":")
+    return (host or None), (port or None)
+
+def url_verdict(url: str, explicit: bool = True) -> str | None:
+    """
+    Причина рекламы для одной ссылки или None.
+    explicit=False — "голый" домен без схемы/www (его, как и раньше, считаем
+    рекламой только если это похоже на адрес сервера).
+    """
+    host, port = split_host_port(url)
+    if not host:
+        return None
+    if host in YOUTUBE_HOSTS:
+        return None
+    if host in TELEGRAM_HOSTS or host.endswith(".t.me"):
+        return "ссылка t.me"
+    tier = domain_tier(host)
+    if tier == "allow":
+        return None
+    if tier == "block":
+        return "адрес сервера/IP"
+    if port or IPV4_RE.fullmatch(host) or MC_HINT_RE.match(host):
+        return "адрес сервера/IP"
+    return "ссылка" if explicit else None
+
+def is_ad_by_entities(text: str, entities: list) -> tuple[bool, str]:
+    # offset/length у entities — в UTF-16 code units, поэтому режем UTF-16 байты
+    raw = text.encode("utf-16-le")
+    found: set[str] = set()
+    rest_parts = []
+    pos = 0
+    for e in sorted(entities, key=lambda x: x.offset):
+        start, end = e.offset * 2, (e.offset + e.length) * 2
+        if e.type == "text_link":
+            # скрытая ссылка: видимый текст может быть невинным — смотрим на url
+            reason = url_verdict(e.url or "")
+            if reason:
+                found.add(reason)
+            continue
+        if e.type not in TOKENIZED_ENTITY_TYPES or start < pos:
+            continue
+        chunk = raw[start:end].decode("utf-16-le", "ignore")
+        if e.type == "url":
+            low = chunk.lower()
+            reason = url_verdict(chunk, explicit=low.startswith(("http://", "https://", "www.")))
+            if reason:
+                found.add(reason)
+        elif e.type == "phone_number":
+            found.add("номер телефона")
+        rest_parts.append(raw[pos:start])
+        pos = end
+    rest_parts.append(raw[pos:])
+
+    if "ссылка t.me" in found:
+        return True, "ссылка t.me"
+
+    # то, что Telegram не разметил (IP, домен:порт, ключевые слова, "кривые" ссылки) — регулярками
+    rest = " ".join(p.decode("utf-16-le", "ignore") for p in rest_parts)
+    ad, reason = is_ad_message(rest)
+    if ad:
+        found.add(reason)
+    if not found:
+        return False, ""
+    return True, min(found, key=ad_reason_rank)
+
+
+# ----- повторная проверка при редактировании -----
+def _common_prefix_len(a: bytes, b: bytes) -> int:
+    # бинарный поиск по срезам: сравнения идут memcmp'ом, а не циклом в Python
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def _common_suffix_len(a: bytes, b: bytes, limit: int) -> int:
+    lo, hi = 0, min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:] == b[len(b) - mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def changed_region(old: str, new: str, entities: list | None) -> tuple[str, list | None]:
+    """
+    Кусок нового текста, который отличается от старого (+EDIT_CONTEXT_CHARS по краям),
+    и entities, попавшие в него (со сдвинутыми offset). Всё считается в UTF-16 code units,
+    как offset'ы у Telegram.
+    """
+    a, b = old.encode("utf-16-le"), new.encode("utf-16-le")
+    prefix = _common_prefix_len(a, b) // 2
+    suffix = _common_suffix_len(a, b, min(len(a), len(b)) - prefix * 2) // 2
+    total = len(b) // 2
+    start = max(0, prefix - EDIT_CONTEXT_CHARS)
+    end = min(total, total - suffix + EDIT_CONTEXT_CHARS)
+
+    # ссылки и прочие entities не режем пополам — расширяем окно до их границ
+    for e in entities or ():
+        if e.offset < end and e.offset + e.length > start:
+            start = min(start, e.offset)
+            end = max(end, e.offset + e.length)
+
+    # не разрываем суррогатную пару
+    if start > 0 and 0xDC00 <= int.from_bytes(b[start * 2:start * 2 + 2], "little") <= 0xDFFF:
+        start -= 1
+    if end < total and 0xD800 <= int.from_bytes(b[end * 2 - 2:end * 2], "little") <= 0xDBFF:
+        end += 1
+
+    window = b[start * 2:end * 2].decode("utf-16-le", "ignore")
+    if not entities:
+        return window, entities
+    shifted = [
+        e.model_copy(update={"offset": e.offset - start})
+        for e in entities
+        if e.offset >= start and e.offset + e.length <= end
+    ]
+    return window, shifted
+
+@dataclass(slots=True)
+class SeenMessage:
+    text_hash: int
+    text: str
+    ad: bool
+    handled: bool = False     # по сообщению уже были действия (удаление/наказание)
+    permitted: bool = False   # принято как реклама по разрешению — правки не считаются новой рекламой
+
+SEEN_MESSAGES = LRUCache(EDIT_CACHE_SIZE)  # (chat_id, message_id) -> SeenMessage
+
+
+# ----- что сканировать в сообщении любого типа -----
+def extract_scan_extras(msg: Message) -> tuple[list[str], list[str], list[str]]:
+    """
+    Всё, что можно проверить детектором, кроме самого text/caption:
+    (строки для is_ad_message, ссылки для url_verdict, имена для is_ad_name).
+    Кнопки, контакт, место, опрос, стикерпак, файл, источник пересылки и т.п.
+    """
+    texts: list[str] = []
+    urls: list[str] = []
+
+    markup = msg.reply_markup
+    if markup is not None and getattr(markup, "inline_keyboard", None):
+        for row in markup.inline_keyboard:
+            for btn in row:
+                if btn.text:
+                    texts.append(btn.text)
+                if btn.url:
+                    urls.append(btn.url)
+                if btn.login_url is not None:
+                    urls.append(btn.login_url.url)
+
+    origin = msg.forward_origin
+    if origin is not None and not msg.is_automatic_forward:
+        src = getattr(origin, "chat", None) or getattr(origin, "sender_chat", None)
+        if src is not None:
+            # сама пересылка из канала — не реклама; проверяем название и @username источника
+            texts.append(" ".join(x for x in (src.title, src.username and "@" + src.username) if x))
+        sender_name = getattr(origin, "sender_user_name", None)
+        if sender_name:
+            texts.append(sender_name)
+
+    if msg.story is not None and msg.story.chat is not None:
+        ch = msg.story.chat
+        texts.append(" ".join(x for x in (ch.title, ch.username and "@" + ch.username) if x))
+    if msg.via_bot is not None and msg.via_bot.username:
+        texts.append("@" + msg.via_bot.username)
+    if msg.contact is not None:
+        c = msg.contact
+        texts.append(" ".join(x for x in (c.first_name, c.last_name, c.phone_number) if x))
+    if msg.venue is not None:
+        texts.append(f"{msg.venue.title} {msg.venue.address}")
+    if msg.poll is not None:
+        texts.append(msg.poll.question)
+        texts.extend(o.text for o in msg.poll.options)
+    if msg.sticker is not None and msg.sticker.set_name:
+        texts.append(msg.sticker.set_name)
+    # имена файлов и теги трека — только строгая проверка (is_ad_name): server.properties — не адрес
+    names: list[str] = []
+    if msg.document is not None and msg.document.file_name:
+        names.append(msg.document.file_name)
+    if msg.audio is not None:
+        names.append(" ".join(x for x in (msg.audio.performer, msg.audio.title) if x))
+    return [t for t in texts if t], urls, [n for n in names if n]
+
+def forward_origin_key(msg: Message) -> tuple | None:
+    origin = msg.forward_origin
+    if origin is None or msg.is_automatic_forward:
+        return None
+    if origin.type == "channel":
+        return ("channel", origin.chat.id, origin.message_id)
+    return None
 
-    if URL_RE.search(low):
-        return True, "ссылка"
+FORWARD_VERDICTS = LRUCache(FORWARD_CACHE_SIZE)  # forward_origin_key -> (ad, reason)
 
+def is_ad_batch(items: list[tuple[str, list | None]], urls: list[str], origin_key: tuple | None = None) -> tuple[bool, str]:
+    """
+    Один вердикт по всем строкам сообщения (текст, подписи кнопок, контакт...) и ссылкам.
+    Для пересланных постов канала результат кэшируется по источнику.
+    """
+    if origin_key is not None:
+        cached = FORWARD_VERDICTS.get(origin_key)
+        if cached is not None:
+            return cached
+    found = []
+    for url in urls:
+        reason = url_verdict(url)
+        if reason:
+            found.append(reason)
+            if reason == "ссылка t.me":
+                break
+    if "ссылка t.me" not in found:
+        for text, entities in items:
+            ad, reason = is_ad_message(text, entities)
+            if ad:
+                found.append(reason)
+    verdict = (True, min(found, key=ad_reason_rank)) if found else (False, "")
+    if origin_key is not None:
+        FORWARD_VERDICTS.set(origin_key, verdict)
+    return verdict
+
+
+def is_ad_cheap(texts: list[str], urls: list[str]) -> tuple[bool, str] | None:
+    # облегчённая проверка для доверенных участников: t.me и IP решает сама,
+    # любая другая ссылка или домен — None, решает полный детектор (allow/block-листы, MC-домены)
+    for t in texts + urls:
+        low = t.lower()
+        if "." not in low:
+            continue
+        if TME_RE.search(low):
+            return True, "ссылка t.me"
+        if IPV4_RE.search(low):
+            return True, "адрес сервера/IP"
+        if URL_RE.search(low):
+            return None
+        for m in DOMAIN_PORT_RE.finditer(low):
+            # "1.20", "т.е." — не домены; домен — буквенная зона или порт
+            if m.group(2) or m.group(1).rsplit(".", 1)[1].isalpha():
+                return None
     return False, ""
 
 
 # =========================
 # БАЗА ДАННЫХ
 # =========================
+class TimedConnection(sqlite3.Connection):
+    # считает время и количество запросов для /metrics
+    def execute(self, sql, params=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, params)
+        finally:
+            op = sql.lstrip()[:6].lower()
+            M_DB_SECONDS.observe(time.perf_counter() - start, op)
+            M_DB_QUERIES.inc(op)
+
+    def executemany(self, sql, seq):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq)
+        finally:
+            op = sql.lstrip()[:6].lower()
+            M_DB_SECONDS.observe(time.perf_counter() - start, op)
+            M_DB_QUERIES.inc(op)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            M_DB_SECONDS.observe(time.perf_counter() - start, "commit")
+
+_SCHEMA_READY: set[str] = set()   # DB_PATH, для которых схема уже создана в этом процессе
+
 def db():
-    con = sqlite3.connect(DB_PATH)
+    con = sqlite3.connect(DB_PATH, factory=TimedConnection)
+    if DB_PATH not in _SCHEMA_READY:
+        _init_schema(con)
+        _SCHEMA_READY.add(DB_PATH)
+    return con
+
+
+def _init_schema(con: sqlite3.Connection):
     con.execute("""
     CREATE TABLE IF NOT EXISTS permits (
         chat_id INTEGER NOT NULL,
@@ -283,6 +1107,27 @@ def db():
         user_id INTEGER PRIMARY KEY,
         last_ts INTEGER NOT NULL DEFAULT 0
     )""")
+    _add_column(con, "support_threads", "unread", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(con, "support_threads", "username", "TEXT")
+    con.execute("CREATE INDEX IF NOT EXISTS support_threads_last ON support_threads(last_ts, user_id)")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS support_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL,
+        direction TEXT NOT NULL,        -- in (от пользователя) / out (ответ админа)
+        chat_id INTEGER NOT NULL,       -- откуда можно скопировать сообщение
+        message_id INTEGER NOT NULL,
+        text TEXT,
+        created_ts INTEGER NOT NULL
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS support_messages_user ON support_messages(user_id, id)")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS support_relays (
+        admin_id INTEGER NOT NULL,
+        relay_message_id INTEGER NOT NULL,   -- сообщение в ЛС админа
+        user_id INTEGER NOT NULL,            -- кому уйдёт ответ reply'ем
+        PRIMARY KEY(admin_id, relay_message_id)
+    )""")
     con.execute("""
     CREATE TABLE IF NOT EXISTS mc_punishments (
         chat_id INTEGER NOT NULL,
@@ -303,16 +1148,151 @@ def db():
         count INTEGER NOT NULL DEFAULT 0,
         PRIMARY KEY(chat_id, user_id)
     )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS known_users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        updated_ts INTEGER NOT NULL
+    )""")
+    con.execute("CREATE INDEX IF NOT EXISTS known_users_username ON known_users(username COLLATE NOCASE)")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS image_scans (
+        file_unique_id TEXT PRIMARY KEY,
+        text TEXT NOT NULL DEFAULT '',
+        created_ts INTEGER NOT NULL
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_ts INTEGER NOT NULL
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS clean_samples (
+        key TEXT PRIMARY KEY,           -- chat_id:message_id
+        text TEXT NOT NULL,
+        created_ts INTEGER NOT NULL
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS trust (
+        chat_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        clean_count INTEGER NOT NULL DEFAULT 0,
+        first_seen INTEGER NOT NULL,
+        PRIMARY KEY(chat_id, user_id)
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS update_ledger (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        key TEXT NOT NULL UNIQUE,       -- u<update_id> или m<chat_id>:<message_id>:<edit_date>
+        created_ts INTEGER NOT NULL
+    )""")
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS bot_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )""")
     con.commit()
-    return con
+
+
+def _add_column(con: sqlite3.Connection, table: str, column: str, ddl: str):
+    # простая миграция: добавляем колонку в старую базу, если её нет
+    cols = {r[1] for r in con.execute(f"PRAGMA table_info({table})").fetchall()}
+    if column not in cols:
+        con.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+# ----- отложенная запись (write-behind) -----
+class WriteBehind:
+    """
+    Копит последние параметры по ключу и пишет их в БД одной пачкой
+    (executemany + один commit) раз в WRITE_BEHIND_FLUSH_SECONDS.
+    """
+
+    def __init__(self, sql: str):
+        self.sql = sql
+        self.pending: dict = {}
+        WRITE_BEHIND_QUEUES.append(self)
+
+    def put(self, key, params: tuple):
+        self.pending[key] = params
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+        rows = list(self.pending.values())
+        self.pending.clear()
+        con = db()
+        con.executemany(self.sql, rows)
+        con.commit()
+        con.close()
+        return len(rows)
+
+WRITE_BEHIND_QUEUES: list[WriteBehind] = []
+
+def flush_write_behind():
+    for q in WRITE_BEHIND_QUEUES:
+        try:
+            q.flush()
+        except Exception:
+            logging.exception("write-behind flush failed")
+
+# периодические задачи (чистка кэшей, протухших записей и т.п.) — вызываются вместе с flush
+MAINTENANCE_HOOKS: list = []
+MAINTENANCE_HOOKS.append(domain_index_load)   # пересобранный индекс доменов подхватываем на лету
+
+async def maintenance_loop():
+    while True:
+        await asyncio.sleep(WRITE_BEHIND_FLUSH_SECONDS)
+        flush_write_behind()
+        for hook in MAINTENANCE_HOOKS:
+            try:
+                hook()
+            except Exception:
+                logging.exception("maintenance hook failed")
 
 
 # ----- чаты -----
+@dataclass(slots=True)
+class ChatMeta:
+    title: str = ""
+    permissions: ChatPermissions | None = None   # права участников по умолчанию
+    bot_member: object | None = None             # ChatMember бота (его права админа)
+    bot_member_at: float = 0.0                   # monotonic() когда узнали bot_member
+    member_count: int | None = None
+    member_count_at: float = 0.0                 # monotonic() последнего get_chat_member_count
+    fetched_at: float = 0.0                      # monotonic() последнего get_chat
+    known_chats_ts: int = 0                      # когда последний раз писали в known_chats
+    bot_member_retry_at: float = 0.0             # monotonic(): раньше не переспрашиваем после ошибки
+    rights_warn_ts: dict[str, int] = field(default_factory=dict)    # право -> когда последний раз просили в чате
+    rights_admins_notified: set[str] = field(default_factory=set)   # про какие права админам уже написали
+
+    def is_fresh(self) -> bool:
+        return self.fetched_at > 0 and time.monotonic() - self.fetched_at < CHAT_META_TTL_SECONDS
+
+CHAT_META = LRUCache(CHAT_META_CACHE_SIZE)
+
+def chat_meta(chat_id: int) -> ChatMeta:
+    meta = CHAT_META.get(chat_id)
+    if meta is None:
+        meta = ChatMeta()
+        CHAT_META.set(chat_id, meta)
+    return meta
+
 def remember_chat(chat_id: int, title: str | None):
+    # вызывается на каждом сообщении группы: в БД пишем только если название
+    # поменялось или запись давно не обновлялась
+    meta = chat_meta(chat_id)
+    now = ts()
+    if meta.title == (title or "") and now - meta.known_chats_ts < KNOWN_CHATS_TOUCH_SECONDS:
+        return
+    meta.title = title or ""
+    meta.known_chats_ts = now
     con = db()
     con.execute(
         "INSERT OR REPLACE INTO known_chats(chat_id, title, updated_ts) VALUES (?,?,?)",
-        (chat_id, title or "", ts())
+        (chat_id, title or "", now)
     )
     con.commit()
     con.close()
@@ -324,14 +1304,529 @@ def get_known_chats() -> list[tuple[int, str]]:
     return [(int(r[0]), str(r[1] or "")) for r in rows]
 
 
-# ----- разрешения -----
-def permit_get(chat_id: int, user_id: int) -> tuple[bool, int | None, int]:
+# ----- версии данных (для кэша готовых экранов) -----
+DATA_VERSIONS: dict[tuple[str, int], int] = {}
+
+def data_version(table: str, chat_id: int) -> int:
+    return DATA_VERSIONS.get((table, chat_id), 0)
+
+def bump_version(table: str, chat_id: int):
+    DATA_VERSIONS[(table, chat_id)] = DATA_VERSIONS.get((table, chat_id), 0) + 1
+
+
+# ----- username → user_id (из трафика) -----
+USERNAME_BY_ID = LRUCache(USERNAME_CACHE_SIZE)   # user_id -> username
+USER_ID_BY_NAME = LRUCache(USERNAME_CACHE_SIZE)  # username (lower) -> user_id
+_known_users_wb = WriteBehind(
+    "INSERT OR REPLACE INTO known_users(user_id, username, updated_ts) VALUES (?,?,?)"
+)
+
+def username_observe(user_id: int, username: str | None):
+    # Вызывается на каждом сообщении — в общем случае это один dict-lookup.
+    # "" в USERNAME_BY_ID — username у пользователя нет (проверено).
+    username = username or ""
+    old = USERNAME_BY_ID.get(user_id)
+    if old == username:
+        return
+    if old is None and not username:
+        # username нет, кэш пуст: один раз на пользователя смотрим в БД, не остался ли старый
+        con = db()
+        row = con.execute("SELECT username FROM known_users WHERE user_id=?", (user_id,)).fetchone()
+        con.close()
+        old = str(row[0]) if row and row[0] else ""
+        if not old:
+            USERNAME_BY_ID.set(user_id, "")
+            return
+    if old:
+        # username сменили или убрали — старый больше не должен находить этого пользователя
+        USER_ID_BY_NAME.pop(old.lower())
+    USERNAME_BY_ID.set(user_id, username)
+    if username:
+        USER_ID_BY_NAME.set(username.lower(), user_id)
+    _known_users_wb.put(user_id, (user_id, username or None, ts()))
+
+def username_lookup(username: str) -> int | None:
+    name = username.strip().lstrip("@").lower()
+    if not name:
+        return None
+    uid = USER_ID_BY_NAME.get(name)
+    if uid is not None:
+        return uid
     con = db()
     row = con.execute(
-        "SELECT until_ts, last_ad_ts FROM permits WHERE chat_id=? AND user_id=?",
-        (chat_id, user_id)
+        "SELECT user_id, username FROM known_users WHERE username=? COLLATE NOCASE ORDER BY updated_ts DESC LIMIT 1",
+        (name,)
     ).fetchone()
     con.close()
+    if not row:
+        return None
+    uid = int(row[0])
+    current = USERNAME_BY_ID.get(uid)
+    if current is not None and current.lower() != name:
+        return None   # в БД ещё старый username: новый ждёт write-behind
+    USERNAME_BY_ID.set(uid, str(row[1]))
+    USER_ID_BY_NAME.set(name, uid)
+    return uid
+
+def username_of(user_id: int) -> str | None:
+    name = USERNAME_BY_ID.get(user_id)
+    if name is not None:
+        return name or None
+    con = db()
+    row = con.execute("SELECT username FROM known_users WHERE user_id=?", (user_id,)).fetchone()
+    con.close()
+    if not row or not row[0]:
+        return None
+    name = str(row[0])
+    USERNAME_BY_ID.set(user_id, name)
+    USER_ID_BY_NAME.set(name.lower(), user_id)
+    return name
+
+
+# ----- доверие участников -----
+# (chat_id, user_id) -> first_seen << 20 | clean_count: одно int на участника вместо объекта.
+# Загружается целиком при старте, изменения пишутся пачкой через write-behind.
+TRUST: dict[tuple[int, int], int] = {}
+TRUST_COUNT_MASK = (1 << 20) - 1
+_trust_wb = WriteBehind(
+    "INSERT OR REPLACE INTO trust(chat_id, user_id, clean_count, first_seen) VALUES (?,?,?,?)"
+)
+
+def trust_load():
+    con = db()
+    rows = con.execute("SELECT chat_id, user_id, clean_count, first_seen FROM trust").fetchall()
+    con.close()
+    TRUST.clear()
+    for chat_id, user_id, clean, first_seen in rows:
+        TRUST[(int(chat_id), int(user_id))] = int(first_seen) << 20 | min(int(clean), TRUST_COUNT_MASK)
+
+def trust_is_trusted(chat_id: int, user_id: int) -> bool:
+    packed = TRUST.get((chat_id, user_id))
+    if packed is None:
+        return False
+    return (packed & TRUST_COUNT_MASK) >= TRUST_CLEAN_MESSAGES and ts() - (packed >> 20) >= TRUST_MIN_AGE_SECONDS
+
+def trust_clean(chat_id: int, user_id: int):
+    key = (chat_id, user_id)
+    packed = TRUST.get(key)
+    if packed is None:
+        first_seen, clean = ts(), 1
+    else:
+        first_seen, clean = packed >> 20, min((packed & TRUST_COUNT_MASK) + 1, TRUST_COUNT_MASK)
+    TRUST[key] = first_seen << 20 | clean
+    _trust_wb.put(key, (chat_id, user_id, clean, first_seen))
+
+def trust_reset(chat_id: int, user_id: int):
+    # любое нарушение — доверие зарабатывается заново, и по числу сообщений, и по времени
+    now = ts()
+    TRUST[(chat_id, user_id)] = now << 20
+    _trust_wb.put((chat_id, user_id), (chat_id, user_id, 0, now))
+
+
+# =========================
+# ХРАНИЛИЩЕ: разрешения, страйки, наказания
+# =========================
+# Всё, что должно быть общим у нескольких экземпляров бота (горячий резерв),
+# идёт через STORE. Логи, known_chats, поддержка и FSM остаются в локальной SQLite.
+#   STORE_URL = ""                     -> SqliteStore (файл DB_PATH, кэш в памяти)
+#   STORE_URL = "redis://host:6379/0"  -> RedisStore (нужен пакет redis)
+
+# таблица счётчика -> колонка со значением
+COUNTER_COLUMNS = {"ad_strikes": "stage", "cooldown_strikes": "count", "admin_warns": "count"}
+
+
+class Store(abc.ABC):
+    """
+    Интерфейс хранилища. Счётчики меняются через counter_incr (атомарно),
+    чтобы два экземпляра не потеряли страйк, прочитав одно и то же значение.
+    """
+
+    def warm(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def run(self, fn, *args):
+        # вызов метода хранилища из обработчика; SqliteStore отвечает из памяти — прямо в цикле
+        return fn(*args)
+
+    @abc.abstractmethod
+    def permit_get(self, chat_id: int, user_id: int) -> tuple[int | None, int] | None:
+        ...
+
+    @abc.abstractmethod
+    def permit_set(self, chat_id: int, user_id: int, until_ts: int | None):
+        ...
+
+    @abc.abstractmethod
+    def permit_remove(self, chat_id: int, user_id: int):
+        ...
+
+    @abc.abstractmethod
+    def permit_touch(self, chat_id: int, user_id: int, now: int):
+        ...
+
+    @abc.abstractmethod
+    def permits_list(self, chat_id: int) -> list[tuple[int, int | None, int]]:
+        ...
+
+    @abc.abstractmethod
+    def counter_get(self, table: str, chat_id: int, user_id: int) -> int:
+        ...
+
+    @abc.abstractmethod
+    def counter_set(self, table: str, chat_id: int, user_id: int, value: int):
+        ...
+
+    @abc.abstractmethod
+    def counter_incr(self, table: str, chat_id: int, user_id: int, by: int = 1) -> int:
+        ...
+
+    @abc.abstractmethod
+    def mc_upsert(self, row: tuple):
+        # row = (chat_id, user_id, username, kind, until_ts, reason, issued_ts, issued_by, active)
+        ...
+
+    @abc.abstractmethod
+    def mc_list(self, chat_id: int, offset: int, limit: int) -> tuple[list[tuple], int]:
+        ...
+
+    @abc.abstractmethod
+    def mc_find(self, chat_id: int, since_ts: int) -> list[tuple]:
+        # (user_id, username, kind, until_ts, reason, issued_ts, active, issued_by), выданные не раньше since_ts
+        ...
+
+    @contextmanager
+    def transaction(self):
+        # пачка записей (set/remove/upsert) одной транзакцией; чтения внутри видят старые данные
+        yield
+
+
+class SqliteStore(Store):
+    """
+    Локальный файл DB_PATH. Разрешения и счётчики небольшие: warm() читает их
+    целиком одним запросом, дальше чтения из памяти, запись — сквозь кэш.
+    Только для одного экземпляра: чужие записи в файл кэш не увидит.
+    """
+
+    def __init__(self):
+        self._con: sqlite3.Connection | None = None
+        self._con_path = ""
+        self.permits: dict[tuple[int, int], tuple[int | None, int]] = {}   # (chat, user) -> (until_ts, last_ad_ts)
+        self.counters: dict[str, dict[tuple[int, int], int]] = {t: {} for t in COUNTER_COLUMNS}
+        self.warm_done = False   # до warm() читаем из БД
+        self.in_tx = False
+
+    def _db(self) -> sqlite3.Connection:
+        # одно соединение на процесс вместо connect/close на каждый вызов
+        if self._con is None or self._con_path != DB_PATH:
+            self.close()
+            self._con = db()
+            self._con_path = DB_PATH
+        return self._con
+
+    def _commit(self):
+        if not self.in_tx:
+            self._db().commit()
+
+    @contextmanager
+    def transaction(self):
+        self.in_tx = True
+        try:
+            yield
+            self._db().commit()
+        except BaseException:
+            self._db().rollback()
+            if self.warm_done:
+                self.warm()   # кэш уже поменяли — перечитываем с диска
+            raise
+        finally:
+            self.in_tx = False
+
+    def close(self):
+        if self._con is not None:
+            self._con.close()
+            self._con = None
+
+    def warm(self):
+        rows = self._db().execute("""
+            SELECT 'permits', chat_id, user_id, until_ts, last_ad_ts FROM permits
+            UNION ALL SELECT 'ad_strikes', chat_id, user_id, stage, 0 FROM ad_strikes WHERE stage != 0
+            UNION ALL SELECT 'cooldown_strikes', chat_id, user_id, count, 0 FROM cooldown_strikes WHERE count != 0
+            UNION ALL SELECT 'admin_warns', chat_id, user_id, count, 0 FROM admin_warns WHERE count != 0
+        """).fetchall()
+        self.permits.clear()
+        for c in self.counters.values():
+            c.clear()
+        for table, chat_id, user_id, a, b in rows:
+            key = (int(chat_id), int(user_id))
+            if table == "permits":
+                self.permits[key] = (int(a) if a is not None else None, int(b or 0))
+            else:
+                self.counters[table][key] = int(a)
+        self.warm_done = True
+        logging.info("store warmed: %d permits, %s", len(self.permits),
+                     ", ".join(f"{len(c)} {t}" for t, c in self.counters.items()))
+
+    def permit_get(self, chat_id, user_id):
+        if self.warm_done:
+            return self.permits.get((chat_id, user_id))
+        row = self._db().execute(
+            "SELECT until_ts, last_ad_ts FROM permits WHERE chat_id=? AND user_id=?",
+            (chat_id, user_id)
+        ).fetchone()
+        return (row[0], int(row[1] or 0)) if row else None
+
+    def permit_set(self, chat_id, user_id, until_ts):
+        con = self._db()
+        con.execute(
+            """
+            INSERT OR REPLACE INTO permits(chat_id, user_id, until_ts, last_ad_ts)
+            VALUES (?,?,?, COALESCE((SELECT last_ad_ts FROM permits WHERE chat_id=? AND user_id=?), 0))
+            """,
+            (chat_id, user_id, until_ts, chat_id, user_id)
+        )
+        self._commit()
+        prev = self.permits.get((chat_id, user_id))
+        self.permits[(chat_id, user_id)] = (until_ts, prev[1] if prev else 0)
+
+    def permit_remove(self, chat_id, user_id):
+        con = self._db()
+        con.execute("DELETE FROM permits WHERE chat_id=? AND user_id=?", (chat_id, user_id))
+        self._commit()
+        self.permits.pop((chat_id, user_id), None)
+
+    def permit_touch(self, chat_id, user_id, now):
+        con = self._db()
+        con.execute("UPDATE permits SET last_ad_ts=? WHERE chat_id=? AND user_id=?", (now, chat_id, user_id))
+        self._commit()
+        prev = self.permits.get((chat_id, user_id))
+        if prev:
+            self.permits[(chat_id, user_id)] = (prev[0], now)
+
+    def permits_list(self, chat_id):
+        rows = self._db().execute(
+            "SELECT user_id, until_ts, last_ad_ts FROM permits WHERE chat_id=?", (chat_id,)
+        ).fetchall()
+        return [(int(r[0]), (int(r[1]) if r[1] is not None else None), int(r[2] or 0)) for r in rows]
+
+    def counter_get(self, table, chat_id, user_id):
+        if self.warm_done:
+            return self.counters[table].get((chat_id, user_id), 0)
+        col = COUNTER_COLUMNS[table]
+        row = self._db().execute(
+            f"SELECT {col} FROM {table} WHERE chat_id=? AND user_id=?", (chat_id, user_id)
+        ).fetchone()
+        return int(row[0]) if row else 0
+
+    def counter_set(self, table, chat_id, user_id, value):
+        col = COUNTER_COLUMNS[table]
+        con = self._db()
+        con.execute(f"INSERT OR REPLACE INTO {table}(chat_id, user_id, {col}) VALUES (?,?,?)", (chat_id, user_id, value))
+        self._commit()
+        self.counters[table][(chat_id, user_id)] = value
+
+    def counter_incr(self, table, chat_id, user_id, by=1):
+        col = COUNTER_COLUMNS[table]
+        con = self._db()
+        value = con.execute(
+            f"""
+            INSERT INTO {table}(chat_id, user_id, {col}) VALUES (?,?,?)
+            ON CONFLICT(chat_id, user_id) DO UPDATE SET {col} = {col} + excluded.{col}
+            RETURNING {col}
+            """,
+            (chat_id, user_id, by)
+        ).fetchone()[0]
+        self._commit()
+        self.counters[table][(chat_id, user_id)] = int(value)
+        return int(value)
+
+    def mc_upsert(self, row):
+        con = self._db()
+        con.execute(
+            """
+            INSERT OR REPLACE INTO mc_punishments(chat_id,user_id,username,kind,until_ts,reason,issued_ts,issued_by,active)
+            VALUES (?,?,?,?,?,?,?,?,?)
+            """,
+            row
+        )
+        self._commit()
+
+    def mc_list(self, chat_id, offset, limit):
+        con = self._db()
+        total = con.execute("SELECT COUNT(*) FROM mc_punishments WHERE chat_id=?", (chat_id,)).fetchone()[0]
+        rows = con.execute(
+            """
+            SELECT user_id, username, kind, until_ts, reason, issued_ts, active
+            FROM mc_punishments
+            WHERE chat_id=?
+            ORDER BY issued_ts DESC
+            LIMIT ? OFFSET ?
+            """,
+            (chat_id, limit, offset)
+        ).fetchall()
+        return rows, int(total)
+
+    def mc_find(self, chat_id, since_ts):
+        return self._db().execute(
+            """
+            SELECT user_id, username, kind, until_ts, reason, issued_ts, active, issued_by
+            FROM mc_punishments
+            WHERE chat_id=? AND issued_ts>=?
+            """,
+            (chat_id, since_ts)
+        ).fetchall()
+
+
+class RedisStore(Store):
+    """
+    Общее хранилище для нескольких экземпляров (Redis или совместимый сервер). Ключи:
+      mc:permit_until:{chat}  hash user -> until_ts ("" = бессрочно)
+      mc:permit_last:{chat}   hash user -> last_ad_ts
+      mc:{table}:{chat}       hash user -> счётчик (HINCRBY — атомарно)
+      mc:pun:{chat}           hash "user:kind" -> JSON строки для /mclist
+      mc:pun_idx:{chat}       zset "user:kind" по issued_ts
+    Локального кэша нет (данные может поменять другой экземпляр); чтения, которые
+    нужны на каждое сообщение, уходят одним pipeline. Клиент синхронный, поэтому
+    обработчики зовут его через run() в своём пуле потоков: медленный Redis (до
+    STORE_TIMEOUT_SECONDS) не останавливает цикл событий.
+    """
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("STORE_URL=redis://... требует пакет redis (pip install redis)") from e
+        self.pool = redis.ConnectionPool.from_url(
+            # RESP2: работает и со старыми серверами (до Redis 6 нет HELLO), и с совместимыми
+            url, max_connections=STORE_POOL_SIZE, decode_responses=True, protocol=2,
+            socket_timeout=STORE_TIMEOUT_SECONDS, socket_connect_timeout=STORE_TIMEOUT_SECONDS,
+        )
+        self.r = redis.Redis(connection_pool=self.pool)
+        self.executor = ThreadPoolExecutor(STORE_POOL_SIZE, thread_name_prefix="store")
+        self.local = threading.local()   # .tx — pipeline (MULTI/EXEC) внутри transaction() своего потока
+
+    @property
+    def tx(self):
+        return getattr(self.local, "tx", None)
+
+    async def run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    @contextmanager
+    def transaction(self):
+        self.local.tx = self.r.pipeline()
+        try:
+            yield
+            self.local.tx.execute()
+        finally:
+            self.local.tx.reset()
+            self.local.tx = None
+
+    def _pipe(self):
+        return self.tx if self.tx is not None else self.r.pipeline()
+
+    def _run(self, pipe):
+        if pipe is not self.tx:
+            pipe.execute()
+
+    def warm(self):
+        # проверяем связь сразу при старте, а не на первом сообщении
+        self.r.ping()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.pool.disconnect()
+
+    def permit_get(self, chat_id, user_id):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hget(f"mc:permit_until:{chat_id}", user_id)
+        pipe.hget(f"mc:permit_last:{chat_id}", user_id)
+        until, last = pipe.execute()
+        if until is None:
+            return None
+        return (int(until) if until else None), int(last or 0)
+
+    def permit_set(self, chat_id, user_id, until_ts):
+        pipe = self._pipe()
+        pipe.hset(f"mc:permit_until:{chat_id}", user_id, "" if until_ts is None else until_ts)
+        pipe.hsetnx(f"mc:permit_last:{chat_id}", user_id, 0)
+        self._run(pipe)
+
+    def permit_remove(self, chat_id, user_id):
+        pipe = self._pipe()
+        pipe.hdel(f"mc:permit_until:{chat_id}", user_id)
+        pipe.hdel(f"mc:permit_last:{chat_id}", user_id)
+        self._run(pipe)
+
+    def permit_touch(self, chat_id, user_id, now):
+        # WATCH: если разрешение сняли между HEXISTS и HSET, EXEC не пройдёт и проверка повторится
+        key = f"mc:permit_until:{chat_id}"
+
+        def touch(pipe):
+            if pipe.hexists(key, user_id):
+                pipe.multi()
+                pipe.hset(f"mc:permit_last:{chat_id}", user_id, now)
+
+        self.r.transaction(touch, key)
+
+    def permits_list(self, chat_id):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.hgetall(f"mc:permit_until:{chat_id}")
+        pipe.hgetall(f"mc:permit_last:{chat_id}")
+        until, last = pipe.execute()
+        return [(int(uid), (int(u) if u else None), int(last.get(uid) or 0)) for uid, u in until.items()]
+
+    def counter_get(self, table, chat_id, user_id):
+        return int(self.r.hget(f"mc:{table}:{chat_id}", user_id) or 0)
+
+    def counter_set(self, table, chat_id, user_id, value):
+        (self.tx if self.tx is not None else self.r).hset(f"mc:{table}:{chat_id}", user_id, value)
+
+    def counter_incr(self, table, chat_id, user_id, by=1):
+        return int(self.r.hincrby(f"mc:{table}:{chat_id}", user_id, by))
+
+    def mc_upsert(self, row):
+        chat_id, user_id, username, kind, until_ts, reason, issued_ts, issued_by, active = row
+        member = f"{user_id}:{kind}"
+        pipe = self._pipe()
+        pipe.hset(f"mc:pun:{chat_id}", member,
+                  json.dumps([user_id, username, kind, until_ts, reason, issued_ts, active, issued_by], ensure_ascii=False))
+        pipe.zadd(f"mc:pun_idx:{chat_id}", {member: issued_ts})
+        self._run(pipe)
+
+    def mc_list(self, chat_id, offset, limit):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.zcard(f"mc:pun_idx:{chat_id}")
+        pipe.zrevrange(f"mc:pun_idx:{chat_id}", offset, offset + limit - 1)
+        total, members = pipe.execute()
+        if not members:
+            return [], int(total)
+        raw = self.r.hmget(f"mc:pun:{chat_id}", members)
+        return [tuple(json.loads(r)[:7]) for r in raw if r], int(total)
+
+    def mc_find(self, chat_id, since_ts):
+        members = self.r.zrangebyscore(f"mc:pun_idx:{chat_id}", since_ts, "+inf")
+        if not members:
+            return []
+        raw = self.r.hmget(f"mc:pun:{chat_id}", members)
+        return [tuple(json.loads(r)) for r in raw if r]
+
+
+def make_store(url: str) -> Store:
+    if not url or url.startswith("sqlite"):
+        return SqliteStore()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore(url)
+    raise ValueError(f"Неизвестный STORE_URL: {url}")
+
+STORE = make_store(STORE_URL)
+
+
+# ----- разрешения -----
+async def permit_get(chat_id: int, user_id: int) -> tuple[bool, int | None, int]:
+    row = await STORE.run(STORE.permit_get, chat_id, user_id)
     if not row:
         return False, None, 0
     until_ts, last_ad_ts = row
@@ -339,79 +1834,50 @@ def permit_get(chat_id: int, user_id: int) -> tuple[bool, int | None, int]:
         return False, int(until_ts), int(last_ad_ts or 0)
     return True, (int(until_ts) if until_ts is not None else None), int(last_ad_ts or 0)
 
-def permit_set(chat_id: int, user_id: int, until_ts: int | None):
-    con = db()
-    con.execute(
-        """
-        INSERT OR REPLACE INTO permits(chat_id, user_id, until_ts, last_ad_ts)
-        VALUES (?,?,?, COALESCE((SELECT last_ad_ts FROM permits WHERE chat_id=? AND user_id=?), 0))
-        """,
-        (chat_id, user_id, until_ts, chat_id, user_id)
-    )
-    con.commit()
-    con.close()
+async def permit_set(chat_id: int, user_id: int, until_ts: int | None):
+    await STORE.run(STORE.permit_set, chat_id, user_id, until_ts)
+    bump_version("permits", chat_id)
 
-def permit_remove(chat_id: int, user_id: int):
-    con = db()
-    con.execute("DELETE FROM permits WHERE chat_id=? AND user_id=?", (chat_id, user_id))
-    con.commit()
-    con.close()
+async def permit_remove(chat_id: int, user_id: int):
+    await STORE.run(STORE.permit_remove, chat_id, user_id)
+    bump_version("permits", chat_id)
 
-def permit_touch_last_ad(chat_id: int, user_id: int):
-    con = db()
-    con.execute("UPDATE permits SET last_ad_ts=? WHERE chat_id=? AND user_id=?", (ts(), chat_id, user_id))
-    con.commit()
-    con.close()
+async def permit_touch_last_ad(chat_id: int, user_id: int):
+    await STORE.run(STORE.permit_touch, chat_id, user_id, ts())
+    bump_version("permits", chat_id)
 
-def permits_list_active(chat_id: int) -> list[tuple[int, int | None, int]]:
+async def permits_list_active(chat_id: int) -> list[tuple[int, int | None, int]]:
     now = ts()
-    con = db()
-    rows = con.execute(
-        """
-        SELECT user_id, until_ts, last_ad_ts
-        FROM permits
-        WHERE chat_id=?
-          AND (until_ts IS NULL OR until_ts > ?)
-        ORDER BY last_ad_ts DESC
-        """,
-        (chat_id, now)
-    ).fetchall()
-    con.close()
-    out = []
-    for r in rows:
-        out.append((int(r[0]), (int(r[1]) if r[1] is not None else None), int(r[2] or 0)))
-    return out
+    rows = [r for r in await STORE.run(STORE.permits_list, chat_id) if r[1] is None or r[1] > now]
+    rows.sort(key=lambda r: r[2], reverse=True)
+    return rows
 
 
 # ----- стадии рекламы (без разрешения) -----
-def ad_stage_get(chat_id: int, user_id: int) -> int:
-    con = db()
-    row = con.execute("SELECT stage FROM ad_strikes WHERE chat_id=? AND user_id=?", (chat_id, user_id)).fetchone()
-    con.close()
-    return int(row[0]) if row else 0
+async def ad_stage_get(chat_id: int, user_id: int) -> int:
+    return await STORE.run(STORE.counter_get, "ad_strikes", chat_id, user_id)
 
-def ad_stage_set(chat_id: int, user_id: int, stage: int):
-    con = db()
-    con.execute("INSERT OR REPLACE INTO ad_strikes(chat_id, user_id, stage) VALUES (?,?,?)", (chat_id, user_id, stage))
-    con.commit()
-    con.close()
+async def ad_stage_set(chat_id: int, user_id: int, stage: int):
+    await STORE.run(STORE.counter_set, "ad_strikes", chat_id, user_id, stage)
+
+async def ad_stage_incr(chat_id: int, user_id: int, by: int = 1) -> int:
+    return await STORE.run(STORE.counter_incr, "ad_strikes", chat_id, user_id, by)
 
 
 # ----- cooldown предупреждения (если разрешение есть, но раньше 24ч) -----
-def cooldown_warn_get(chat_id: int, user_id: int) -> int:
-    con = db()
-    row = con.execute("SELECT count FROM cooldown_strikes WHERE chat_id=? AND user_id=?", (chat_id, user_id)).fetchone()
-    con.close()
-    return int(row[0]) if row else 0
+async def cooldown_warn_get(chat_id: int, user_id: int) -> int:
+    return await STORE.run(STORE.counter_get, "cooldown_strikes", chat_id, user_id)
 
-def cooldown_warn_set(chat_id: int, user_id: int, count: int):
-    con = db()
-    con.execute("INSERT OR REPLACE INTO cooldown_strikes(chat_id, user_id, count) VALUES (?,?,?)", (chat_id, user_id, count))
-    con.commit()
-    con.close()
+async def cooldown_warn_set(chat_id: int, user_id: int, count: int):
+    await STORE.run(STORE.counter_set, "cooldown_strikes", chat_id, user_id, count)
+
+async def cooldown_warn_incr(chat_id: int, user_id: int) -> int:
+    return await STORE.run(STORE.counter_incr, "cooldown_strikes", chat_id, user_id)
 
-def cooldown_warn_reset(chat_id: int, user_id: int):
-    cooldown_warn_set(chat_id, user_id, 0)
+async def cooldown_warn_reset(chat_id: int, user_id: int):
+    if not await cooldown_warn_get(chat_id, user_id):
+        return   # и так ноль — не пишем на каждом сообщении с разрешением
+    await cooldown_warn_set(chat_id, user_id, 0)
 
 
 # ----- логи рекламы -----
@@ -425,70 +1891,212 @@ def log_deleted_ad(chat_id: int, chat_title: str, user_id: int, username: str |
     )
     con.commit()
     con.close()
+    trust_reset(chat_id, user_id)
 
 
-# ----- support -----
-def support_touch_user(uid: int):
+# ----- support (инбокс) -----
+def support_log_in(uid: int, username: str | None, chat_id: int, message_id: int, text: str | None):
+    now = ts()
     con = db()
-    con.execute("INSERT OR REPLACE INTO support_threads(user_id, last_ts) VALUES (?,?)", (uid, ts()))
+    con.execute(
+        "INSERT INTO support_messages(user_id, direction, chat_id, message_id, text, created_ts) VALUES (?,?,?,?,?,?)",
+        (uid, "in", chat_id, message_id, text or "", now)
+    )
+    con.execute(
+        """
+        INSERT INTO support_threads(user_id, last_ts, unread, username) VALUES (?,?,1,?)
+        ON CONFLICT(user_id) DO UPDATE SET last_ts=excluded.last_ts, unread=unread+1,
+            username=COALESCE(excluded.username, username)
+        """,
+        (uid, now, username)
+    )
     con.commit()
     con.close()
 
-def support_users_list() -> list[int]:
-    con = db()
-    rows = con.execute("SELECT user_id FROM support_threads ORDER BY last_ts DESC").fetchall()
-    con.close()
-    return [int(r[0]) for r in rows]
-
-
-# ----- наказания (для /mclist) -----
-def mc_upsert(chat_id: int, user_id: int, username: str | None, kind: str, until_ts: int | None, reason: str, issued_by: int, active: int):
+def support_log_out(uid: int, chat_id: int, message_id: int, text: str | None):
     con = db()
     con.execute(
-        """
-        INSERT OR REPLACE INTO mc_punishments(chat_id,user_id,username,kind,until_ts,reason,issued_ts,issued_by,active)
-        VALUES (?,?,?,?,?,?,?,?,?)
-        """,
-        (chat_id, user_id, username or "", kind, until_ts, reason, ts(), issued_by, active)
+        "INSERT INTO support_messages(user_id, direction, chat_id, message_id, text, created_ts) VALUES (?,?,?,?,?,?)",
+        (uid, "out", chat_id, message_id, text or "", ts())
     )
+    con.execute("UPDATE support_threads SET unread=0 WHERE user_id=?", (uid,))
     con.commit()
     con.close()
 
-def mc_list(chat_id: int, page: int) -> tuple[list[tuple], int]:
+def support_mark_read(uid: int):
     con = db()
-    total = con.execute("SELECT COUNT(*) FROM mc_punishments WHERE chat_id=?", (chat_id,)).fetchone()[0]
-    offset = (page - 1) * MC_LIST_PAGE_SIZE
-    rows = con.execute(
-        """
-        SELECT user_id, username, kind, until_ts, reason, issued_ts, active
-        FROM mc_punishments
-        WHERE chat_id=?
-        ORDER BY issued_ts DESC
-        LIMIT ? OFFSET ?
-        """,
-        (chat_id, MC_LIST_PAGE_SIZE, offset)
-    ).fetchall()
+    con.execute("UPDATE support_threads SET unread=0 WHERE user_id=?", (uid,))
+    con.commit()
     con.close()
-    return rows, int(total)
 
+def support_threads_page(cursor: tuple[int, int] | None) -> tuple[list[tuple[int, int, int, str]], tuple[int, int] | None]:
+    # keyset-пагинация: (last_ts, user_id) последней строки — курсор следующей страницы
+    con = db()
+    if cursor is None:
+        rows = con.execute(
+            "SELECT user_id, last_ts, unread, username FROM support_threads "
+            "ORDER BY last_ts DESC, user_id DESC LIMIT ?",
+            (SUPPORT_PAGE_SIZE + 1,)
+        ).fetchall()
+    else:
+        rows = con.execute(
+            "SELECT user_id, last_ts, unread, username FROM support_threads "
+            "WHERE (last_ts, user_id) < (?, ?) ORDER BY last_ts DESC, user_id DESC LIMIT ?",
+            (cursor[0], cursor[1], SUPPORT_PAGE_SIZE + 1)
+        ).fetchall()
+    con.close()
+    out = [(int(r[0]), int(r[1]), int(r[2] or 0), str(r[3] or "")) for r in rows[:SUPPORT_PAGE_SIZE]]
+    next_cursor = (out[-1][1], out[-1][0]) if len(rows) > SUPPORT_PAGE_SIZE else None
+    return out, next_cursor
 
-# ----- админ-варны (счётчик) -----
-def admin_warn_get(chat_id: int, user_id: int) -> int:
+def support_thread_messages(uid: int, limit: int = SUPPORT_THREAD_PREVIEW) -> list[tuple[str, str, int]]:
     con = db()
-    row = con.execute("SELECT count FROM admin_warns WHERE chat_id=? AND user_id=?", (chat_id, user_id)).fetchone()
+    rows = con.execute(
+        "SELECT direction, text, created_ts FROM support_messages WHERE user_id=? ORDER BY id DESC LIMIT ?",
+        (uid, limit)
+    ).fetchall()
     con.close()
-    return int(row[0]) if row else 0
+    return [(str(r[0]), str(r[1] or ""), int(r[2])) for r in reversed(rows)]
 
-def admin_warn_set(chat_id: int, user_id: int, count: int):
+def support_relay_add(admin_id: int, relay_message_id: int, uid: int):
     con = db()
-    con.execute("INSERT OR REPLACE INTO admin_warns(chat_id, user_id, count) VALUES (?,?,?)", (chat_id, user_id, count))
+    con.execute(
+        "INSERT OR REPLACE INTO support_relays(admin_id, relay_message_id, user_id) VALUES (?,?,?)",
+        (admin_id, relay_message_id, uid)
+    )
     con.commit()
     con.close()
 
+def support_relay_user(admin_id: int, relay_message_id: int) -> int | None:
+    con = db()
+    row = con.execute(
+        "SELECT user_id FROM support_relays WHERE admin_id=? AND relay_message_id=?",
+        (admin_id, relay_message_id)
+    ).fetchone()
+    con.close()
+    return int(row[0]) if row else None
+
+
+# ----- наказания (для /mclist) -----
+async def mc_upsert(chat_id: int, user_id: int, username: str | None, kind: str, until_ts: int | None, reason: str, issued_by: int, active: int):
+    await STORE.run(STORE.mc_upsert, (chat_id, user_id, username or "", kind, until_ts, reason, ts(), issued_by, active))
+    bump_version("mc_punishments", chat_id)
+
+async def mc_list(chat_id: int, page: int) -> tuple[list[tuple], int]:
+    return await STORE.run(STORE.mc_list, chat_id, (page - 1) * MC_LIST_PAGE_SIZE, MC_LIST_PAGE_SIZE)
+
+async def mc_find_active(chat_id: int, kind: str, since_ts: int = 0, issued_by: int | None = None) -> list[int]:
+    # кто сейчас под наказанием kind; issued_by=0 — выданные ботом автоматически
+    now = ts()
+    return [
+        int(r[0]) for r in await STORE.run(STORE.mc_find, chat_id, since_ts)
+        if r[2] == kind and r[6] and (r[3] is None or r[3] > now) and (issued_by is None or r[7] == issued_by)
+    ]
+
+
+# ----- админ-варны (счётчик) -----
+async def admin_warn_get(chat_id: int, user_id: int) -> int:
+    return await STORE.run(STORE.counter_get, "admin_warns", chat_id, user_id)
+
+async def admin_warn_set(chat_id: int, user_id: int, count: int):
+    await STORE.run(STORE.counter_set, "admin_warns", chat_id, user_id, count)
 
 # =========================
 # FSM (ЛС)
 # =========================
+class SqliteStorage(BaseStorage):
+    """
+    FSM-хранилище: SQLite + LRU в памяти.
+    Ключи всех сохранённых состояний держим в памяти, поэтому get_state для
+    пользователя без диалога (т.е. почти всегда) не ходит на диск.
+    Состояние, которое не меняли FSM_STATE_TTL_SECONDS, считается брошенным.
+    """
+
+    def __init__(self):
+        self.cache = LRUCache(FSM_CACHE_SIZE)   # key -> [state, data, updated_ts]
+        self.persisted: set[str] | None = None  # ключи, у которых есть строка в БД
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.business_connection_id or ''}:{key.destiny}"
+
+    def _keys(self) -> set[str]:
+        if self.persisted is None:
+            con = db()
+            rows = con.execute("SELECT key FROM fsm_states WHERE updated_ts>=?", (ts() - FSM_STATE_TTL_SECONDS,)).fetchall()
+            con.close()
+            self.persisted = {r[0] for r in rows}
+        return self.persisted
+
+    def _load(self, k: str) -> list:
+        rec = self.cache.get(k)
+        if rec is None:
+            rec = [None, {}, 0]
+            if k in self._keys():
+                con = db()
+                row = con.execute("SELECT state, data, updated_ts FROM fsm_states WHERE key=?", (k,)).fetchone()
+                con.close()
+                if row:
+                    rec = [row[0], json.loads(row[1] or "{}"), int(row[2])]
+            self.cache.set(k, rec)
+        if rec[2] and ts() - rec[2] > FSM_STATE_TTL_SECONDS:
+            rec = [None, {}, 0]
+            self._save(k, rec)
+        return rec
+
+    def _save(self, k: str, rec: list):
+        self.cache.set(k, rec)
+        con = db()
+        if rec[0] is None and not rec[1]:
+            if k in self._keys():
+                con.execute("DELETE FROM fsm_states WHERE key=?", (k,))
+                self.persisted.discard(k)
+        else:
+            con.execute(
+                "INSERT OR REPLACE INTO fsm_states(key, state, data, updated_ts) VALUES (?,?,?,?)",
+                (k, rec[0], json.dumps(rec[1], ensure_ascii=False), rec[2])
+            )
+            self._keys().add(k)
+        con.commit()
+        con.close()
+
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        k = self._key(key)
+        rec = self._load(k)
+        new_state = state.state if isinstance(state, State) else state
+        self._save(k, [new_state, rec[1], ts()])
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return self._load(self._key(key))[0]
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        k = self._key(key)
+        rec = self._load(k)
+        self._save(k, [rec[0], dict(data), ts()])
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict(self._load(self._key(key))[1])
+
+    async def close(self) -> None:
+        pass
+
+    def sweep(self):
+        # удаляем брошенные диалоги из БД и памяти
+        cutoff = ts() - FSM_STATE_TTL_SECONDS
+        con = db()
+        rows = con.execute("SELECT key FROM fsm_states WHERE updated_ts<?", (cutoff,)).fetchall()
+        if rows:
+            con.execute("DELETE FROM fsm_states WHERE updated_ts<?", (cutoff,))
+            con.commit()
+        con.close()
+        for (k,) in rows:
+            self.cache.pop(k)
+            self._keys().discard(k)
+
+FSM_STORAGE = SqliteStorage()
+MAINTENANCE_HOOKS.append(FSM_STORAGE.sweep)
+
+
 class AdminStates(StatesGroup):
     waiting_permit_give = State()
     waiting_permit_remove = State()
@@ -496,6 +2104,7 @@ class AdminStates(StatesGroup):
     waiting_broadcast_message = State()
     waiting_support_reply_pick = State()
     waiting_support_reply_text = State()
+    waiting_bulk_targets = State()
 
 
 # =========================
@@ -510,8 +2119,10 @@ def kb_main(is_admin_flag: bool) -> InlineKeyboardMarkup:
         rows += [
             [InlineKeyboardButton(text="✅ Разрешения (выдать/забрать)", callback_data="perm_menu")],
             [InlineKeyboardButton(text="📋 Список разрешений", callback_data="perm_list_pick_chat")],
+            [InlineKeyboardButton(text="📦 Массовые действия", callback_data="bulk_menu")],
             [InlineKeyboardButton(text="📣 Рассылка", callback_data="bc_menu")],
             [InlineKeyboardButton(text="💬 Сообщения", callback_data="support_admin")],
+            [InlineKeyboardButton(text="🛠 Диагностика", callback_data="diag")],
         ]
     rows += [
         [InlineKeyboardButton(text="☎️ Связь с админом", callback_data="support_user")],
@@ -539,10 +2150,19 @@ def kb_bc_chats(chats: list[tuple[int, str]]) -> InlineKeyboardMarkup:
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
-def kb_support_admin_users(users: list[int]) -> InlineKeyboardMarkup:
+def kb_support_threads(threads: list[tuple[int, int, int, str]], next_cursor: tuple[int, int] | None, first_page: bool) -> InlineKeyboardMarkup:
     rows = []
-    for uid in users[:25]:
-        rows.append([InlineKeyboardButton(text=f"👤 {uid}", callback_data=f"sup_user:{uid}")])
+    for uid, _last_ts, unread, username in threads:
+        label = f"@{username}" if username else str(uid)
+        badge = f" • {unread} нов." if unread else ""
+        rows.append([InlineKeyboardButton(text=f"👤 {label}{badge}", callback_data=f"sup_user:{uid}")])
+    nav = []
+    if not first_page:
+        nav.append(InlineKeyboardButton(text="⏮ В начало", callback_data="support_admin"))
+    if next_cursor:
+        nav.append(InlineKeyboardButton(text="➡️ Дальше", callback_data=f"sup_page:{next_cursor[0]}:{next_cursor[1]}"))
+    if nav:
+        rows.append(nav)
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
@@ -564,6 +2184,57 @@ def kb_perm_list_pick_chat(chats: list[tuple[int, str]]) -> InlineKeyboardMarkup
     rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu")])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
+def kb_diag() -> InlineKeyboardMarkup:
+    onoff = lambda flag: "✅" if flag else "▫️"
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{onoff(DIAG['trace'])} Трассировка (JSON-логи)", callback_data="diag_toggle:trace")],
+        [InlineKeyboardButton(text=f"{onoff(DIAG['profile'])} Профайлер медленных апдейтов", callback_data="diag_toggle:profile")],
+        [InlineKeyboardButton(text="📄 Последний профиль", callback_data="diag_last")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="menu")],
+    ])
+
+def kb_bulk_actions() -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text=title, callback_data=f"bulk_act:{action}")]
+            for action, (title, _kind) in BULK_ACTIONS.items()]
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def kb_bulk_chats(chats: list[tuple[int, str]]) -> InlineKeyboardMarkup:
+    rows = [[InlineKeyboardButton(text="🌐 Все чаты", callback_data="bulk_chat:0")]]
+    for cid, title in chats[:25]:
+        label = title if title else str(cid)
+        rows.append([InlineKeyboardButton(text=f"🗂 {label[:40]}", callback_data=f"bulk_chat:{cid}")])
+    rows.append([InlineKeyboardButton(text="⬅️ Назад", callback_data="bulk_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+def kb_bulk_filters() -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"🤖 Авто за последние {fmt_duration_left(BULK_AUTO_WINDOW_SECONDS)}",
+                              callback_data="bulk_filter:auto")],
+        [InlineKeyboardButton(text="📋 Все активные (как в /mclist)", callback_data="bulk_filter:active")],
+        [InlineKeyboardButton(text="☑️ Выбрать из /mclist", callback_data="bulk_filter:pick")],
+        [InlineKeyboardButton(text="⬅️ Назад", callback_data="bulk_menu")],
+        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")],
+    ])
+
+def kb_bulk_pick(labels: list[str], selected: set[int], page: int) -> InlineKeyboardMarkup:
+    max_page = max(1, (len(labels) + BULK_PICK_PAGE_SIZE - 1) // BULK_PICK_PAGE_SIZE)
+    start = (page - 1) * BULK_PICK_PAGE_SIZE
+    rows = [
+        [InlineKeyboardButton(text=f"{'✅' if i in selected else '▫️'} {labels[i][:40]}", callback_data=f"bulk_pick:{i}:{page}")]
+        for i in range(start, min(start + BULK_PICK_PAGE_SIZE, len(labels)))
+    ]
+    nav = []
+    if page > 1:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"bulk_pick_page:{page-1}"))
+    if page < max_page:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"bulk_pick_page:{page+1}"))
+    if nav:
+        rows.append(nav)
+    rows.append([InlineKeyboardButton(text=f"▶️ Выполнить ({len(selected)})", callback_data="bulk_pick_go")])
+    rows.append([InlineKeyboardButton(text="❌ Отмена", callback_data="cancel")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
 def kb_regrant(chat_id: int, user_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -576,8 +2247,530 @@ def kb_regrant(chat_id: int, user_id: int) -> InlineKeyboardMarkup:
 # =========================
 # БОТ
 # =========================
-bot = Bot(TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
+class TunedAiohttpSession(AiohttpSession):
+    """
+    Сессия aiogram с настройками из НАСТРОЙКИ: размер пула, keep-alive, кэш DNS
+    и таймауты по методам (явный request_timeout, как у getUpdates, главнее).
+    """
+
+    def __init__(self, api_url: str = ""):
+        api = TelegramAPIServer.from_base(api_url, is_local=BOT_API_LOCAL_FILES) if api_url else PRODUCTION
+        super().__init__(api=api, limit=HTTP_POOL_SIZE, timeout=HTTP_TIMEOUT_SECONDS)
+        self._connector_init.update(
+            limit_per_host=HTTP_POOL_SIZE,
+            keepalive_timeout=HTTP_KEEPALIVE_SECONDS,
+            use_dns_cache=True,
+            ttl_dns_cache=HTTP_DNS_CACHE_SECONDS,
+        )
+
+    async def make_request(self, bot: Bot, method, timeout: int | None = None):
+        if timeout is None:
+            timeout = HTTP_METHOD_TIMEOUTS.get(method.__api_method__)
+        return await super().make_request(bot, method, timeout)
+
+bot = Bot(TOKEN, session=TunedAiohttpSession(BOT_API_URL), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+dp = Dispatcher(storage=FSM_STORAGE)
+
+
+# =========================
+# АНТИ-ФЛУД В ЛС
+# =========================
+class TokenBucket:
+    """
+    Token bucket на ключ. Состояние — кортеж (токены, monotonic последнего обращения),
+    полные (давно неактивные) ведра периодически выкидываются.
+    """
+
+    def __init__(self, rate_per_second: float, burst: float):
+        self.rate = rate_per_second
+        self.burst = burst
+        self.state: dict[int, tuple[float, float]] = {}
+
+    def allow(self, key: int) -> bool:
+        now = time.monotonic()
+        tokens, last = self.state.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        if tokens >= 1:
+            self.state[key] = (tokens - 1, now)
+            return True
+        self.state[key] = (tokens, now)
+        return False
+
+    def evict(self):
+        now = time.monotonic()
+        full = [k for k, (tokens, last) in self.state.items() if tokens + (now - last) * self.rate >= self.burst]
+        for k in full:
+            del self.state[k]
+
+PRIVATE_LIMITER = TokenBucket(PRIVATE_RATE_PER_MINUTE / 60, PRIVATE_BURST)
+PRIVATE_THROTTLED: set[int] = set()    # кому уже сказали "слишком часто" в текущем эпизоде
+M_PRIVATE_THROTTLED = Counter("mcbot_private_throttled_total", "Private messages dropped by the per-user rate limit")
+
+def private_limiter_evict():
+    PRIVATE_LIMITER.evict()
+    PRIVATE_THROTTLED.intersection_update(PRIVATE_LIMITER.state)
+
+MAINTENANCE_HOOKS.append(private_limiter_evict)
+
+class PrivateFloodMiddleware(BaseMiddleware):
+    # самый первый из наших outer-middleware, раньше журнала дублей: лишние сообщения
+    # не доходят ни до БД (даже до update_ledger), ни до API
+    async def __call__(self, handler, event, data):
+        msg = event.message
+        if msg is None or msg.chat.type != "private" or not msg.from_user or is_admin(msg.from_user.id):
+            return await handler(event, data)
+        uid = msg.from_user.id
+        if PRIVATE_LIMITER.allow(uid):
+            PRIVATE_THROTTLED.discard(uid)
+            return await handler(event, data)
+        M_PRIVATE_THROTTLED.inc()
+        if uid not in PRIVATE_THROTTLED:
+            PRIVATE_THROTTLED.add(uid)
+            try:
+                await msg.answer("⏳ Слишком много сообщений. Подожди немного — лишние я не передам админу.")
+            except Exception:
+                pass
+        return None
+
+dp.update.outer_middleware(PrivateFloodMiddleware())
+
+Gauge("mcbot_private_limiter_buckets", "Users tracked by the private-chat rate limiter",
+      lambda: len(PRIVATE_LIMITER.state))
+
+
+# =========================
+# ДЕДУПЛИКАЦИЯ АПДЕЙТОВ
+# =========================
+class DedupeLedger:
+    """
+    Журнал уже обработанных апдейтов: кольцо (deque) + set, проверка за O(1),
+    память ограничена size ключами. Новый ключ записывается в SQLite до обработки
+    апдейта (persist): упали посреди пачки — Telegram пришлёт её снова, а ключи уже
+    на диске. Ключи одного прохода цикла событий (пачка getUpdates) — один commit.
+    При старте кольцо восстанавливается — повтор после рестарта тоже отсекается.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.ring: deque[str] = deque()
+        self.keys: set[str] = set()
+        self._wb = WriteBehind("INSERT OR IGNORE INTO update_ledger(key, created_ts) VALUES (?,?)")
+        self._commit: asyncio.Future | None = None   # общий commit для ключей текущего прохода цикла
+
+    def check_and_add(self, key: str) -> bool:
+        # True — ключ уже был (дубль); иначе запоминаем
+        if key in self.keys:
+            return True
+        self.keys.add(key)
+        self.ring.append(key)
+        if len(self.ring) > self.size:
+            self.keys.discard(self.ring.popleft())
+        self._wb.put(key, (key, ts()))
+        return False
+
+    def discard(self, keys: list[str]):
+        # обработка не удалась — забываем ключи, чтобы повтор апдейта не отсекался
+        for key in keys:
+            if key in self.keys:
+                self.keys.discard(key)
+                self.ring.remove(key)
+            self._wb.pending.pop(key, None)
+        con = db()
+        con.executemany("DELETE FROM update_ledger WHERE key=?", [(k,) for k in keys])
+        con.commit()
+        con.close()
+
+    async def persist(self):
+        # ждём commit, общий для всех апдейтов, начатых в этом проходе цикла событий
+        if self._commit is None:
+            loop = asyncio.get_running_loop()
+            self._commit = loop.create_future()
+            loop.call_soon(self._flush)
+        await asyncio.shield(self._commit)
+
+    def _flush(self):
+        fut, self._commit = self._commit, None
+        try:
+            self._wb.flush()
+        except Exception:
+            # БД недоступна — апдейты всё равно обрабатываем, защита от повтора только в памяти
+            logging.exception("update ledger flush failed")
+        fut.set_result(None)
+
+    def load(self):
+        con = db()
+        rows = con.execute("SELECT key FROM update_ledger ORDER BY seq DESC LIMIT ?", (self.size,)).fetchall()
+        con.close()
+        self.ring.clear()
+        self.keys.clear()
+        for (key,) in reversed(rows):
+            self.ring.append(key)
+            self.keys.add(key)
+
+    def trim(self):
+        # в таблице держим столько же, сколько в памяти
+        con = db()
+        con.execute(
+            "DELETE FROM update_ledger WHERE seq <= (SELECT MAX(seq) FROM update_ledger) - ?",
+            (self.size,)
+        )
+        con.commit()
+        con.close()
+
+UPDATE_LEDGER = DedupeLedger(DEDUPE_LEDGER_SIZE)
+MAINTENANCE_HOOKS.append(UPDATE_LEDGER.trim)
+M_DUPLICATE_UPDATES = Counter("mcbot_duplicate_updates_total", "Updates skipped as already processed", ("key",))
+
+def update_dedupe_keys(update) -> list[str]:
+    keys = [f"u{update.update_id}"]
+    msg = update.message or update.edited_message
+    if msg is not None:
+        keys.append(f"m{msg.chat.id}:{msg.message_id}:{msg.edit_date or 0}")
+    return keys
+
+class DedupeMiddleware(BaseMiddleware):
+    # сразу за анти-флудом ЛС (встроенные в aiogram — ошибки, user context, FSM —
+    # отрабатывают раньше): дубль не считается в метриках и не доходит до страйков/мутов.
+    # Ключ помечается до обработчика: если обработчик бросил исключение, ключи снимаются
+    # и повтор апдейта снова будет обработан. Но если процесс убит посреди обработчика,
+    # ключ уже на диске и повтор отсечётся — апдейт обработан не более одного раза
+    # (at-most-once). Это сознательный выбор: повторный мут/страйк хуже пропущенного.
+    async def __call__(self, handler, event, data):
+        keys = update_dedupe_keys(event)
+        for key in keys:
+            if UPDATE_LEDGER.check_and_add(key):
+                M_DUPLICATE_UPDATES.inc(key[0])
+                return None
+        await UPDATE_LEDGER.persist()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_LEDGER.discard(keys)
+            raise
+
+dp.update.outer_middleware(DedupeMiddleware())
+
+
+# =========================
+# МЕТРИКИ: Telegram API, апдейты, HTTP
+# =========================
+# стадии трассы для запросов к API (остальные методы пишутся под своим именем)
+API_TRACE_STAGES = {"deleteMessage": "delete", "sendMessage": "send", "sendSticker": "send"}
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    # оборачивает каждый запрос к Bot API — в т.ч. те, ошибки которых глушатся в хендлерах
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            M_API_ERRORS.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            M_API_SECONDS.observe(elapsed, name)
+            trace_add(API_TRACE_STAGES.get(name, name), elapsed)
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        kind = event.event_type
+        M_UPDATES.inc(kind)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            M_HANDLER_SECONDS.observe(time.perf_counter() - start, kind)
+
+# ----- трассировка и профайлер -----
+SLOW_CAPTURES: list[dict] = []       # последние медленные апдейты, снятые под профайлером
+_profile_busy = False                # cProfile один на поток — профилируем по одному апдейту
+
+class TraceMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        tracing, profiling = DIAG["trace"], DIAG["profile"]
+        if not tracing and not profiling:
+            return await handler(event, data)
+
+        global _profile_busy
+        tr = {"trace_id": secrets.token_hex(8), "stages": {}}
+        token = _TRACE.set(tr)
+        prof = None
+        if profiling and not _profile_busy and random.random() < PROFILE_SAMPLE_RATE:
+            import cProfile
+            _profile_busy = True
+            prof = cProfile.Profile()
+            prof.enable()
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            total_ms = (time.perf_counter() - start) * 1000
+            _TRACE.reset(token)
+            slow = total_ms >= TRACE_SLOW_MS
+            if prof is not None:
+                prof.disable()
+                _profile_busy = False
+                if slow:
+                    save_slow_capture(prof, tr, total_ms)
+            if tracing:
+                ev = event.event
+                chat = getattr(ev, "chat", None) or getattr(getattr(ev, "message", None), "chat", None)
+                trace_log.info(json.dumps({
+                    "trace_id": tr["trace_id"],
+                    "update_id": event.update_id,
+                    "type": event.event_type,
+                    "chat_id": chat.id if chat else None,
+                    "total_ms": round(total_ms, 3),
+                    "slow": slow,
+                    "stages": {k: round(v, 3) for k, v in tr["stages"].items()},
+                }, ensure_ascii=False))
+
+def save_slow_capture(prof, tr: dict, total_ms: float):
+    # профили пишутся в PROFILE_DIR/<trace_id>.prof (смотреть: python -m pstats / snakeviz)
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{tr['trace_id']}.prof")
+    prof.dump_stats(path)
+    SLOW_CAPTURES.append({"trace_id": tr["trace_id"], "total_ms": total_ms, "stages": dict(tr["stages"]), "path": path})
+    while len(SLOW_CAPTURES) > PROFILE_KEEP:
+        old = SLOW_CAPTURES.pop(0)
+        try:
+            os.remove(old["path"])
+        except OSError:
+            pass
+
+def profile_top(path: str, limit: int = 15) -> str:
+    import io
+    import pstats
+    buf = io.StringIO()
+    pstats.Stats(path, stream=buf).sort_stats("cumulative").print_stats(limit)
+    return buf.getvalue()
+
+bot.session.middleware(ApiMetricsMiddleware())
+dp.update.outer_middleware(UpdateMetricsMiddleware())
+dp.update.outer_middleware(TraceMiddleware())
+
+Gauge("mcbot_write_behind_pending", "Rows waiting for the write-behind flush",
+      lambda: sum(len(q.pending) for q in WRITE_BEHIND_QUEUES))
+Gauge("mcbot_cache_entries", "Entries in in-memory caches", lambda: {
+    "usernames": len(USERNAME_BY_ID),
+    "chat_meta": len(CHAT_META),
+    "seen_messages": len(SEEN_MESSAGES),
+    "forward_verdicts": len(FORWARD_VERDICTS),
+    "views": len(VIEW_CACHE),
+    "update_ledger": len(UPDATE_LEDGER.keys),
+    "trust": len(TRUST),
+    "chat_admins": len(CHAT_ADMINS),
+    "flood_trackers": len(FLOOD_TRACKERS),
+    "join_verdicts": len(JOIN_SCREENER.verdicts),
+}, label="cache")
+
+async def metrics_handler(request):
+    from aiohttp import web
+    return web.Response(text=metrics_render(), content_type="text/plain", charset="utf-8")
+
+async def start_metrics_server():
+    # aiohttp.web нужен только для /metrics — не тянем его при старте, если эндпоинт выключен
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    return runner
+
+
+# =========================
+# ОТПРАВКА С ЛИМИТОМ
+# =========================
+class RateLimitedSender:
+    """
+    Общий лимит исходящих: не больше SEND_RATE_PER_SECOND запросов в секунду
+    и SEND_CONCURRENCY одновременно. RetryAfter от Telegram — ждём и повторяем один раз.
+    """
+
+    def __init__(self, rate: float, concurrency: int):
+        self.interval = 1.0 / rate
+        self.sem = asyncio.Semaphore(concurrency)
+        self.next_slot = 0.0
+
+    async def _slot(self):
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def call(self, factory):
+        # factory — функция без аргументов, возвращающая корутину (её можно вызвать повторно)
+        async with self.sem:
+            await self._slot()
+            try:
+                return await factory()
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await self._slot()
+                return await factory()
+
+    async def gather(self, factories) -> list:
+        return await asyncio.gather(*(self.call(f) for f in factories), return_exceptions=True)
+
+SENDER = RateLimitedSender(SEND_RATE_PER_SECOND, SEND_CONCURRENCY)
+
+
+# =========================
+# МЕТАДАННЫЕ ЧАТОВ (кэш)
+# =========================
+CHAT_META_INFLIGHT: dict[int, asyncio.Task] = {}
+
+async def _chat_meta_fetch(chat_id: int) -> ChatMeta:
+    try:
+        chat = await bot.get_chat(chat_id)
+    finally:
+        CHAT_META_INFLIGHT.pop(chat_id, None)
+    meta = chat_meta(chat_id)
+    meta.title = chat.title or meta.title
+    meta.permissions = chat.permissions
+    meta.fetched_at = time.monotonic()
+    return meta
+
+async def chat_meta_refresh(chat_id: int) -> ChatMeta:
+    # одновременные промахи по одному чату (пачка unmute) ждут один и тот же get_chat
+    task = CHAT_META_INFLIGHT.get(chat_id)
+    if task is None:
+        task = asyncio.create_task(_chat_meta_fetch(chat_id))
+        CHAT_META_INFLIGHT[chat_id] = task
+    return await asyncio.shield(task)
+
+async def chat_member_count(chat_id: int) -> int | None:
+    # только там, где число показывают (/diag); между запросами его правят chat_member
+    meta = chat_meta(chat_id)
+    if meta.member_count is None or time.monotonic() - meta.member_count_at >= CHAT_META_TTL_SECONDS:
+        try:
+            meta.member_count = int(await bot.get_chat_member_count(chat_id))
+            meta.member_count_at = time.monotonic()
+        except Exception:
+            pass
+    return meta.member_count
+
+async def chat_permissions(chat_id: int) -> ChatPermissions | None:
+    meta = chat_meta(chat_id)
+    if not meta.is_fresh():
+        meta = await chat_meta_refresh(chat_id)
+    return meta.permissions
+
+def member_present(member) -> bool:
+    status = getattr(member, "status", None)
+    if status in ("creator", "administrator", "member"):
+        return True
+    return status == "restricted" and bool(getattr(member, "is_member", False))
+
+def member_can(member, right: str) -> bool:
+    status = getattr(member, "status", None)
+    if status == "creator":
+        return True
+    return status == "administrator" and bool(getattr(member, right, False))
+
+async def bot_rights(chat_id: int) -> tuple[bool, bool]:
+    """
+    (может удалять, может ограничивать) для бота в чате.
+    Берётся из my_chat_member; если не знаем — один get_chat_member на CHAT_META_TTL_SECONDS.
+    """
+    meta = chat_meta(chat_id)
+    now = time.monotonic()
+    stale = meta.bot_member is None or now - meta.bot_member_at >= CHAT_META_TTL_SECONDS
+    if stale and now >= meta.bot_member_retry_at:
+        try:
+            meta.bot_member = await bot.get_chat_member(chat_id, bot.id)
+            meta.bot_member_at = time.monotonic()
+        except Exception:
+            # ошибку тоже запоминаем, иначе get_chat_member уходил бы на каждое сообщение
+            meta.bot_member_retry_at = time.monotonic() + BOT_RIGHTS_RETRY_SECONDS
+    m = meta.bot_member
+    if m is None:
+        # не смогли узнать — действуем как раньше: пробуем и смотрим на результат
+        return True, True
+    return member_can(m, "can_delete_messages"), member_can(m, "can_restrict_members")
+
+# ----- админы чата -----
+# chat_id -> set(user_id). Между перечитываниями набор правится по chat_member,
+# так что проверка команды — это поиск в set без запросов к API.
+CHAT_ADMINS = LRUCache(CHAT_ADMINS_CACHE_SIZE, ttl=CHAT_ADMINS_TTL_SECONDS)
+CHAT_ADMINS_INFLIGHT: dict[int, asyncio.Task] = {}
+M_CHAT_ADMINS = Counter("mcbot_chat_admins_lookups_total", "Chat admin set lookups (hit/miss/joined)", ("result",))
+
+async def _chat_admins_fetch(chat_id: int) -> set[int]:
+    try:
+        members = await bot.get_chat_administrators(chat_id)
+    finally:
+        CHAT_ADMINS_INFLIGHT.pop(chat_id, None)
+    admins = {m.user.id for m in members}
+    CHAT_ADMINS.set(chat_id, admins)
+    return admins
+
+async def chat_admins(chat_id: int) -> set[int]:
+    admins = CHAT_ADMINS.get(chat_id)
+    if admins is not None:
+        M_CHAT_ADMINS.inc("hit")
+        return admins
+    # одновременные промахи по одному чату ждут один и тот же запрос
+    task = CHAT_ADMINS_INFLIGHT.get(chat_id)
+    if task is None:
+        M_CHAT_ADMINS.inc("miss")
+        task = asyncio.create_task(_chat_admins_fetch(chat_id))
+        CHAT_ADMINS_INFLIGHT[chat_id] = task
+    else:
+        M_CHAT_ADMINS.inc("joined")
+    return await asyncio.shield(task)
+
+async def is_chat_admin(msg: Message) -> bool:
+    """Админ бота (ADMIN_IDS), анонимный админ группы или админ этого чата."""
+    if msg.from_user and is_admin(msg.from_user.id):
+        return True
+    if msg.sender_chat and msg.sender_chat.id == msg.chat.id:
+        return True
+    if not msg.from_user:
+        return False
+    try:
+        return msg.from_user.id in await chat_admins(msg.chat.id)
+    except Exception:
+        logging.exception("get_chat_administrators failed for %s", msg.chat.id)
+        return False
+
+@dp.my_chat_member()
+async def on_my_chat_member(ev: ChatMemberUpdated):
+    if not member_present(ev.new_chat_member):
+        CHAT_META.pop(ev.chat.id)
+        CHAT_ADMINS.pop(ev.chat.id)
+        return
+    meta = chat_meta(ev.chat.id)
+    meta.title = ev.chat.title or meta.title
+    meta.bot_member = ev.new_chat_member
+    meta.bot_member_at = time.monotonic()
+    # права бота поменялись — заодно перечитаем права чата при следующем обращении
+    meta.fetched_at = 0.0
+    for right in RIGHTS_WARNINGS:
+        if member_can(ev.new_chat_member, right):
+            meta.rights_warn_ts.pop(right, None)
+            meta.rights_admins_notified.discard(right)
+
+@dp.chat_member()
+async def on_chat_member(ev: ChatMemberUpdated):
+    was, now_in = member_present(ev.old_chat_member), member_present(ev.new_chat_member)
+    if now_in and not was:
+        JOIN_SCREENER.screen(ev.chat.id, ev.new_chat_member.user)
+    admins = CHAT_ADMINS.get(ev.chat.id)
+    if admins is not None:
+        if ev.new_chat_member.status in ("creator", "administrator"):
+            admins.add(ev.new_chat_member.user.id)
+        else:
+            admins.discard(ev.new_chat_member.user.id)
+    meta = CHAT_META.get(ev.chat.id)
+    if meta is None:
+        return
+    meta.title = ev.chat.title or meta.title
+    if meta.member_count is not None and was != now_in:
+        meta.member_count += 1 if now_in else -1
 
 
 # =========================
@@ -590,12 +2783,52 @@ async def try_delete(msg: Message) -> bool:
     except Exception:
         return False
 
-async def ensure_delete_warning(chat_id: int):
-    await bot.send_message(
-        chat_id,
+# право -> (сообщение в чат, что не работает — для админов)
+RIGHTS_WARNINGS = {
+    "can_delete_messages": (
         "⚠️ Я не смог удалить сообщение.\n"
-        "Дай мне права: <b>Delete messages</b> (сделай админом)."
-    )
+        "Дай мне права: <b>Delete messages</b> (сделай админом).",
+        "<b>Delete messages</b> — реклама не удаляется",
+    ),
+    "can_restrict_members": (
+        "⚠️ Я не смог выдать мут.\n"
+        "Дай мне права: <b>Ban users</b> (сделай админом).",
+        "<b>Ban users</b> — нарушителей не получается замутить",
+    ),
+}
+
+async def ensure_rights_warning(chat_id: int, right: str):
+    # одно предупреждение на чат и право за RIGHTS_WARN_INTERVAL_SECONDS, админам — один раз
+    meta = chat_meta(chat_id)
+    now = ts()
+    if now - meta.rights_warn_ts.get(right, 0) < RIGHTS_WARN_INTERVAL_SECONDS:
+        return
+    meta.rights_warn_ts[right] = now
+    chat_text, admin_text = RIGHTS_WARNINGS[right]
+    try:
+        await bot.send_message(chat_id, chat_text)
+    except Exception:
+        pass
+    if right not in meta.rights_admins_notified:
+        meta.rights_admins_notified.add(right)
+        await notify_admins(
+            f"⚠️ В чате <b>{meta.title or chat_id}</b> (<code>{chat_id}</code>) "
+            f"у меня нет права {admin_text}."
+        )
+
+async def ensure_delete_warning(chat_id: int):
+    await ensure_rights_warning(chat_id, "can_delete_messages")
+
+async def delete_or_warn(msg: Message) -> bool:
+    # без прав на удаление даже не пытаемся — сразу (дедуплицированное) предупреждение
+    can_delete, _ = await bot_rights(msg.chat.id)
+    if can_delete and await try_delete(msg):
+        return True
+    if can_delete:
+        # думали, что права есть, — перепроверим при следующем сообщении
+        chat_meta(msg.chat.id).bot_member_at = 0.0
+    await ensure_delete_warning(msg.chat.id)
+    return False
 
 async def notify_admins(text: str, kb: InlineKeyboardMarkup | None = None):
     for aid in ADMIN_IDS:
@@ -608,19 +2841,23 @@ async def notify_admins(text: str, kb: InlineKeyboardMarkup | None = None):
 # =========================
 # ГРУППА: наказания (mute/ban)
 # =========================
-async def apply_mute(chat_id: int, user_id: int, seconds: int | None):
+async def apply_mute(chat_id: int, user_id: int, seconds: int | None) -> bool:
+    _, can_restrict = await bot_rights(chat_id)
+    if not can_restrict:
+        await ensure_rights_warning(chat_id, "can_restrict_members")
+        return False
     if seconds is None:
         perms = ChatPermissions(can_send_messages=False)
         await bot.restrict_chat_member(chat_id, user_id, permissions=perms)
-        return
+        return True
     until = now_utc() + timedelta(seconds=seconds)
     perms = ChatPermissions(can_send_messages=False)
     await bot.restrict_chat_member(chat_id, user_id, permissions=perms, until_date=until)
+    return True
 
 async def apply_unmute(chat_id: int, user_id: int):
-    # Возвращаем права чата (самый правильный способ)
-    chat = await bot.get_chat(chat_id)
-    perms = chat.permissions or ChatPermissions(
+    # Возвращаем права чата (самый правильный способ); права берём из кэша метаданных
+    perms = await chat_permissions(chat_id) or ChatPermissions(
         can_send_messages=True,
         can_send_other_messages=True,
         can_send_polls=True,
@@ -644,7 +2881,9 @@ async def apply_unban(chat_id: int, user_id: int):
 async def resolve_target_from_command(msg: Message, args: list[str]) -> int | None:
     # 1) reply — самый надёжный вариант
     if msg.reply_to_message and msg.reply_to_message.from_user and not args:
-        return msg.reply_to_message.from_user.id
+        u = msg.reply_to_message.from_user
+        username_observe(u.id, u.username)
+        return u.id
 
     # 2) forward (если reply на пересланное)
     if msg.reply_to_message and msg.reply_to_message.forward_from and not args:
@@ -656,14 +2895,21 @@ async def resolve_target_from_command(msg: Message, args: list[str]) -> int | No
         if t.isdigit():
             return int(t)
         if t.startswith("@"):
-            username = t[1:]
-            try:
-                ch = await bot.get_chat(username)
-                return int(ch.id)
-            except Exception:
-                return None
+            return await resolve_username(t)
     return None
 
+async def resolve_username(username: str) -> int | None:
+    # сначала индекс из трафика (без запросов к API), потом get_chat как запасной вариант
+    uid = username_lookup(username)
+    if uid is not None:
+        return uid
+    try:
+        ch = await bot.get_chat("@" + username.strip().lstrip("@"))
+    except Exception:
+        return None
+    username_observe(int(ch.id), ch.username)
+    return int(ch.id)
+
 def split_args(text: str | None) -> list[str]:
     if not text:
         return []
@@ -719,7 +2965,7 @@ async def cmd_userid(msg: Message):
 async def cmd_adgive(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -732,8 +2978,8 @@ async def cmd_adgive(msg: Message):
     rest = args[1:] if args and (args[0].startswith("@") or args[0].isdigit()) else args
     dur = parse_duration(rest[0]) if rest else None
     until_ts = None if dur is None else ts() + dur
-    permit_set(msg.chat.id, uid, until_ts)
-    cooldown_warn_reset(msg.chat.id, uid)
+    await permit_set(msg.chat.id, uid, until_ts)
+    await cooldown_warn_reset(msg.chat.id, uid)
 
     await msg.reply(f"✅ Разрешение на рекламу выдано: <code>{uid}</code>\n⏳ До: <b>{fmt_dt(until_ts)}</b>")
 
@@ -741,7 +2987,7 @@ async def cmd_adgive(msg: Message):
 async def cmd_adrevoke(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -751,8 +2997,8 @@ async def cmd_adrevoke(msg: Message):
                         "⚠️ Если @username не находится — используй reply/forward или числовой ID.")
         return
 
-    permit_remove(msg.chat.id, uid)
-    cooldown_warn_reset(msg.chat.id, uid)
+    await permit_remove(msg.chat.id, uid)
+    await cooldown_warn_reset(msg.chat.id, uid)
     await msg.reply(f"🗑️ Разрешение на рекламу убрано: <code>{uid}</code>")
 
 
@@ -763,7 +3009,7 @@ async def cmd_adrevoke(msg: Message):
 async def cmd_mcunwarn(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -773,15 +3019,15 @@ async def cmd_mcunwarn(msg: Message):
                         "⚠️ Если @username не находится — используй reply/forward или числовой ID.")
         return
 
-    admin_warn_set(msg.chat.id, uid, 0)
-    mc_upsert(msg.chat.id, uid, "", "warn", ts(), "Снято админом", msg.from_user.id, 0)
+    await admin_warn_set(msg.chat.id, uid, 0)
+    await mc_upsert(msg.chat.id, uid, username_of(uid), "warn", ts(), "Снято админом", msg.from_user.id, 0)
     await msg.reply(f"✅ Предупреждения сняты: <code>{uid}</code>")
 
 @dp.message(Command("mcunmute"))
 async def cmd_mcunmute(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -795,14 +3041,14 @@ async def cmd_mcunmute(msg: Message):
         await apply_unmute(msg.chat.id, uid)
     except Exception:
         pass
-    mc_upsert(msg.chat.id, uid, "", "mute", ts(), "Снято админом", msg.from_user.id, 0)
+    await mc_upsert(msg.chat.id, uid, username_of(uid), "mute", ts(), "Снято админом", msg.from_user.id, 0)
     await msg.reply(f"✅ Мут снят: <code>{uid}</code>")
 
 @dp.message(Command("mcunban"))
 async def cmd_mcunban(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -816,10 +3062,44 @@ async def cmd_mcunban(msg: Message):
         await apply_unban(msg.chat.id, uid)
     except Exception:
         pass
-    mc_upsert(msg.chat.id, uid, "", "ban", ts(), "Снято админом", msg.from_user.id, 0)
+    await mc_upsert(msg.chat.id, uid, username_of(uid), "ban", ts(), "Снято админом", msg.from_user.id, 0)
     await msg.reply(f"✅ Бан снят: <code>{uid}</code>")
 
 
+# =========================
+# КЭШ ГОТОВЫХ ЭКРАНОВ
+# =========================
+# Ключ — (экран, чат, страница, версия данных): пока в таблице ничего не менялось,
+# повторное нажатие кнопки не ходит в БД и не пересобирает текст/клавиатуру.
+VIEW_CACHE = LRUCache(VIEW_CACHE_SIZE, ttl=VIEW_CACHE_TTL_SECONDS)
+SHOWN_VIEWS = LRUCache(VIEW_CACHE_SIZE)   # (chat_id, message_id) -> ключ экрана, который сейчас в сообщении
+
+async def cached_view(view: str, table: str, chat_id: int, page: int, render) -> tuple[tuple, tuple[str, InlineKeyboardMarkup]]:
+    key = (view, chat_id, page, data_version(table, chat_id))
+    rendered = VIEW_CACHE.get(key)
+    if rendered is None:
+        rendered = await render()
+        VIEW_CACHE.set(key, rendered)
+    return key, rendered
+
+async def show_view(cq: CallbackQuery, key: tuple, rendered: tuple[str, InlineKeyboardMarkup]):
+    text, kb = rendered
+    shown = (cq.message.chat.id, cq.message.message_id)
+    # клавиатуру сверяем с той, что пришла в апдейте: сообщение могли
+    # перерисовать другим экраном (например, "Назад"), и тогда edit нужен
+    if SHOWN_VIEWS.get(shown) == key and cq.message.reply_markup == kb:
+        # в сообщении уже ровно это — не делаем пустой edit
+        await cq.answer()
+        return
+    try:
+        await cq.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    SHOWN_VIEWS.set(shown, key)
+    await cq.answer()
+
+
 # =========================
 # /mclist
 # =========================
@@ -831,8 +3111,8 @@ def kind_ru(kind: str) -> str:
         "kick": "KICK",
     }.get(kind, kind.upper())
 
-def render_mclist(chat_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
-    rows, total = mc_list(chat_id, page)
+async def render_mclist(chat_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
+    rows, total = await mc_list(chat_id, page)
     if not rows:
         return "📋 <b>Список наказаний пуст.</b>", InlineKeyboardMarkup(inline_keyboard=[])
 
@@ -854,7 +3134,7 @@ def render_mclist(chat_id: int, page: int) -> tuple[str, InlineKeyboardMarkup]:
 async def cmd_mclist(msg: Message):
     if msg.chat.type not in ("group", "supergroup"):
         return
-    if not is_admin(msg.from_user.id):
+    if not await is_chat_admin(msg):
         return
 
     args = split_args(msg.text)
@@ -862,8 +3142,9 @@ async def cmd_mclist(msg: Message):
     if args and args[0].isdigit():
         page = max(1, int(args[0]))
 
-    text, kb = render_mclist(msg.chat.id, page)
-    await msg.reply(text, reply_markup=kb)
+    key, (text, kb) = await cached_view("mclist", "mc_punishments", msg.chat.id, page, lambda: render_mclist(msg.chat.id, page))
+    sent = await msg.reply(text, reply_markup=kb)
+    SHOWN_VIEWS.set((sent.chat.id, sent.message_id), key)
 
 @dp.callback_query(F.data.startswith("mclist:"))
 async def cb_mclist(cq: CallbackQuery):
@@ -879,12 +3160,8 @@ async def cb_mclist(cq: CallbackQuery):
         await cq.answer()
         return
 
-    text, kb = render_mclist(chat_id, page)
-    try:
-        await cq.message.edit_text(text, reply_markup=kb)
-    except Exception:
-        pass
-    await cq.answer()
+    key, rendered = await cached_view("mclist", "mc_punishments", chat_id, page, lambda: render_mclist(chat_id, page))
+    await show_view(cq, key, rendered)
 
 
 # =========================
@@ -961,22 +3238,14 @@ async def cb_perm_list_pick_chat(cq: CallbackQuery):
     await cq.message.edit_text("📋 <b>Выбери чат</b>:", reply_markup=kb_perm_list_pick_chat(chats))
     await cq.answer()
 
-@dp.callback_query(F.data.startswith("perm_list:"))
-async def cb_perm_list(cq: CallbackQuery):
-    if not is_admin(cq.from_user.id):
-        await cq.answer("Нет доступа", show_alert=True)
-        return
-    chat_id = int(cq.data.split(":")[1])
-    items = permits_list_active(chat_id)
-
+async def render_perm_list(chat_id: int) -> tuple[str, InlineKeyboardMarkup]:
+    items = await permits_list_active(chat_id)
     if not items:
-        await cq.message.edit_text(
+        return (
             "📋 <b>Разрешений нет</b>\n\n"
             "В этом чате пока никто не имеет разрешения.",
-            reply_markup=kb_back("perm_list_pick_chat")
+            kb_back("perm_list_pick_chat")
         )
-        await cq.answer()
-        return
 
     lines = ["📋 <b>Разрешения на рекламу</b>", ""]
     now = ts()
@@ -990,9 +3259,16 @@ async def cb_perm_list(cq: CallbackQuery):
             f"  ⏳ До: <b>{fmt_dt(until_ts)}</b>\n"
             f"  🕒 Последняя реклама: <b>{last_used}</b>"
         )
+    return "\n".join(lines), kb_back("perm_list_pick_chat")
 
-    await cq.message.edit_text("\n".join(lines), reply_markup=kb_back("perm_list_pick_chat"))
-    await cq.answer()
+@dp.callback_query(F.data.startswith("perm_list:"))
+async def cb_perm_list(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    chat_id = int(cq.data.split(":")[1])
+    key, rendered = await cached_view("perm_list", "permits", chat_id, 1, lambda: render_perm_list(chat_id))
+    await show_view(cq, key, rendered)
 
 @dp.callback_query(F.data == "perm_give")
 async def cb_perm_give(cq: CallbackQuery, state: FSMContext):
@@ -1034,12 +3310,7 @@ async def resolve_user_id_from_input(msg: Message, raw: str | None) -> int | Non
     if raw:
         t = raw.strip()
         if t.startswith("@"):
-            t = t[1:]
-            try:
-                ch = await bot.get_chat(t)
-                return int(ch.id)
-            except Exception:
-                return None
+            return await resolve_username(t)
     return None
 
 @dp.message(AdminStates.waiting_permit_give)
@@ -1066,8 +3337,8 @@ async def st_perm_give(msg: Message, state: FSMContext):
         return
 
     for chat_id, _ in chats:
-        permit_set(chat_id, uid, until_ts)
-        cooldown_warn_reset(chat_id, uid)
+        await permit_set(chat_id, uid, until_ts)
+        await cooldown_warn_reset(chat_id, uid)
 
     await state.clear()
     await msg.answer(
@@ -1093,8 +3364,8 @@ async def st_perm_remove(msg: Message, state: FSMContext):
 
     chats = get_known_chats()
     for chat_id, _ in chats:
-        permit_remove(chat_id, uid)
-        cooldown_warn_reset(chat_id, uid)
+        await permit_remove(chat_id, uid)
+        await cooldown_warn_reset(chat_id, uid)
 
     await state.clear()
     await msg.answer(
@@ -1105,19 +3376,295 @@ async def st_perm_remove(msg: Message, state: FSMContext):
 
 
 # =========================
-# ЛС: Рассылка
+# ЛС: Массовые действия
 # =========================
-@dp.callback_query(F.data == "bc_menu")
-async def cb_bc_menu(cq: CallbackQuery, state: FSMContext):
+# действие -> (кнопка, вид наказания в mc_punishments; None — фильтры не нужны)
+BULK_ACTIONS = {
+    "unmute": ("🔊 Снять мут", "mute"),
+    "unban": ("🔓 Снять бан", "ban"),
+    "unwarn": ("🧹 Снять предупреждения", "warn"),
+    "permit_give": ("➕ Выдать разрешение", None),
+    "permit_remove": ("➖ Забрать разрешение", None),
+}
+
+def bulk_chat_ids(chat_id: int) -> list[int]:
+    return [cid for cid, _ in get_known_chats()] if chat_id == 0 else [chat_id]
+
+async def bulk_api(action: str, chat_id: int, uid: int):
+    if action == "unmute":
+        await apply_unmute(chat_id, uid)
+    elif action == "unban":
+        # only_if_banned: участника чата unban выкинул бы из группы
+        await bot.unban_chat_member(chat_id, uid, only_if_banned=True)
+
+def bulk_apply_db(action: str, rows: list[tuple[int, int, str]], admin_id: int, until_ts: int | None):
+    # одна транзакция на всю пачку; через STORE.run — целиком в потоке хранилища
+    now = ts()
+    with STORE.transaction():
+        for chat_id, uid, username in rows:
+            if action in ("unmute", "unban", "unwarn"):
+                if action == "unwarn":
+                    STORE.counter_set("admin_warns", chat_id, uid, 0)
+                STORE.mc_upsert((chat_id, uid, username, BULK_ACTIONS[action][1], now, "Снято админом (массово)", now, admin_id, 0))
+            else:
+                if action == "permit_give":
+                    STORE.permit_set(chat_id, uid, until_ts)
+                else:
+                    STORE.permit_remove(chat_id, uid)
+                STORE.counter_set("cooldown_strikes", chat_id, uid, 0)
+
+async def bulk_run(action: str, targets: list[tuple[int, int]], status: Message, admin_id: int, until_ts: int | None = None):
+    """
+    Запросы к API — параллельно через SENDER (общий лимит), записи в хранилище —
+    одной транзакцией в конце. Прогресс — правкой одного сообщения status.
+    """
+    title = BULK_ACTIONS[action][0]
+    requested = len(targets)
+    targets = targets[:BULK_MAX_TARGETS]
+    total = len(targets)
+    of_requested = f" из {requested}" if requested > total else ""
+
+    async def edit(text: str):
+        try:
+            await status.edit_text(text)
+        except TelegramBadRequest:
+            pass
+
+    # права чата для unmute — один get_chat на чат заранее, а не на каждого пользователя
+    if action == "unmute":
+        await asyncio.gather(*(chat_permissions(cid) for cid in {c for c, _ in targets}), return_exceptions=True)
+
+    async def one(chat_id: int, uid: int) -> tuple[int, int, BaseException | None]:
+        try:
+            if action in ("unmute", "unban"):
+                await SENDER.call(lambda: bulk_api(action, chat_id, uid))
+            return chat_id, uid, None
+        except Exception as e:
+            return chat_id, uid, e
+
+    ok: list[tuple[int, int]] = []
+    failed: list[tuple[int, int, BaseException]] = []
+    last_edit = time.monotonic()
+    await edit(f"⏳ <b>{title}</b>: 0/{total}{of_requested}")
+    for fut in asyncio.as_completed([one(c, u) for c, u in targets]):
+        chat_id, uid, err = await fut
+        if err is None:
+            ok.append((chat_id, uid))
+        else:
+            failed.append((chat_id, uid, err))
+        if time.monotonic() - last_edit >= BULK_PROGRESS_SECONDS:
+            last_edit = time.monotonic()
+            await edit(f"⏳ <b>{title}</b>: {len(ok) + len(failed)}/{total} (ошибок: {len(failed)})")
+
+    await STORE.run(bulk_apply_db, action, [(c, u, username_of(u) or "") for c, u in ok], admin_id, until_ts)
+    table = "permits" if action.startswith("permit_") else "mc_punishments"
+    for chat_id in {c for c, _ in ok}:
+        bump_version(table, chat_id)
+
+    lines = [f"✅ <b>{title}</b>: готово {len(ok)}/{total}"]
+    if requested > total:
+        lines.append(f"⚠️ Взяты первые {total} из {requested} (лимит {BULK_MAX_TARGETS} за раз), "
+                     f"остальные {requested - total} пропущены — запусти ещё раз.")
+    if failed:
+        lines.append(f"❌ Ошибок: {len(failed)}")
+        for chat_id, uid, err in failed[:10]:
+            lines.append(f"• <code>{uid}</code> в <code>{chat_id}</code>: {html.escape(type(err).__name__)}")
+    await edit("\n".join(lines))
+
+@dp.callback_query(F.data == "bulk_menu")
+async def cb_bulk_menu(cq: CallbackQuery, state: FSMContext):
     if not is_admin(cq.from_user.id):
         await cq.answer("Нет доступа", show_alert=True)
         return
+    await state.clear()
+    await cq.message.edit_text(
+        "📦 <b>Массовые действия</b>\n\n"
+        "Выбери действие, потом чат (или все чаты) и пришли список\n"
+        "<code>ID</code> / <code>@username</code> через пробел или с новой строки.\n"
+        "Для снятия наказаний можно взять людей по фильтру.",
+        reply_markup=kb_bulk_actions()
+    )
+    await cq.answer()
 
+@dp.callback_query(F.data.startswith("bulk_act:"))
+async def cb_bulk_act(cq: CallbackQuery, state: FSMContext):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    action = cq.data.split(":")[1]
+    if action not in BULK_ACTIONS:
+        await cq.answer()
+        return
     chats = get_known_chats()
     if not chats:
         await cq.message.edit_text(
-            "📣 <b>Рассылка</b>\n\n"
-            "Пока нет чатов в списке.\n"
+            "📦 <b>Массовые действия</b>\n\n"
+            "Пока нет чатов.\n"
+            "Напиши что-нибудь в группе с ботом — и чат появится.",
+            reply_markup=kb_back("bulk_menu")
+        )
+        await cq.answer()
+        return
+    await state.update_data(bulk_action=action)
+    await cq.message.edit_text(f"{BULK_ACTIONS[action][0]}\n\n📋 <b>Выбери чат</b>:", reply_markup=kb_bulk_chats(chats))
+    await cq.answer()
+
+@dp.callback_query(F.data.startswith("bulk_chat:"))
+async def cb_bulk_chat(cq: CallbackQuery, state: FSMContext):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    data = await state.get_data()
+    action = data.get("bulk_action")
+    if action not in BULK_ACTIONS:
+        await cq.answer("Сначала выбери действие", show_alert=True)
+        return
+    chat_id = int(cq.data.split(":")[1])
+    await state.update_data(bulk_chat_id=chat_id)
+    await state.set_state(AdminStates.waiting_bulk_targets)
+    title, kind = BULK_ACTIONS[action]
+    text = (
+        f"{title}\n\n"
+        "Пришли список: <code>ID</code> / <code>@username</code> через пробел, запятую или с новой строки "
+        f"(до {BULK_MAX_TARGETS})."
+    )
+    if action == "permit_give":
+        text += "\nСрок можно добавить в конце: <code>123 456 1d</code>. Без срока — навсегда."
+    if kind is not None:
+        text += "\n\nИли выбери по фильтру:"
+    await cq.message.edit_text(text, reply_markup=kb_bulk_filters() if kind is not None else kb_back("bulk_menu"))
+    await cq.answer()
+
+@dp.callback_query(AdminStates.waiting_bulk_targets, F.data.startswith("bulk_filter:"))
+async def cb_bulk_filter(cq: CallbackQuery, state: FSMContext):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    data = await state.get_data()
+    action, chat_id = data.get("bulk_action"), data.get("bulk_chat_id")
+    kind = BULK_ACTIONS.get(action, ("", None))[1]
+    if kind is None or chat_id is None:
+        await cq.answer()
+        return
+    mode = cq.data.split(":")[1]
+    auto = mode == "auto"
+    since = ts() - BULK_AUTO_WINDOW_SECONDS if auto else 0
+    targets = [(cid, uid) for cid in bulk_chat_ids(chat_id)
+               for uid in await mc_find_active(cid, kind, since, 0 if auto else None)]
+    if not targets:
+        await cq.answer("Никого не нашлось", show_alert=True)
+        return
+    if mode == "pick":
+        # выбор по одному: список и отметки живут в данных FSM, пока не нажмут "Выполнить"
+        targets = targets[:BULK_MAX_TARGETS]
+        await state.update_data(bulk_pick=targets, bulk_selected=[])
+        await cq.message.edit_text(bulk_pick_text(action, 0), reply_markup=kb_bulk_pick(bulk_pick_labels(chat_id, targets), set(), 1))
+        await cq.answer()
+        return
+    await state.clear()
+    await cq.answer()
+    await bulk_run(action, targets, cq.message, cq.from_user.id)
+
+def bulk_pick_labels(chat_id: int, targets: list) -> list[str]:
+    titles = dict(get_known_chats()) if chat_id == 0 else {}
+    out = []
+    for cid, uid in targets:
+        name = username_of(uid)
+        label = f"@{name}" if name else str(uid)
+        if chat_id == 0:
+            label += f" · {titles.get(cid) or cid}"
+        out.append(label)
+    return out
+
+def bulk_pick_text(action: str, selected: int) -> str:
+    return f"{BULK_ACTIONS[action][0]}\n\n☑️ Отметь, с кого снять (выбрано: {selected}), и нажми «Выполнить»."
+
+@dp.callback_query(AdminStates.waiting_bulk_targets, F.data.startswith("bulk_pick"))
+async def cb_bulk_pick(cq: CallbackQuery, state: FSMContext):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    data = await state.get_data()
+    action, chat_id = data.get("bulk_action"), data.get("bulk_chat_id")
+    targets = [tuple(t) for t in data.get("bulk_pick") or ()]
+    selected = set(data.get("bulk_selected") or ())
+    if action not in BULK_ACTIONS or not targets:
+        await cq.answer()
+        return
+    parts = cq.data.split(":")
+    if parts[0] == "bulk_pick_go":
+        if not selected:
+            await cq.answer("Никто не выбран", show_alert=True)
+            return
+        await state.clear()
+        await cq.answer()
+        await bulk_run(action, [targets[i] for i in sorted(selected)], cq.message, cq.from_user.id)
+        return
+    if parts[0] == "bulk_pick_page":
+        page = int(parts[1])
+    else:
+        i, page = int(parts[1]), int(parts[2])
+        if 0 <= i < len(targets):
+            selected ^= {i}
+        await state.update_data(bulk_selected=sorted(selected))
+    await cq.message.edit_text(
+        bulk_pick_text(action, len(selected)),
+        reply_markup=kb_bulk_pick(bulk_pick_labels(chat_id, targets), selected, page)
+    )
+    await cq.answer()
+
+@dp.message(AdminStates.waiting_bulk_targets)
+async def st_bulk_targets(msg: Message, state: FSMContext):
+    if msg.chat.type != "private" or not is_admin(msg.from_user.id):
+        return
+    data = await state.get_data()
+    action, chat_id = data.get("bulk_action"), data.get("bulk_chat_id")
+    if action not in BULK_ACTIONS or chat_id is None:
+        await state.clear()
+        await msg.answer("⚠️ Сначала выбери действие.", reply_markup=kb_main(True))
+        return
+
+    tokens = [t for t in re.split(r"[\s,;]+", msg.text or "") if t]
+    dur_sec = parse_duration(tokens[-1]) if tokens else None
+    if dur_sec is not None:
+        tokens = tokens[:-1]
+    names = [t for t in tokens if t.startswith("@")]
+    resolved = await asyncio.gather(*(resolve_username(n) for n in names))
+    by_name = dict(zip(names, resolved))
+    uids, bad = [], []
+    for t in tokens:
+        uid = int(t) if t.isdigit() else by_name.get(t)
+        if uid is None:
+            bad.append(t)
+        elif uid not in uids:
+            uids.append(uid)
+    if not uids:
+        await msg.answer("❌ Не нашёл ни одного ID. Пришли ID / @username через пробел или с новой строки.")
+        return
+
+    await state.clear()
+    if bad:
+        await msg.answer("⚠️ Не смог определить: " + ", ".join(html.escape(b) for b in bad[:20]))
+    targets = [(cid, uid) for cid in bulk_chat_ids(chat_id) for uid in uids]
+    status = await msg.answer("⏳ …")
+    until_ts = None if dur_sec is None else ts() + dur_sec
+    await bulk_run(action, targets, status, msg.from_user.id, until_ts)
+
+
+# =========================
+# ЛС: Рассылка
+# =========================
+@dp.callback_query(F.data == "bc_menu")
+async def cb_bc_menu(cq: CallbackQuery, state: FSMContext):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+
+    chats = get_known_chats()
+    if not chats:
+        await cq.message.edit_text(
+            "📣 <b>Рассылка</b>\n\n"
+            "Пока нет чатов в списке.\n"
             "Напиши что-нибудь в группе с ботом — и чат появится.",
             reply_markup=kb_back("menu")
         )
@@ -1177,20 +3724,45 @@ async def cb_support_user(cq: CallbackQuery):
     )
     await cq.answer()
 
+def render_support_threads(cursor: tuple[int, int] | None) -> tuple[str, InlineKeyboardMarkup | None]:
+    threads, next_cursor = support_threads_page(cursor)
+    if not threads:
+        return "💬 Сообщений пока нет.", None
+    unread = sum(t[2] for t in threads)
+    head = "💬 <b>Выбери диалог</b>:"
+    if unread:
+        head += f"\n📬 Непрочитанных на странице: <b>{unread}</b>"
+    return head, kb_support_threads(threads, next_cursor, first_page=cursor is None)
+
 @dp.callback_query(F.data == "support_admin")
 async def cb_support_admin(cq: CallbackQuery, state: FSMContext):
     if not is_admin(cq.from_user.id):
         await cq.answer("Нет доступа", show_alert=True)
         return
 
-    users = support_users_list()
-    if not users:
-        await cq.message.edit_text("💬 Сообщений пока нет.", reply_markup=kb_back("menu"))
+    text, kb = render_support_threads(None)
+    if kb is None:
+        await cq.message.edit_text(text, reply_markup=kb_back("menu"))
         await cq.answer()
         return
 
     await state.set_state(AdminStates.waiting_support_reply_pick)
-    await cq.message.edit_text("💬 <b>Выбери пользователя</b>:", reply_markup=kb_support_admin_users(users))
+    await cq.message.edit_text(text, reply_markup=kb)
+    await cq.answer()
+
+@dp.callback_query(F.data.startswith("sup_page:"))
+async def cb_support_page(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    try:
+        _, last_ts_s, uid_s = cq.data.split(":")
+        cursor = (int(last_ts_s), int(uid_s))
+    except Exception:
+        await cq.answer()
+        return
+    text, kb = render_support_threads(cursor)
+    await cq.message.edit_text(text, reply_markup=kb or kb_back("support_admin"))
     await cq.answer()
 
 @dp.callback_query(F.data.startswith("sup_user:"))
@@ -1202,12 +3774,33 @@ async def cb_sup_user_pick(cq: CallbackQuery, state: FSMContext):
     uid = int(cq.data.split(":")[1])
     await state.update_data(support_uid=uid)
     await state.set_state(AdminStates.waiting_support_reply_text)
-    await cq.message.edit_text(
-        f"✍️ Напиши ответ пользователю <code>{uid}</code>:",
-        reply_markup=kb_back("support_admin")
-    )
+
+    lines = [f"💬 <b>Диалог с</b> <code>{uid}</code>", ""]
+    for direction, text, created in support_thread_messages(uid):
+        arrow = "⬅️" if direction == "in" else "➡️"
+        body = html.escape(text[:300]) if text else "<i>[медиа]</i>"
+        lines.append(f"{arrow} <i>{fmt_dt(created)}</i>\n{body}")
+    lines += ["", "✍️ Напиши ответ (текст или медиа) — или ответь reply'ем на пересланное сообщение."]
+    support_mark_read(uid)
+
+    await cq.message.edit_text("\n".join(lines)[:4000], reply_markup=kb_back("support_admin"))
     await cq.answer()
 
+async def send_support_reply(uid: int, msg: Message) -> bool:
+    # ответ админа пользователю: текст — одним сообщением, медиа — заголовок + копия
+    try:
+        if msg.text:
+            await SENDER.call(lambda: bot.send_message(
+                uid, f"💬 <b>Ответ администратора:</b>\n\n{html.escape(msg.text)}"
+            ))
+        else:
+            await SENDER.call(lambda: bot.send_message(uid, "💬 <b>Ответ администратора:</b>"))
+            await SENDER.call(lambda: bot.copy_message(uid, msg.chat.id, msg.message_id))
+    except Exception:
+        return False
+    support_log_out(uid, msg.chat.id, msg.message_id, msg.text or msg.caption)
+    return True
+
 @dp.message(AdminStates.waiting_support_reply_text)
 async def st_sup_reply(msg: Message, state: FSMContext):
     if msg.chat.type != "private" or not is_admin(msg.from_user.id):
@@ -1222,11 +3815,100 @@ async def st_sup_reply(msg: Message, state: FSMContext):
         return
 
     try:
-        await bot.send_message(uid, f"💬 <b>Ответ администратора:</b>\n\n{msg.text or ''}")
-        await msg.answer("✅ Отправлено.", reply_markup=kb_main(True))
+        ok = await send_support_reply(uid, msg)
+        await msg.answer("✅ Отправлено." if ok else "❌ Не удалось отправить.", reply_markup=kb_main(True))
     finally:
         await state.clear()
 
+@dp.message(F.chat.type == "private", F.reply_to_message, lambda m: m.from_user and is_admin(m.from_user.id))
+async def admin_reply_to_relay(msg: Message):
+    # админ ответил reply'ем на пересланное ботом сообщение — отправляем ответ пользователю
+    uid = support_relay_user(msg.chat.id, msg.reply_to_message.message_id)
+    if uid is None:
+        raise SkipHandler()
+    ok = await send_support_reply(uid, msg)
+    await msg.reply("✅ Отправлено." if ok else "❌ Не удалось отправить.")
+
+
+# ----- пересылка входящих админам (с дебаунсом) -----
+SUPPORT_LAST_RELAY: dict[int, float] = {}      # uid -> monotonic() последней пересылки
+SUPPORT_SUPPRESSED: dict[int, int] = {}        # uid -> сколько сообщений накопилось в окне
+
+async def relay_to_admins(msg: Message):
+    u = msg.from_user
+    uname = f"@{u.username}" if u.username else ""
+    header = (
+        f"📩 <b>Сообщение от пользователя</b>\n"
+        f"🆔 <code>{u.id}</code> {uname}"
+    )
+
+    async def relay(aid: int):
+        if msg.text:
+            sent = await SENDER.call(lambda: bot.send_message(aid, f"{header}\n\n{html.escape(msg.text)}"))
+            support_relay_add(aid, sent.message_id, u.id)
+            return
+        sent = await SENDER.call(lambda: bot.send_message(aid, header))
+        support_relay_add(aid, sent.message_id, u.id)
+        copied = await SENDER.call(lambda: bot.copy_message(aid, msg.chat.id, msg.message_id))
+        support_relay_add(aid, copied.message_id, u.id)
+
+    await asyncio.gather(*(relay(aid) for aid in ADMIN_IDS), return_exceptions=True)
+
+async def relay_summary_later(uid: int, username: str | None):
+    # в конце окна — одна сводка вместо N пересылок
+    await asyncio.sleep(SUPPORT_DEBOUNCE_SECONDS)
+    count = SUPPORT_SUPPRESSED.pop(uid, 0)
+    if not count:
+        return
+    SUPPORT_LAST_RELAY[uid] = time.monotonic()
+    uname = f"@{username}" if username else ""
+    text = (
+        f"📩 Ещё <b>{count}</b> сообщ. от <code>{uid}</code> {uname}\n"
+        "Открой 💬 Сообщения или ответь reply'ем."
+    )
+
+    async def relay(aid: int):
+        sent = await SENDER.call(lambda: bot.send_message(aid, text))
+        support_relay_add(aid, sent.message_id, uid)
+
+    await asyncio.gather(*(relay(aid) for aid in ADMIN_IDS), return_exceptions=True)
+
+async def support_incoming(msg: Message):
+    u = msg.from_user
+    support_log_in(u.id, u.username, msg.chat.id, msg.message_id, msg.text or msg.caption)
+    last = SUPPORT_LAST_RELAY.get(u.id, 0.0)
+    if time.monotonic() - last < SUPPORT_DEBOUNCE_SECONDS:
+        if u.id not in SUPPORT_SUPPRESSED:
+            SUPPORT_SUPPRESSED[u.id] = 0
+            spawn(relay_summary_later(u.id, u.username))
+        SUPPORT_SUPPRESSED[u.id] += 1
+        return
+    SUPPORT_LAST_RELAY[u.id] = time.monotonic()
+    await relay_to_admins(msg)
+
+def support_evict_idle():
+    cutoff = time.monotonic() - SUPPORT_DEBOUNCE_SECONDS
+    for uid in [k for k, v in SUPPORT_LAST_RELAY.items() if v < cutoff and k not in SUPPORT_SUPPRESSED]:
+        del SUPPORT_LAST_RELAY[uid]
+
+MAINTENANCE_HOOKS.append(support_evict_idle)
+
+def support_messages_trim():
+    # id растёт вместе с created_ts: ищем первое свежее сообщение по id (просматриваются
+    # только старые строки, которые тут же удаляются) и удаляем всё до него
+    cutoff = ts() - SUPPORT_HISTORY_DAYS * 24 * 60 * 60
+    con = db()
+    con.execute(
+        "DELETE FROM support_messages WHERE id < COALESCE("
+        "(SELECT id FROM support_messages WHERE created_ts >= ? ORDER BY id LIMIT 1), "
+        "(SELECT MAX(id) + 1 FROM support_messages))",
+        (cutoff,)
+    )
+    con.commit()
+    con.close()
+
+MAINTENANCE_HOOKS.append(support_messages_trim)
+
 
 # =========================
 # PRIVATE CATCHALL (ЛС)
@@ -1239,22 +3921,72 @@ async def private_catchall(msg: Message):
             await msg.answer("ℹ️ Нажми /start чтобы открыть меню.")
             return
 
-    support_touch_user(msg.from_user.id)
-    for aid in ADMIN_IDS:
-        try:
-            uname = f"@{msg.from_user.username}" if msg.from_user.username else ""
-            await bot.send_message(
-                aid,
-                f"📩 <b>Сообщение от пользователя</b>\n"
-                f"🆔 <code>{msg.from_user.id}</code> {uname}\n\n"
-                f"{msg.text or ''}"
-            )
-        except Exception:
-            pass
+    username_observe(msg.from_user.id, msg.from_user.username)
+    await support_incoming(msg)
 
     await msg.answer("✅ Сообщение отправлено админу.", reply_markup=kb_main(is_admin(msg.from_user.id)))
 
 
+# =========================
+# ЛС: Диагностика (трассировка / профайлер)
+# =========================
+async def render_diag() -> str:
+    lines = [
+        "🛠 <b>Диагностика</b>",
+        "",
+        f"Порог медленного апдейта: <b>{TRACE_SLOW_MS} мс</b>",
+        f"Под профайлером: <b>{int(PROFILE_SAMPLE_RATE * 100)}%</b> апдейтов",
+    ]
+    chats = get_known_chats()[:10]
+    if chats:
+        counts = await asyncio.gather(*(chat_member_count(cid) for cid, _ in chats))
+        lines += ["", "👥 <b>Чаты:</b>"]
+        for (cid, title), count in zip(chats, counts):
+            lines.append(f"• {html.escape(title or str(cid))} — {count if count is not None else '?'} участн.")
+    if SLOW_CAPTURES:
+        lines += ["", "🐢 <b>Медленные апдейты:</b>"]
+        for cap in SLOW_CAPTURES[-5:]:
+            top = max(cap["stages"].items(), key=lambda kv: kv[1], default=("—", 0))
+            lines.append(f"• <code>{cap['trace_id']}</code> {cap['total_ms']:.0f} мс (дольше всего: {top[0]})")
+    return "\n".join(lines)
+
+@dp.callback_query(F.data == "diag")
+async def cb_diag(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    await cq.message.edit_text(await render_diag(), reply_markup=kb_diag())
+    await cq.answer()
+
+@dp.callback_query(F.data.startswith("diag_toggle:"))
+async def cb_diag_toggle(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    key = cq.data.split(":")[1]
+    if key in DIAG:
+        DIAG[key] = not DIAG[key]
+    await cq.message.edit_text(await render_diag(), reply_markup=kb_diag())
+    await cq.answer("Включено" if DIAG.get(key) else "Выключено")
+
+@dp.callback_query(F.data == "diag_last")
+async def cb_diag_last(cq: CallbackQuery):
+    if not is_admin(cq.from_user.id):
+        await cq.answer("Нет доступа", show_alert=True)
+        return
+    if not SLOW_CAPTURES:
+        await cq.answer("Медленных апдейтов пока не было", show_alert=True)
+        return
+    cap = SLOW_CAPTURES[-1]
+    report = profile_top(cap["path"])
+    safe = report.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    await cq.message.answer(
+        f"📄 <b>Профиль</b> <code>{cap['trace_id']}</code> ({cap['total_ms']:.0f} мс)\n"
+        f"<pre>{safe[:3500]}</pre>"
+    )
+    await cq.answer()
+
+
 # =========================
 # CALLBACK: regrant
 # =========================
@@ -1271,8 +4003,8 @@ async def cb_regrant(cq: CallbackQuery):
         await cq.answer()
         return
 
-    permit_set(chat_id, user_id, None)
-    cooldown_warn_reset(chat_id, user_id)
+    await permit_set(chat_id, user_id, None)
+    await cooldown_warn_reset(chat_id, user_id)
 
     try:
         await cq.message.edit_text((cq.message.html_text or "") + "\n\n✅ <b>Разрешение снова выдано.</b>")
@@ -1291,23 +4023,651 @@ async def cb_noop(cq: CallbackQuery):
     await cq.answer("Ок")
 
 
+# =========================
+# КАРТИНКИ: QR / OCR
+# =========================
+def scan_image_bytes(data: bytes, ocr: bool, lang: str) -> str:
+    # выполняется в отдельном процессе; импорты здесь, чтобы бот стартовал и без этих библиотек
+    import io
+    from PIL import Image
+
+    img = Image.open(io.BytesIO(data))
+    img.load()
+    parts: list[str] = []
+    try:
+        from pyzbar.pyzbar import decode
+        parts += [r.data.decode("utf-8", "ignore") for r in decode(img)]
+    except ImportError:
+        try:
+            import cv2
+            import numpy as np
+            arr = cv2.cvtColor(np.array(img.convert("RGB")), cv2.COLOR_RGB2BGR)
+            ok, decoded, _, _ = cv2.QRCodeDetector().detectAndDecodeMulti(arr)
+            if ok:
+                parts += [d for d in decoded if d]
+        except ImportError:
+            pass
+    if ocr:
+        try:
+            import pytesseract
+            parts.append(pytesseract.image_to_string(img, lang=lang))
+        except ImportError:
+            pass
+    return "\n".join(p.strip() for p in parts if p and p.strip())
+
+def pick_photo_size(sizes: list):
+    # Telegram отдаёт размеры от меньшего к большему
+    for size in sizes:
+        if min(size.width, size.height) >= IMAGE_MIN_SIDE:
+            return size
+    return sizes[-1]
+
+M_IMAGE_SCANS = Counter("mcbot_image_scans_total", "Image scan outcomes", ("result",))
+M_IMAGE_SECONDS = Histogram("mcbot_image_scan_seconds", "Download + decode time per image")
+
+class ImageScanner:
+    """
+    Очередь (ограниченная) → воркеры → пул процессов.
+    Результат кэшируется по file_unique_id (память + таблица image_scans), так что
+    одна и та же картинка, разосланная по чатам, обрабатывается один раз.
+    """
+
+    def __init__(self):
+        self.cache = LRUCache(IMAGE_CACHE_SIZE)
+        self.queue: asyncio.Queue | None = None
+        self.pool = None
+        self.workers: list[asyncio.Task] = []
+        self.inflight: dict[str, asyncio.Future] = {}
+        self.wb = WriteBehind("INSERT OR REPLACE INTO image_scans(file_unique_id, text, created_ts) VALUES (?,?,?)")
+
+    async def start(self):
+        import importlib.util
+        from concurrent.futures import ProcessPoolExecutor
+        if importlib.util.find_spec("PIL") is None:
+            logging.warning("IMAGE_SCAN_ENABLED, но Pillow не установлен — сканирование картинок выключено")
+            return
+        self.queue = asyncio.Queue(maxsize=IMAGE_SCAN_QUEUE_SIZE)
+        self.pool = ProcessPoolExecutor(max_workers=IMAGE_SCAN_WORKERS)
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(IMAGE_SCAN_WORKERS)]
+
+    async def stop(self):
+        for w in self.workers:
+            w.cancel()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+
+    def cached(self, key: str) -> str | None:
+        text = self.cache.get(key)
+        if text is not None:
+            return text
+        pending = self.wb.pending.get(key)
+        if pending is not None:
+            return pending[1]
+        con = db()
+        row = con.execute("SELECT text FROM image_scans WHERE file_unique_id=?", (key,)).fetchone()
+        con.close()
+        if row is None:
+            return None
+        self.cache.set(key, row[0])
+        return row[0]
+
+    async def scan(self, size) -> str | None:
+        """Текст с картинки (QR + OCR) или None, если не успели / очередь полна / сканер выключен."""
+        if self.queue is None:
+            return None
+        key = size.file_unique_id
+        text = self.cached(key)
+        if text is not None:
+            M_IMAGE_SCANS.inc("cached")
+            return text
+        fut = self.inflight.get(key)
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            try:
+                self.queue.put_nowait((size, fut))
+            except asyncio.QueueFull:
+                M_IMAGE_SCANS.inc("dropped")
+                return None
+            self.inflight[key] = fut
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), IMAGE_SCAN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            M_IMAGE_SCANS.inc("timeout")
+            return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            size, fut = await self.queue.get()
+            key = size.file_unique_id
+            start = time.perf_counter()
+            try:
+                buf = await bot.download(size.file_id, timeout=IMAGE_SCAN_TIMEOUT_SECONDS)
+                # зависший процесс так не убить, но бот дальше не ждёт; пул ограничен IMAGE_SCAN_WORKERS
+                text = await asyncio.wait_for(
+                    loop.run_in_executor(self.pool, scan_image_bytes, buf.getvalue(), IMAGE_OCR_ENABLED, IMAGE_OCR_LANG),
+                    IMAGE_SCAN_TIMEOUT_SECONDS,
+                )
+                self.cache.set(key, text)
+                self.wb.put(key, (key, text, ts()))
+                M_IMAGE_SCANS.inc("scanned")
+            except Exception:
+                logging.exception("image scan failed")
+                M_IMAGE_SCANS.inc("error")
+                text = None
+            finally:
+                M_IMAGE_SECONDS.observe(time.perf_counter() - start)
+                self.inflight.pop(key, None)
+                self.queue.task_done()
+            if not fut.done():
+                fut.set_result(text)
+
+IMAGE_SCANNER = ImageScanner()
+
+Gauge("mcbot_image_scan_queue", "Images waiting for a scan worker",
+      lambda: IMAGE_SCANNER.queue.qsize() if IMAGE_SCANNER.queue else 0)
+
+
+# =========================
+# СПАМ-МОДЕЛЬ: хэшированные символьные n-граммы
+# =========================
+# Логистическая регрессия по n-граммам символов (хэш в 2^bits корзин).
+# Обучение: python bot.py train-spam — реклама из deleted_ads_log, чистые из clean_samples.
+# В работе — дополнительный сигнал после правил: сообщения, пришедшие в пределах
+# SPAM_BATCH_WINDOW_MS, считаются одним векторным проходом NumPy.
+# Без numpy или без файла модели шаг просто выключен.
+SPAM_DIGITS_RE = re.compile(r"\d")
+SPAM_SPACES_RE = re.compile(r"\s+")
+
+def spam_normalize(text: str) -> str:
+    # цифры в одну, без хэштега (его ставят и честные рекламщики), пробелы схлопнуты
+    t = (text or "").lower().replace(HASHTAG, " ")
+    t = SPAM_DIGITS_RE.sub("0", t)
+    return " " + SPAM_SPACES_RE.sub(" ", t).strip() + " "
+
+def spam_features(np, texts: list[str], sizes: tuple[int, ...], bits: int):
+    """
+    (индексы корзин, номер текста для каждого индекса, число n-грамм в каждом тексте).
+    Все тексты склеены в один массив кодов; n-граммы на стыке двух текстов отбрасываются.
+    """
+    norm = [spam_normalize(t) for t in texts]
+    codes = np.frombuffer("".join(norm).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    docs = np.repeat(np.arange(len(norm)), [len(t) for t in norm])
+    mask = np.uint64((1 << bits) - 1)
+    idx_parts, doc_parts = [], []
+    n = len(codes)
+    for k in sizes:
+        if n < k:
+            continue
+        m = n - k + 1
+        h = np.full(m, k, dtype=np.uint64)
+        for j in range(k):
+            h = h * np.uint64(1_000_003) + codes[j:j + m]
+        valid = docs[:m] == docs[k - 1:]
+        h = h[valid]
+        h ^= h >> np.uint64(31)
+        h *= np.uint64(0x9E3779B97F4A7C15)
+        h ^= h >> np.uint64(29)
+        idx_parts.append((h & mask).astype(np.int64))
+        doc_parts.append(docs[:m][valid])
+    idx = np.concatenate(idx_parts) if idx_parts else np.zeros(0, dtype=np.int64)
+    doc = np.concatenate(doc_parts) if doc_parts else np.zeros(0, dtype=np.int64)
+    counts = np.bincount(doc, minlength=len(norm))
+    return idx, doc, counts
+
+
+class SpamModel:
+    def __init__(self, np, weights, bias: float, sizes: tuple[int, ...], bits: int):
+        self.np = np
+        self.weights = weights
+        self.bias = bias
+        self.sizes = sizes
+        self.bits = bits
+
+    @classmethod
+    def load(cls, path: str) -> "SpamModel | None":
+        if not os.path.exists(path):
+            return None
+        try:
+            import numpy as np
+        except ImportError:
+            logging.warning("spam model %s found, but numpy is not installed — model disabled", path)
+            return None
+        data = np.load(path)
+        return cls(np, data["weights"].astype(np.float32), float(data["bias"]),
+                   tuple(int(x) for x in data["sizes"]), int(data["bits"]))
+
+    def save(self, path: str):
+        self.np.savez_compressed(path, weights=self.weights.astype(self.np.float16), bias=self.bias,
+                                 sizes=self.np.array(self.sizes), bits=self.bits)
+
+    def scores(self, texts: list[str]) -> list[float]:
+        np = self.np
+        idx, doc, counts = spam_features(np, texts, self.sizes, self.bits)
+        z = self.bias + np.bincount(doc, weights=self.weights[idx], minlength=len(texts)) / np.sqrt(np.maximum(counts, 1))
+        return (1.0 / (1.0 + np.exp(-z))).tolist()
+
+
+class SpamScorer:
+    """Микро-батчинг: score() ждёт до SPAM_BATCH_WINDOW_MS, чтобы посчитать пачку за раз."""
+
+    def __init__(self):
+        self.model: SpamModel | None = None
+        self.pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+
+    def load(self, path: str):
+        self.model = SpamModel.load(path)
+        if self.model:
+            logging.info("spam model loaded: 2^%d buckets, n-grams %s", self.model.bits, self.model.sizes)
+
+    async def score(self, text: str) -> float:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((text, fut))
+        if len(self.pending) >= SPAM_BATCH_MAX:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(SPAM_BATCH_WINDOW_MS / 1000, self._flush)
+        return await fut
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        start = time.perf_counter()
+        try:
+            scores = self.model.scores([t for t, _ in batch])
+        except Exception as e:
+            logging.exception("spam model failed")
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+        M_SPAM_BATCH.observe(len(batch))
+        M_SPAM_SECONDS.observe(time.perf_counter() - start)
+        for (_, fut), p in zip(batch, scores):
+            if not fut.done():
+                fut.set_result(p)
+
+SPAM_SCORER = SpamScorer()
+M_SPAM_SECONDS = Histogram("mcbot_spam_model_seconds", "Spam model time per micro-batch")
+M_SPAM_BATCH = Histogram("mcbot_spam_model_batch", "Messages per spam model micro-batch",
+                         buckets=(1, 2, 4, 8, 16, 32, 64))
+
+# чистые сообщения для обучения: случайная выборка, без автора
+_clean_samples_wb = WriteBehind("INSERT OR IGNORE INTO clean_samples(key, text, created_ts) VALUES (?,?,?)")
+
+def clean_sample_observe(chat_id: int, message_id: int, text: str):
+    if len(text) >= 8 and random.random() < SPAM_CLEAN_SAMPLE_RATE:
+        key = f"{chat_id}:{message_id}"
+        _clean_samples_wb.put(key, (key, text[:280], ts()))
+
+def clean_samples_trim():
+    con = db()
+    con.execute(
+        "DELETE FROM clean_samples WHERE rowid <= (SELECT MAX(rowid) FROM clean_samples) - ?",
+        (SPAM_CLEAN_SAMPLE_MAX,)
+    )
+    con.commit()
+    con.close()
+
+MAINTENANCE_HOOKS.append(clean_samples_trim)
+
+
+def train_spam_model(out_path: str, epochs: int = 300, bits: int = SPAM_HASH_BITS, sizes: tuple[int, ...] = (2, 3, 4)):
+    import numpy as np
+
+    con = db()
+    ads = [r[0] for r in con.execute("SELECT text_snip FROM deleted_ads_log WHERE text_snip != ''")]
+    clean = [r[0] for r in con.execute("SELECT text FROM clean_samples")]
+    con.close()
+    if len(ads) < 20 or len(clean) < 20:
+        raise SystemExit(f"мало данных: {len(ads)} рекламных и {len(clean)} чистых (нужно хотя бы по 20)")
+
+    texts = ads + clean
+    y = np.array([1.0] * len(ads) + [0.0] * len(clean))
+    order = np.random.default_rng(1).permutation(len(texts))
+    n_test = max(1, len(texts) // 10)
+    test, train = order[:n_test], order[n_test:]
+
+    def featurize(rows):
+        idx, doc, counts = spam_features(np, [texts[i] for i in rows], sizes, bits)
+        return idx, doc, 1.0 / np.sqrt(np.maximum(counts, 1))[doc]
+
+    idx, doc, val = featurize(train)
+    yt = y[train]
+    n, dim = len(train), 1 << bits
+    # классы уравниваем весами: рекламы в логе обычно больше, чем чистой выборки
+    cw = np.where(yt > 0, 0.5 / max(yt.mean(), 1e-9), 0.5 / max(1 - yt.mean(), 1e-9))
+    w = np.zeros(dim)
+    b = 0.0
+    g2 = np.zeros(dim)
+    for _ in range(epochs):
+        z = b + np.bincount(doc, weights=w[idx] * val, minlength=n)
+        err = (1.0 / (1.0 + np.exp(-z)) - yt) * cw
+        grad = np.bincount(idx, weights=err[doc] * val, minlength=dim) / n + 1e-6 * w
+        g2 += grad * grad
+        w -= 0.5 * grad / (np.sqrt(g2) + 1e-8)   # AdaGrad: редкие n-граммы учатся быстрее
+        b -= 0.5 * err.mean()
+
+    model = SpamModel(np, w.astype(np.float32), float(b), sizes, bits)
+    p = np.array(model.scores([texts[i] for i in test]))
+    yv = y[test]
+    for thr in (0.5, SPAM_THRESHOLD):
+        pred = p >= thr
+        tp = int((pred & (yv > 0)).sum())
+        prec = tp / max(int(pred.sum()), 1)
+        rec = tp / max(int((yv > 0).sum()), 1)
+        print(f"threshold {thr:.2f}: precision {prec:.3f}, recall {rec:.3f} on {len(test)} held-out messages")
+    model.save(out_path)
+    print(f"saved {out_path}: {len(ads)} ads, {len(clean)} clean, 2^{bits} buckets")
+
+
 # =========================
 # АНТИ-РЕКЛАМА: общая логика (для msg и edited_message)
 # =========================
+# ----- флуд в группах -----
+class FloodTracker:
+    """
+    Последние FLOOD_RING_SIZE сообщений (чат, юзер) в кольцевых буферах: отпечаток
+    текста, время, message_id. counts — сколько раз отпечаток встречается в окне,
+    поэтому и повтор, и очередь проверяются за O(1) на сообщение.
+    """
+
+    __slots__ = ("prints", "times", "ids", "head", "size", "counts", "last", "group")
+
+    def __init__(self, size: int):
+        self.prints = [0] * size
+        self.times = [0.0] * size
+        self.ids = [0] * size
+        self.head = 0     # индекс самого старого
+        self.size = 0
+        self.counts: dict[int, int] = {}
+        self.last = 0.0
+        self.group: str | None = None   # media_group_id последнего альбома
+
+    def _drop_oldest(self):
+        fp = self.prints[self.head]
+        left = self.counts[fp] - 1
+        if left:
+            self.counts[fp] = left
+        else:
+            del self.counts[fp]
+        self.head = (self.head + 1) % len(self.prints)
+        self.size -= 1
+
+    def add(self, fp: int, now: float, message_id: int) -> str | None:
+        n = len(self.prints)
+        while self.size and now - self.times[self.head] > FLOOD_WINDOW_SECONDS:
+            self._drop_oldest()
+        if self.size == n:
+            self._drop_oldest()
+        i = (self.head + self.size) % n
+        self.prints[i], self.times[i], self.ids[i] = fp, now, message_id
+        self.size += 1
+        self.counts[fp] = self.counts.get(fp, 0) + 1
+        self.last = now
+        if self.counts[fp] >= FLOOD_DUPLICATES:
+            return "duplicate"
+        if self.size >= FLOOD_BURST_MESSAGES and now - self.times[(i - FLOOD_BURST_MESSAGES + 1) % n] <= FLOOD_BURST_SECONDS:
+            return "burst"
+        return None
+
+    def message_ids(self, fp: int | None = None) -> list[int]:
+        n = len(self.prints)
+        idx = ((self.head + k) % n for k in range(self.size))
+        return [self.ids[i] for i in idx if fp is None or self.prints[i] == fp]
+
+    def reset(self):
+        self.head = self.size = 0
+        self.counts.clear()
+
+FLOOD_TRACKERS: OrderedDict[tuple[int, int], FloodTracker] = OrderedDict()   # по давности последнего сообщения
+M_FLOOD = Counter("mcbot_flood_total", "Group flood detections by kind (duplicate/burst)", ("kind",))
+
+def flood_fingerprint(msg: Message) -> int | None:
+    text = msg.text or msg.caption
+    if text:
+        return hash(" ".join(text.lower().split()))
+    media = msg.sticker or msg.animation or (msg.photo[-1] if msg.photo else None) or msg.video or msg.voice
+    if media is not None:
+        return hash(media.file_unique_id)
+    return None   # служебные сообщения не считаем
+
+def flood_observe(msg: Message) -> tuple[str, list[int]] | None:
+    """(вид флуда, какие сообщения удалить) или None."""
+    # автопересылки из канала и посты от имени чата/канала: у всех один from_user
+    # (777000, GroupAnonymousBot) — это не один человек
+    if msg.is_automatic_forward or msg.sender_chat is not None:
+        return None
+    fp = flood_fingerprint(msg)
+    if fp is None:
+        return None
+    key = (msg.chat.id, msg.from_user.id)
+    tracker = FLOOD_TRACKERS.get(key)
+    if tracker is None:
+        tracker = FLOOD_TRACKERS[key] = FloodTracker(FLOOD_RING_SIZE)
+        if len(FLOOD_TRACKERS) > FLOOD_MAX_TRACKERS:
+            FLOOD_TRACKERS.popitem(last=False)
+    else:
+        FLOOD_TRACKERS.move_to_end(key)
+    if msg.media_group_id is not None:
+        # альбом (до 10 фото) — одно событие: считаем только первый элемент
+        if tracker.group == msg.media_group_id:
+            return None
+        tracker.group = msg.media_group_id
+    kind = tracker.add(fp, time.monotonic(), msg.message_id)
+    if kind is None:
+        return None
+    ids = tracker.message_ids(fp if kind == "duplicate" else None)
+    # следующая ступень — только за новый эпизод флуда
+    tracker.reset()
+    return kind, ids
+
+def flood_evict_idle():
+    cutoff = time.monotonic() - FLOOD_WINDOW_SECONDS
+    while FLOOD_TRACKERS:
+        key, tracker = next(iter(FLOOD_TRACKERS.items()))
+        if tracker.last >= cutoff:
+            break
+        del FLOOD_TRACKERS[key]
+
+MAINTENANCE_HOOKS.append(flood_evict_idle)
+
+async def handle_flood(msg: Message) -> bool:
+    flood = flood_observe(msg)
+    if flood is None or await is_chat_admin(msg):
+        return False
+    kind, ids = flood
+    M_FLOOD.inc(kind)
+    chat_id, uid = msg.chat.id, msg.from_user.id
+    can_delete, _ = await bot_rights(chat_id)
+    deleted = False
+    if can_delete:
+        try:
+            deleted = await bot.delete_messages(chat_id, ids[-100:])
+        except Exception:
+            # думали, что права есть, — перепроверим при следующем сообщении
+            chat_meta(chat_id).bot_member_at = 0.0
+    if not deleted:
+        # ничего не удалили — не копим страйки за флуд, который остался в чате
+        await ensure_delete_warning(chat_id)
+        return True
+    reason = "флуд (одинаковые сообщения)" if kind == "duplicate" else "флуд (слишком много сообщений подряд)"
+    await punish_stage(chat_id, uid, mention_html(uid, msg.from_user.full_name), reason)
+    return True
+
+
+# ----- лестница наказаний (реклама без разрешения, флуд) -----
+PERMIT_HINT = (
+    f"\nПолучить разрешение можно в боте: {SUPPORT_BOT_FOR_PERMIT}\n"
+    f'В разделе "Связь с админом".'
+)
+
+async def punish_stage(chat_id: int, uid: int, user_mention: str, reason: str, edit_tag: str = "", hint: str = ""):
+    # атомарно: два экземпляра бота не выдадут одну и ту же стадию дважды
+    stage = await ad_stage_incr(chat_id, uid) - 1
+
+    if stage == 0:
+        if AD_WARN_STICKER_ID:
+            try:
+                await bot.send_sticker(chat_id, AD_WARN_STICKER_ID)
+            except Exception:
+                pass
+
+        await bot.send_message(
+            chat_id,
+            f"{user_mention}, ваше сообщение удалено{edit_tag}.\n"
+            f"Причина: {reason}\n"
+            f"Правила: {RULES_LINK}{hint}"
+        )
+        return
+
+    secs, label = (MUTE_2_SECONDS, "3 часа") if stage == 1 else (MUTE_3_SECONDS, "12 часов")
+    try:
+        muted = await apply_mute(chat_id, uid, secs)
+    except Exception:
+        muted = False
+    if not muted:
+        # мут не выдан (нет права — админам уже написали): не пишем в чат, что он есть,
+        # и откатываем ступень — следующее нарушение снова попадёт на эту же
+        await ad_stage_incr(chat_id, uid, -1)
+        await bot.send_message(
+            chat_id,
+            f"⚠️ {user_mention}, нарушение{edit_tag}.\n"
+            f"Причина: {reason}\n"
+            f"Правила: {RULES_LINK}{hint}"
+        )
+        return
+    # авто-мут записываем с issued_by=0: его видно в /mclist и можно снять пачкой из ЛС
+    await mc_upsert(chat_id, uid, username_of(uid), "mute", ts() + secs, f"Авто: {reason}", 0, 1)
+    if stage == 1:
+        await bot.send_message(
+            chat_id,
+            f"🔇 {user_mention} — мут на <b>{label}</b>{edit_tag}.\n"
+            f"Причина: {reason}\n"
+            f"Правила: {RULES_LINK}{hint}"
+        )
+    else:
+        await ad_stage_set(chat_id, uid, 0)
+        await bot.send_message(
+            chat_id,
+            f"🔇 {user_mention} — мут на <b>{label}</b>{edit_tag}.\n"
+            f"Причина: {reason}\n"
+            f"Правила: {RULES_LINK}{hint}\n\n"
+            f"✅ Счётчик нарушений сброшен."
+        )
+
+
 async def handle_ad_check(msg: Message, edited: bool = False):
-    remember_chat(msg.chat.id, msg.chat.title)
+    if not edited:
+        with trace_stage("remember_chat"):
+            remember_chat(msg.chat.id, msg.chat.title)
 
     if not msg.from_user:
         return
 
+    username_observe(msg.from_user.id, msg.from_user.username)
+
     if is_command_text(msg.text) or is_command_text(msg.caption):
         return
 
+    if not edited:
+        with trace_stage("flood"):
+            if await handle_flood(msg):
+                return
+
     text = msg.text or msg.caption or ""
-    if not text:
+    extras, urls, names = extract_scan_extras(msg)
+    photo = pick_photo_size(msg.photo) if msg.photo and IMAGE_SCANNER.queue is not None else None
+    if not text and not extras and not urls and not names and photo is None:
         return
 
-    ad, reason_detail = is_ad_message(text)
+    # редактирование: текст не менялся или по сообщению уже наказали — ничего не делаем;
+    # если прошлый вердикт "чисто" — проверяем только изменённый кусок
+    seen_key = (msg.chat.id, msg.message_id)
+    text_hash = hash((text, tuple(extras), tuple(urls), tuple(names)))
+    entities = msg.entities if msg.text else msg.caption_entities
+    # запись может быть и у нового сообщения: правку доставили раньше него
+    seen = SEEN_MESSAGES.get(seen_key)
+    if seen is not None and (seen.handled or seen.text_hash == text_hash):
+        return
+    # ключ занимаем до первого await: правка, пришедшая во время проверки,
+    # видит тот же объект (и тот же handled), а не проверяет сообщение заново
+    prev = (seen.text, seen.ad) if edited and seen is not None else None
+    if seen is None:
+        seen = SeenMessage(text_hash, text, False)
+        SEEN_MESSAGES.set(seen_key, seen)
+    else:
+        seen.text_hash, seen.text = text_hash, text
+
+    # доверенным — облегчённая проверка, кроме случайной выборки
+    tier = "trusted" if trust_is_trusted(msg.chat.id, msg.from_user.id) else "new"
+    if tier == "trusted" and random.random() < TRUST_SAMPLE_RATE:
+        tier = "sampled"
+    cheap = None
+    if tier == "trusted":
+        hidden = [e.url for e in entities or () if e.url]
+        cheap = is_ad_cheap([text] + extras + names, urls + hidden)
+        # облегчённая проверка не должна ослаблять правила: ссылка/домен, #реклама
+        # или разрешение (лимит 24ч, тег в конце) — полный детектор
+        if cheap is None or has_hashtag(text) or (await permit_get(msg.chat.id, msg.from_user.id))[0]:
+            tier = "escalated"
+    M_TRUST_TIER.inc(tier)
+
+    start = time.perf_counter()
+    if tier == "trusted":
+        ad, reason_detail = cheap
+    else:
+        if prev is not None and not prev[1]:
+            main = changed_region(prev[0], text, entities)
+        else:
+            main = (text, entities)
+        items = [(x, None) for x in extras]
+        if text:
+            items.insert(0, main)
+        ad, reason_detail = is_ad_batch(items, urls, forward_origin_key(msg))
+    for name in names:
+        if ad:
+            break
+        ad, reason_detail = is_ad_name(name)
+    elapsed = time.perf_counter() - start
+    M_DETECT_SECONDS.observe(elapsed)
+    trace_add("detect", elapsed)
+
+    # картинка: текст из QR/OCR через тот же детектор
+    if not ad and photo is not None and tier != "trusted":
+        with trace_stage("image"):
+            scanned = await IMAGE_SCANNER.scan(photo)
+        if scanned:
+            ad, reason_detail = is_ad_message(scanned)
+            if ad:
+                reason_detail = f"картинка: {reason_detail}"
+                text = text or scanned
+
+    # модель: перефразированная реклама, которую не ловят правила
+    if not ad and tier != "trusted" and SPAM_SCORER.model is not None and (text or extras):
+        with trace_stage("spam_model"):
+            p = await SPAM_SCORER.score(" ".join([text] + extras))
+        if p >= SPAM_THRESHOLD:
+            ad, reason_detail = True, "похоже на рекламу (модель)"
+
+    M_AD_VERDICTS.inc(reason_detail or "clean")
+    # доверие и выборка для модели — только по вердиктам полного детектора
+    if not ad and not edited and tier != "trusted":
+        trust_clean(msg.chat.id, msg.from_user.id)
+        if text:
+            clean_sample_observe(msg.chat.id, msg.message_id, text)
+
+    seen.ad = ad
+
+    # для логов/хэштега: у контакта, стикера и т.п. своего текста нет
+    if not text:
+        text = " | ".join(extras + names + urls)
 
     if (not ad) and (not has_hashtag(text)):
         return
@@ -1317,24 +4677,28 @@ async def handle_ad_check(msg: Message, edited: bool = False):
     chat_title = msg.chat.title or ""
     user_mention = mention_html(uid, msg.from_user.full_name)
 
-    permit_ok, _permit_until, last_ad_ts = permit_get(chat_id, uid)
+    with trace_stage("permit"):
+        permit_ok, _permit_until, last_ad_ts = await permit_get(chat_id, uid)
+    if seen.handled:
+        return   # пока ждали, по этому сообщению уже наказала параллельная правка
+    # handled ставим в начале каждой ветки с действием (до await) —
+    # последующие правки этого сообщения второй раз не наказываются
     edit_tag = " (редактирование)" if edited else ""
 
     # (1) без разрешения, но пишет #реклама
     if (not permit_ok) and has_hashtag(text):
-        deleted = await try_delete(msg)
-        if not deleted:
-            await ensure_delete_warning(chat_id)
+        seen.handled = True
+        await delete_or_warn(msg)
 
         await bot.send_message(chat_id, f"❌ У вас нет разрешения на рекламу{edit_tag}.\nПолучить: {SUPPORT_BOT_FOR_PERMIT}")
-        log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"нет разрешения, но есть #реклама{edit_tag}")
+        with trace_stage("log"):
+            log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"нет разрешения, но есть #реклама{edit_tag}")
         return
 
     # (2) есть разрешение, но реклама без тега в конце
     if permit_ok and ad and (not hashtag_at_end(text)):
-        deleted = await try_delete(msg)
-        if not deleted:
-            await ensure_delete_warning(chat_id)
+        seen.handled = True
+        await delete_or_warn(msg)
 
         await bot.send_message(
             chat_id,
@@ -1342,19 +4706,20 @@ async def handle_ad_check(msg: Message, edited: bool = False):
             f"Причина: <b>нет тега {HASHTAG} в конце</b>\n"
             f"Правила: {RULES_LINK}"
         )
-        log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"разрешение есть, но тег не в конце ({reason_detail}){edit_tag}")
+        with trace_stage("log"):
+            log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"разрешение есть, но тег не в конце ({reason_detail}){edit_tag}")
         return
 
     # (3) есть разрешение и реклама — лимит 24ч
     if permit_ok and ad:
+        if seen.permitted:
+            return   # правка уже принятой рекламы — лимит за неё уже учтён
         if last_ad_ts and (ts() - last_ad_ts) < ADS_COOLDOWN_SECONDS:
-            deleted = await try_delete(msg)
-            if not deleted:
-                await ensure_delete_warning(chat_id)
+            seen.handled = True
+            await delete_or_warn(msg)
 
             left = ADS_COOLDOWN_SECONDS - (ts() - last_ad_ts)
-            warn_count = cooldown_warn_get(chat_id, uid) + 1
-            cooldown_warn_set(chat_id, uid, warn_count)
+            warn_count = await cooldown_warn_incr(chat_id, uid)
 
             await bot.send_message(
                 chat_id,
@@ -1363,11 +4728,12 @@ async def handle_ad_check(msg: Message, edited: bool = False):
                 f"⚠️ Вы получили предупреждение <b>{min(warn_count, 3)}/3</b>."
             )
 
-            log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"лимит 24 часа (попытка {warn_count}){edit_tag}")
+            with trace_stage("log"):
+                log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"лимит 24 часа (попытка {warn_count}){edit_tag}")
 
             if warn_count > 3:
-                permit_remove(chat_id, uid)
-                cooldown_warn_reset(chat_id, uid)
+                await permit_remove(chat_id, uid)
+                await cooldown_warn_reset(chat_id, uid)
 
                 info = (
                     f"🚫 <b>Разрешение снято</b>\n\n"
@@ -1382,81 +4748,160 @@ async def handle_ad_check(msg: Message, edited: bool = False):
 
             return
 
-        permit_touch_last_ad(chat_id, uid)
-        cooldown_warn_reset(chat_id, uid)
+        seen.permitted = True
+        await permit_touch_last_ad(chat_id, uid)
+        await cooldown_warn_reset(chat_id, uid)
         return
 
     # (4) нет разрешения и реклама — стадии
     if (not permit_ok) and ad:
-        deleted = await try_delete(msg)
-        if not deleted:
-            await ensure_delete_warning(chat_id)
+        seen.handled = True
+        await delete_or_warn(msg)
 
-        stage = ad_stage_get(chat_id, uid)
+        await punish_stage(chat_id, uid, user_mention, "реклама", edit_tag, PERMIT_HINT)
 
-        if stage == 0:
-            ad_stage_set(chat_id, uid, 1)
+        with trace_stage("log"):
+            log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"реклама без разрешения ({reason_detail}){edit_tag}")
+        return
 
-            if AD_WARN_STICKER_ID:
-                try:
-                    await bot.send_sticker(chat_id, AD_WARN_STICKER_ID)
-                except Exception:
-                    pass
 
-            await bot.send_message(
-                chat_id,
-                f"{user_mention}, ваше сообщение удалено{edit_tag}.\n"
-                f"Причина: реклама\n"
-                f"Правила: {RULES_LINK}\n"
-                f"Получить разрешение можно в боте: {SUPPORT_BOT_FOR_PERMIT}\n"
-                f'В разделе "Связь с админом".'
-            )
+# =========================
+# ПРОВЕРКА НОВЫХ УЧАСТНИКОВ
+# =========================
+M_JOIN_SCREEN = Counter("mcbot_join_screen_total", "Join screening outcomes (cached/clean/name/bio/dropped)", ("result",))
+
+class JoinScreener:
+    """
+    Очередь входов (из new_chat_members и chat_member). Воркер берёт до JOIN_SCREEN_BATCH
+    человек, проверяет имя и username строгим is_ad_name, для чистых — био через get_chat
+    (с лимитом JOIN_SCREEN_RATE_PER_SECOND), и действует во всех чатах, куда человек зашёл.
+    """
+
+    def __init__(self):
+        self.verdicts = LRUCache(JOIN_SCREEN_CACHE_SIZE, ttl=JOIN_SCREEN_TTL_SECONDS)   # user_id -> (ad, reason)
+        self.recent = LRUCache(JOIN_SCREEN_CACHE_SIZE, ttl=60)   # (chat_id, user_id): вход уже учли
+        self.waiting: dict[int, tuple[object, set[int]]] = {}    # user_id -> (User, чаты)
+        self.queue: asyncio.Queue | None = None
+        self.task: asyncio.Task | None = None
+        self.limiter = RateLimitedSender(JOIN_SCREEN_RATE_PER_SECOND, JOIN_SCREEN_CONCURRENCY)
+
+    def screen(self, chat_id: int, user):
+        if not JOIN_SCREEN_ENABLED or user.is_bot or is_admin(user.id):
+            return
+        # один вход приходит дважды: сервисным сообщением и chat_member
+        if (chat_id, user.id) in self.recent:
+            return
+        self.recent.set((chat_id, user.id), True)
+        verdict = self.verdicts.get(user.id)
+        if verdict is not None:
+            M_JOIN_SCREEN.inc("cached")
+            if verdict[0]:
+                spawn(self._act([(chat_id, user, verdict[1])]))
+            return
+        if user.id in self.waiting:
+            self.waiting[user.id][1].add(chat_id)
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue(JOIN_SCREEN_QUEUE_MAX)
+            self.task = asyncio.create_task(self._worker())
+        try:
+            self.queue.put_nowait(user.id)
+        except asyncio.QueueFull:
+            M_JOIN_SCREEN.inc("dropped")
+            return
+        self.waiting[user.id] = (user, {chat_id})
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
 
-        elif stage == 1:
-            ad_stage_set(chat_id, uid, 2)
+    async def _bio(self, user_id: int) -> str:
+        chat = await self.limiter.call(lambda: bot.get_chat(user_id))
+        return chat.bio or ""
+
+    async def _worker(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < JOIN_SCREEN_BATCH and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
             try:
-                await apply_mute(chat_id, uid, MUTE_2_SECONDS)
+                await self._screen_batch(batch)
             except Exception:
-                pass
-            await bot.send_message(
-                chat_id,
-                f"🔇 {user_mention} — мут на <b>3 часа</b>{edit_tag}.\n"
-                f"Причина: реклама\n"
-                f"Правила: {RULES_LINK}\n"
-                f"Получить разрешение можно в боте: {SUPPORT_BOT_FOR_PERMIT}\n"
-                f'В разделе "Связь с админом".'
+                logging.exception("join screening failed")
+            for _ in batch:
+                self.queue.task_done()
+
+    async def _screen_batch(self, user_ids: list[int]):
+        verdicts: dict[int, tuple[bool, str]] = {}
+        for uid in user_ids:
+            user, _ = self.waiting[uid]
+            ad, reason = is_ad_name(f"{user.full_name}\n{user.username or ''}")
+            verdicts[uid] = (ad, f"имя: {reason}" if ad else "")
+        if JOIN_SCREEN_BIO:
+            clean = [uid for uid in user_ids if not verdicts[uid][0]]
+            bios = await asyncio.gather(*(self._bio(uid) for uid in clean), return_exceptions=True)
+            for uid, bio in zip(clean, bios):
+                if isinstance(bio, BaseException) or not bio:
+                    continue
+                ad, reason = is_ad_name(bio, links=False)
+                if ad:
+                    verdicts[uid] = (True, f"био: {reason}")
+        flagged = []
+        for uid in user_ids:
+            user, chats = self.waiting.pop(uid)
+            ad, reason = verdicts[uid]
+            self.verdicts.set(uid, (ad, reason))
+            M_JOIN_SCREEN.inc(("name" if reason.startswith("имя") else "bio") if ad else "clean")
+            flagged.extend((chat_id, user, reason) for chat_id in chats if ad)
+        if flagged:
+            await self._act(flagged)
+
+    async def _act(self, flagged: list[tuple[int, object, str]]):
+        restrict = JOIN_SCREEN_ACTION == "restrict"
+        if restrict:
+            results = await asyncio.gather(
+                *(self.limiter.call(lambda c=chat_id, u=user.id: apply_mute(c, u, JOIN_SCREEN_RESTRICT_SECONDS))
+                  for chat_id, user, _ in flagged),
+                return_exceptions=True,
             )
         else:
-            ad_stage_set(chat_id, uid, 0)
-            try:
-                await apply_mute(chat_id, uid, MUTE_3_SECONDS)
-            except Exception:
-                pass
-            await bot.send_message(
-                chat_id,
-                f"🔇 {user_mention} — мут на <b>12 часов</b>{edit_tag}.\n"
-                f"Причина: реклама\n"
-                f"Правила: {RULES_LINK}\n"
-                f"Получить разрешение можно в боте: {SUPPORT_BOT_FOR_PERMIT}\n"
-                f'В разделе "Связь с админом".\n\n'
-                f"✅ Счётчик нарушений сброшен."
-            )
-
-        log_deleted_ad(chat_id, chat_title, uid, msg.from_user.username, text, f"реклама без разрешения ({reason_detail}){edit_tag}")
+            results = [False] * len(flagged)
+        lines = []
+        for (chat_id, user, reason), muted in zip(flagged, results):
+            muted = muted is True
+            if muted:
+                await mc_upsert(chat_id, user.id, user.username, "mute", ts() + JOIN_SCREEN_RESTRICT_SECONDS,
+                          f"реклама в профиле ({reason})", 0, 1)
+            title = html.escape(chat_meta(chat_id).title or str(chat_id))
+            tag = f"🔇 мут на {fmt_duration_left(JOIN_SCREEN_RESTRICT_SECONDS)}" if muted else "⚠️ не тронут"
+            lines.append(f"• {mention_html(user.id, user.full_name)} (<code>{user.id}</code>) в <b>{title}</b> — {tag}\n"
+                         f"  📝 {html.escape(reason)}")
+        head = f"🚪 <b>Вход с рекламой в профиле</b>: {len(flagged)}"
+        hint = "\nСнять мут: <code>/mcunmute ID</code> в чате." if restrict else ""
+        await notify_admins("\n".join([head, ""] + lines[:30] + ([f"… и ещё {len(lines) - 30}"] if len(lines) > 30 else [])) + hint)
+
+JOIN_SCREENER = JoinScreener()
+
+@dp.message(F.new_chat_members)
+async def on_new_chat_members(msg: Message):
+    if msg.chat.type not in ("group", "supergroup"):
         return
+    remember_chat(msg.chat.id, msg.chat.title)
+    for user in msg.new_chat_members:
+        JOIN_SCREENER.screen(msg.chat.id, user)
 
 
 # =========================
 # ГРУППА: АНТИ-РЕКЛАМА (новые сообщения)
 # =========================
-@dp.message(F.chat.type.in_({"group", "supergroup"}) & (F.text | F.caption))
+@dp.message(F.chat.type.in_({"group", "supergroup"}))
 async def anti_ads(msg: Message):
     await handle_ad_check(msg, edited=False)
 
 # =========================
 # ГРУППА: АНТИ-РЕКЛАМА (редактирование)
 # =========================
-@dp.edited_message(F.chat.type.in_({"group", "supergroup"}) & (F.text | F.caption))
+@dp.edited_message(F.chat.type.in_({"group", "supergroup"}))
 async def anti_ads_edited(msg: Message):
     await handle_ad_check(msg, edited=True)
 
@@ -1464,6 +4909,20 @@ async def anti_ads_edited(msg: Message):
 # =========================
 # Команды для подсказок "/"
 # =========================
+COMMANDS_HASH_KEY = "commands_hash"
+
+def bot_meta_get(key: str) -> str | None:
+    con = db()
+    row = con.execute("SELECT value FROM bot_meta WHERE key=?", (key,)).fetchone()
+    con.close()
+    return row[0] if row else None
+
+def bot_meta_set(key: str, value: str):
+    con = db()
+    con.execute("INSERT OR REPLACE INTO bot_meta(key, value) VALUES (?,?)", (key, value))
+    con.commit()
+    con.close()
+
 async def setup_commands():
     private_cmds = [
         BotCommand(command="start", description="Меню бота"),
@@ -1472,22 +4931,70 @@ async def setup_commands():
         BotCommand(command="chatid", description="Показать chat_id (в группе)"),
     ]
 
-    await bot.set_my_commands(private_cmds, scope=BotCommandScopeAllPrivateChats())
-    await bot.set_my_commands(private_cmds, scope=BotCommandScopeDefault())
+    # список команд не меняется между перезапусками — сверяем хэш и не ходим в API зря
+    spec = json.dumps([bot.id, [c.model_dump() for c in private_cmds]], ensure_ascii=False, sort_keys=True)
+    digest = hashlib.sha256(spec.encode()).hexdigest()
+    if bot_meta_get(COMMANDS_HASH_KEY) == digest:
+        logging.info("bot commands unchanged, skip set_my_commands")
+        return
 
-    # убираем подсказки в группах
-    await bot.set_my_commands([], scope=BotCommandScopeAllGroupChats())
+    await asyncio.gather(
+        bot.set_my_commands(private_cmds, scope=BotCommandScopeAllPrivateChats()),
+        bot.set_my_commands(private_cmds, scope=BotCommandScopeDefault()),
+        # убираем подсказки в группах
+        bot.set_my_commands([], scope=BotCommandScopeAllGroupChats()),
+    )
+    bot_meta_set(COMMANDS_HASH_KEY, digest)
+
+async def setup_commands_background():
+    try:
+        await setup_commands()
+    except Exception:
+        # не критично: бот модерирует и без подсказок, попробуем при следующем старте
+        logging.exception("set_my_commands failed")
 
 
 # =========================
 # MAIN
 # =========================
 async def main():
-    db().close()
-    await setup_commands()
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    # до первого getUpdates — только то, без чего нельзя модерировать:
+    # схема БД, кэши разрешений/страйков (или проверка связи с общим хранилищем), журнал апдейтов и снятие вебхука (иначе getUpdates не работает).
+    # Команды меню регистрируем параллельно с поллингом.
+    STORE.warm()
+    UPDATE_LEDGER.load()
+    trust_load()
+    SPAM_SCORER.load(SPAM_MODEL_PATH)
+    domain_index_load()
+    await bot.delete_webhook(drop_pending_updates=DROP_PENDING_UPDATES)
+    commands_task = asyncio.create_task(setup_commands_background())
+    flusher = asyncio.create_task(maintenance_loop())
+    metrics_runner = await start_metrics_server() if METRICS_ENABLED else None
+    if IMAGE_SCAN_ENABLED:
+        await IMAGE_SCANNER.start()
+    try:
+        await dp.start_polling(bot)
+    finally:
+        flusher.cancel()
+        commands_task.cancel()
+        await IMAGE_SCANNER.stop()
+        await JOIN_SCREENER.stop()
+        flush_write_behind()
+        STORE.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    import sys
+    if sys.argv[1:2] == ["train-spam"]:
+        train_spam_model(sys.argv[2] if len(sys.argv) > 2 else SPAM_MODEL_PATH)
+    elif sys.argv[1:2] == ["build-domains"]:
+        import argparse
+        ap = argparse.ArgumentParser(prog="bot.py build-domains")
+        ap.add_argument("--allow", nargs="*", default=[], help="свои/партнёрские сервера")
+        ap.add_argument("--block", nargs="*", default=[], help="блок-листы")
+        ap.add_argument("--out", default=DOMAIN_INDEX_PATH)
+        args = ap.parse_args(sys.argv[2:])
+        print(f"{args.out}: {build_domain_index(args.out, args.allow, args.block)} domains")
+    else:
+        asyncio.run(main())
@@ -0,0 +1,73 @@
+# Общие фикстуры: bot.py против заглушки Bot API (bench/fake_bot_api.py) и временной SQLite.
+# Сценарий — async-функция, env.run() крутит её в своём event loop (pytest-asyncio не нужен).
+
+import asyncio
+import itertools
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import bot as botmod  # noqa: E402
+from fake_bot_api import FakeBotAPI  # noqa: E402
+
+CHAT = {"id": -1001000000001, "type": "supergroup", "title": "MC test chat"}
+USER = {"id": 100001, "is_bot": False, "first_name": "Steve", "username": "steve"}
+
+
+class Env:
+    def __init__(self):
+        self.api = FakeBotAPI()
+        self.update_ids = itertools.count(1)
+
+    def run(self, scenario):
+        async def main():
+            base = await self.api.start()
+            botmod.bot.session.api = TelegramAPIServer.from_base(base)
+            try:
+                return await scenario()
+            finally:
+                await botmod.bot.session.close()
+                await self.api.stop()
+        return asyncio.run(main())
+
+    def message(self, text: str = "", message_id: int = 1, user: dict = USER, edit_date: int | None = None, **fields) -> dict:
+        msg = {"message_id": message_id, "date": int(time.time()), "chat": CHAT, "from": user, **fields}
+        if text:
+            msg["text"] = text
+        if edit_date is not None:
+            msg["edit_date"] = edit_date
+            return {"update_id": next(self.update_ids), "edited_message": msg}
+        return {"update_id": next(self.update_ids), "message": msg}
+
+    async def feed(self, raw: dict):
+        await botmod.dp.feed_update(botmod.bot, Update.model_validate(raw, context={"bot": botmod.bot}))
+
+
+@pytest.fixture
+def env(tmp_path, monkeypatch):
+    # своя БД и чистое состояние модулей на каждый тест
+    monkeypatch.setattr(botmod, "DB_PATH", str(tmp_path / "test.db"))
+    monkeypatch.setattr(botmod, "STORE", botmod.SqliteStore())
+    monkeypatch.setattr(botmod, "JOIN_SCREENER", botmod.JoinScreener())
+    monkeypatch.setattr(botmod, "UPDATE_LEDGER", botmod.DedupeLedger(botmod.DEDUPE_LEDGER_SIZE))
+    monkeypatch.setattr(botmod, "TRUST_SAMPLE_RATE", 0.0)
+    for cache in (botmod.SEEN_MESSAGES, botmod.CHAT_META, botmod.CHAT_ADMINS, botmod.USERNAME_BY_ID, botmod.USER_ID_BY_NAME):
+        cache.clear()
+    for queue in botmod.WRITE_BEHIND_QUEUES:
+        queue.pending.clear()
+    botmod.FLOOD_TRACKERS.clear()
+    botmod.TRUST.clear()
+    botmod.PRIVATE_LIMITER.state.clear()
+    botmod.PRIVATE_THROTTLED.clear()
+    botmod.STORE.warm()
+    botmod.UPDATE_LEDGER.load()
+    return Env()
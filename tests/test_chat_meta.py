@@ -0,0 +1,23 @@
+import asyncio
+
+import bot as botmod
+from conftest import CHAT, USER
+
+CHAT_ID = CHAT["id"]
+
+
+def test_cold_cache_unmutes_share_one_get_chat(env):
+    async def scenario():
+        await asyncio.gather(*(botmod.apply_unmute(CHAT_ID, USER["id"] + i) for i in range(20)))
+    env.run(scenario)
+    assert env.api.calls["getChat"] == 1
+    assert env.api.calls["getChatMemberCount"] == 0
+    assert env.api.calls["restrictChatMember"] == 20
+
+
+def test_member_count_fetched_once_per_ttl(env):
+    async def scenario():
+        return [await botmod.chat_member_count(CHAT_ID) for _ in range(3)]
+    counts = env.run(scenario)
+    assert counts[0] is not None and counts == [counts[0]] * 3
+    assert env.api.calls["getChatMemberCount"] == 1
@@ -0,0 +1,72 @@
+import bot as botmod
+
+AD = "заходи на наш сервер play.craftworld.net"
+
+
+def restart(monkeypatch):
+    # после рестарта в памяти ничего нет: журнал и хранилище читаются из БД заново
+    monkeypatch.setattr(botmod, "UPDATE_LEDGER", botmod.DedupeLedger(botmod.DEDUPE_LEDGER_SIZE))
+    monkeypatch.setattr(botmod, "STORE", botmod.SqliteStore())
+    botmod.SEEN_MESSAGES.clear()
+    botmod.FLOOD_TRACKERS.clear()
+    botmod.UPDATE_LEDGER.load()
+    botmod.STORE.warm()
+
+
+def test_redelivered_update_skipped_after_restart(env, monkeypatch):
+    # упали до следующего getUpdates: Telegram присылает ту же пачку ещё раз
+    raw = env.message(AD)
+
+    async def scenario():
+        await env.feed(raw)
+    env.run(scenario)
+    handled = env.api.total_calls
+    assert env.api.calls["deleteMessage"] == 1
+
+    restart(monkeypatch)
+    env.run(scenario)
+    assert env.api.total_calls == handled
+    assert env.run(lambda: botmod.ad_stage_get(-1001000000001, 100001)) == 1
+
+
+def test_same_message_under_new_update_id_skipped(env):
+    async def scenario():
+        await env.feed(env.message(AD, message_id=5))
+        await env.feed(env.message(AD, message_id=5))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_new_edit_of_same_message_not_skipped(env):
+    async def scenario():
+        await env.feed(env.message("привет", message_id=5))
+        await env.feed(env.message(AD, message_id=5, edit_date=100))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_failed_handler_leaves_update_retryable(env, monkeypatch):
+    # обработчик упал — ключи снимаются, повтор той же пачки обрабатывается заново
+    raw = env.message(AD)
+    punish_stage = botmod.punish_stage
+    calls = []
+
+    async def flaky(*args, **kwargs):
+        calls.append(args)
+        if len(calls) == 1:
+            raise RuntimeError("boom")
+        await punish_stage(*args, **kwargs)
+    monkeypatch.setattr(botmod, "punish_stage", flaky)
+
+    async def scenario():
+        try:
+            await env.feed(raw)
+        except RuntimeError:
+            pass
+    env.run(scenario)
+    assert not botmod.UPDATE_LEDGER.keys
+
+    restart(monkeypatch)
+    env.run(scenario)
+    assert len(calls) == 2
+    assert env.run(lambda: botmod.ad_stage_get(-1001000000001, 100001)) == 1
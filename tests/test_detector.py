@@ -0,0 +1,46 @@
+import pytest
+
+import bot as botmod
+from detector import NAME_CASES
+from replay import AD_TEXTS, CLEAN_TEXTS
+
+
+@pytest.mark.parametrize("text", [t for t in AD_TEXTS if "#" not in t])
+def test_ads_detected(text):
+    assert botmod.is_ad_message(text)[0]
+
+
+@pytest.mark.parametrize("text", CLEAN_TEXTS)
+def test_clean_not_detected(text):
+    assert not botmod.is_ad_message(text)[0]
+
+
+@pytest.mark.parametrize("name,expected", NAME_CASES)
+def test_file_names(name, expected):
+    assert botmod.is_ad_name(name)[0] == expected
+
+
+def test_bio_ignores_plain_urls():
+    # в био ссылка на свой сайт — не реклама, t.me и адрес сервера с портом — реклама
+    assert not botmod.is_ad_name("мой сайт https://example.org", links=False)[0]
+    assert botmod.is_ad_name("канал t.me/spam_channel", links=False)[0]
+    assert botmod.is_ad_name("играю на mc.spamcraft.net:25565", links=False)[0]
+
+
+def test_document_name_does_not_trigger_keywords(env):
+    # server.properties / Server.log в вложении — обычный вопрос про свой сервер, не реклама
+    async def scenario():
+        doc = {"file_id": "f1", "file_unique_id": "u1", "file_name": "server.properties"}
+        await env.feed(env.message(caption="почему не стартует?", document=doc))
+        audio = {"file_id": "f2", "file_unique_id": "u2", "duration": 1, "performer": "mc.jar", "title": "play.mp3"}
+        await env.feed(env.message(message_id=2, audio=audio))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 0
+
+
+def test_document_name_with_link_deleted(env):
+    async def scenario():
+        doc = {"file_id": "f1", "file_unique_id": "u1", "file_name": "t.me/spam_channel.apk"}
+        await env.feed(env.message(document=doc))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
@@ -0,0 +1,38 @@
+import bot as botmod
+from conftest import CHAT
+
+ANON = {"id": 1087968824, "is_bot": True, "first_name": "Group", "username": "GroupAnonymousBot"}
+
+
+def photo(n: int) -> list[dict]:
+    return [{"file_id": f"p{n}", "file_unique_id": f"u{n}", "width": 800, "height": 600}]
+
+
+def test_album_is_one_event(env):
+    # обычный альбом из 10 фото — не флуд
+    async def scenario():
+        for i in range(10):
+            await env.feed(env.message(message_id=i + 1, photo=photo(i), media_group_id="album1"))
+    env.run(scenario)
+    assert env.api.calls["deleteMessages"] == 0
+    assert env.run(lambda: botmod.ad_stage_get(CHAT["id"], 100001)) == 0
+
+
+def test_burst_of_single_messages_is_flood(env):
+    async def scenario():
+        for i in range(botmod.FLOOD_BURST_MESSAGES):
+            await env.feed(env.message(f"сообщение {i}", message_id=i + 1))
+    env.run(scenario)
+    assert env.api.calls["deleteMessages"] == 1
+    assert env.run(lambda: botmod.ad_stage_get(CHAT["id"], 100001)) == 1
+
+
+def test_anonymous_admin_posts_not_tracked(env):
+    sender = {"id": CHAT["id"], "type": "supergroup", "title": CHAT["title"]}
+
+    async def scenario():
+        for i in range(botmod.FLOOD_BURST_MESSAGES * 2):
+            await env.feed(env.message("объявление", message_id=i + 1, user=ANON, sender_chat=sender))
+    env.run(scenario)
+    assert env.api.calls["deleteMessages"] == 0
+    assert not botmod.FLOOD_TRACKERS
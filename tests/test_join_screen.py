@@ -0,0 +1,55 @@
+import asyncio
+
+import bot as botmod
+from conftest import USER
+
+CHATS = [-1001000000001, -1001000000002, -1001000000003]
+SPAMMER = {"id": 200001, "is_bot": False, "first_name": "Лучший сервер t.me/spam_mc"}
+
+
+def join(env, chat_id: int, user: dict) -> dict:
+    chat = {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"}
+    return env.message(message_id=chat_id % 1000, user=user, chat=chat, new_chat_members=[user])
+
+
+async def screened(env, *raws):
+    # рейд: входы приходят одной пачкой getUpdates
+    await asyncio.gather(*(env.feed(raw) for raw in raws))
+    if botmod.JOIN_SCREENER.queue is not None:
+        await botmod.JOIN_SCREENER.queue.join()
+    await asyncio.gather(*botmod.BACKGROUND_TASKS)
+    await botmod.JOIN_SCREENER.stop()
+
+
+def test_name_flagged_once_across_chats(env):
+    # один спамер заходит в три чата: одна проверка, одно сообщение админам, без мута по умолчанию
+    env.run(lambda: screened(env, *(join(env, c, SPAMMER) for c in CHATS)))
+    assert env.api.calls["getChat"] == 0
+    assert env.api.calls["sendMessage"] == 1
+    assert env.api.calls["restrictChatMember"] == 0
+
+
+def test_restrict_mode_mutes_in_every_chat(env, monkeypatch):
+    monkeypatch.setattr(botmod, "JOIN_SCREEN_ACTION", "restrict")
+    env.run(lambda: screened(env, *(join(env, c, SPAMMER) for c in CHATS)))
+    assert env.api.calls["restrictChatMember"] == len(CHATS)
+    rows, _ = env.run(lambda: botmod.mc_list(CHATS[0], 1))
+    assert [(r[0], r[2]) for r in rows] == [(SPAMMER["id"], "mute")]
+
+
+def test_bio_checked_for_clean_name(env):
+    env.api.bios[USER["id"]] = "мой канал t.me/spam_mc"
+    env.run(lambda: screened(env, join(env, CHATS[0], USER)))
+    assert env.api.calls["getChat"] == 1
+    assert env.api.calls["sendMessage"] == 1
+
+
+def test_clean_user_and_cached_verdict(env):
+    env.api.bios[USER["id"]] = "играю на https://example.org"
+
+    async def scenario():
+        await screened(env, join(env, CHATS[0], USER))
+        await screened(env, join(env, CHATS[1], USER))
+    env.run(scenario)
+    assert env.api.calls["getChat"] == 1
+    assert env.api.calls["sendMessage"] == 0
@@ -0,0 +1,61 @@
+import asyncio
+
+import bot as botmod
+from conftest import CHAT, USER
+
+AD = "заходи на наш сервер play.craftworld.net"
+
+
+def stage(env):
+    return env.run(lambda: botmod.ad_stage_get(CHAT["id"], USER["id"]))
+
+
+def test_ad_without_permit_deleted_and_warned(env):
+    async def scenario():
+        await env.feed(env.message(AD))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+    assert stage(env) == 1
+
+
+def test_permit_holder_ad_allowed_once_per_day(env):
+    async def scenario():
+        await botmod.permit_set(CHAT["id"], USER["id"], None)
+        await env.feed(env.message(f"{AD} #реклама", message_id=1))
+        allowed = env.api.total_calls
+        await env.feed(env.message(f"{AD} снова #реклама", message_id=2))
+        return allowed
+    assert env.run(scenario) == 0
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_edit_of_allowed_ad_is_rechecked(env):
+    # разрешённая реклама не помечает сообщение обработанным: правка без тега удаляется,
+    # а правка с тегом не считается второй рекламой за сутки
+    async def scenario():
+        await botmod.permit_set(CHAT["id"], USER["id"], None)
+        await env.feed(env.message(f"{AD} #реклама"))
+        await env.feed(env.message(f"{AD} сюда #реклама", edit_date=100))
+        kept = env.api.calls["deleteMessage"]
+        await env.feed(env.message(AD, edit_date=101))
+        return kept
+    assert env.run(scenario) == 0
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_edit_after_punishment_not_punished_again(env):
+    async def scenario():
+        await env.feed(env.message(AD))
+        await env.feed(env.message(AD + " !!!", edit_date=100))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+    assert stage(env) == 1
+
+
+def test_concurrent_new_and_edit_punished_once(env):
+    # правка пришла, пока новое сообщение ещё проверяется
+    async def scenario():
+        await asyncio.gather(env.feed(env.message(AD)), env.feed(env.message(AD + " !!!", edit_date=100)))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+    assert stage(env) == 1
@@ -0,0 +1,23 @@
+import bot as botmod
+from conftest import USER
+
+PRIVATE = {"id": USER["id"], "type": "private", "first_name": USER["first_name"]}
+
+
+def ledger_rows() -> int:
+    botmod.flush_write_behind()
+    con = botmod.db()
+    n = con.execute("SELECT COUNT(*) FROM update_ledger").fetchone()[0]
+    con.close()
+    return n
+
+
+def test_dropped_private_messages_skip_ledger(env):
+    # анти-флуд ЛС стоит перед журналом дублей: сверх burst в БД ничего не пишется
+    async def scenario():
+        for i in range(botmod.PRIVATE_BURST + 10):
+            await env.feed(env.message(f"привет {i}", message_id=i + 1, chat=PRIVATE))
+    before = ledger_rows()
+    env.run(scenario)
+    # на каждое пропущенное сообщение два ключа: update_id и chat:message_id
+    assert ledger_rows() - before == 2 * botmod.PRIVATE_BURST
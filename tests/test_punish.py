@@ -0,0 +1,46 @@
+import bot as botmod
+import fake_bot_api
+from conftest import CHAT, USER
+
+CHAT_ID, UID = CHAT["id"], USER["id"]
+
+
+def test_ladder_warn_mute_mute_reset(env):
+    async def scenario():
+        stages = []
+        for _ in range(3):
+            await botmod.punish_stage(CHAT_ID, UID, "Steve", "реклама")
+            stages.append(await botmod.ad_stage_get(CHAT_ID, UID))
+        return stages
+    assert env.run(scenario) == [1, 2, 0]
+    assert env.api.calls["restrictChatMember"] == 2
+
+
+def test_failed_mute_keeps_stage(env, monkeypatch):
+    async def no_mute(chat_id, user_id, seconds):
+        return False
+    monkeypatch.setattr(botmod, "apply_mute", no_mute)
+
+    async def scenario():
+        await botmod.ad_stage_set(CHAT_ID, UID, 1)
+        for _ in range(3):
+            await botmod.punish_stage(CHAT_ID, UID, "Steve", "реклама")
+        return await botmod.ad_stage_get(CHAT_ID, UID)
+    assert env.run(scenario) == 1
+    rows, _ = env.run(lambda: botmod.mc_list(CHAT_ID, 1))
+    assert rows == []
+
+
+def test_no_restrict_right_warns_once(env, monkeypatch):
+    monkeypatch.setattr(botmod, "ADMIN_IDS", {1})
+    monkeypatch.setitem(fake_bot_api.ADMIN_RIGHTS, "can_restrict_members", False)
+
+    async def scenario():
+        await botmod.ad_stage_set(CHAT_ID, UID, 1)
+        for _ in range(3):
+            await botmod.punish_stage(CHAT_ID, UID, "Steve", "реклама")
+        return await botmod.ad_stage_get(CHAT_ID, UID)
+    assert env.run(scenario) == 1
+    assert env.api.calls["restrictChatMember"] == 0
+    # 3 уведомления о нарушении + одно "дай права" в чат + одно админу
+    assert env.api.calls["sendMessage"] == 5
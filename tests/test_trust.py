@@ -0,0 +1,47 @@
+import bot as botmod
+from conftest import CHAT, USER
+
+
+def make_trusted():
+    first_seen = botmod.ts() - botmod.TRUST_MIN_AGE_SECONDS - 60
+    botmod.TRUST[(CHAT["id"], USER["id"])] = first_seen << 20 | botmod.TRUST_CLEAN_MESSAGES
+
+
+def test_cheap_check_defers_domains_to_full_detector():
+    assert botmod.is_ad_cheap(["где найти алмазы на 1.20? т.е. версия"], []) == (False, "")
+    assert botmod.is_ad_cheap(["заходи play.craftworld.net"], []) is None
+    assert botmod.is_ad_cheap(["localhost.test:25565"], []) is None
+    assert botmod.is_ad_cheap([""], ["https://example.org"]) is None
+    assert botmod.is_ad_cheap(["t.me/spam_channel"], [])[0]
+
+
+def test_trusted_user_domain_ad_deleted(env):
+    make_trusted()
+
+    async def scenario():
+        await env.feed(env.message("заходи на наш сервер play.craftworld.net"))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_trusted_permit_holder_keeps_daily_limit(env):
+    # доверенный с разрешением: вторая реклама за сутки удаляется, как у всех
+    make_trusted()
+
+    async def scenario():
+        await botmod.permit_set(CHAT["id"], USER["id"], None)
+        await env.feed(env.message("наш сервер mc.funcraft.ru:25565 #реклама", message_id=1))
+        await env.feed(env.message("наш сервер mc.funcraft.ru:25565 ждём #реклама", message_id=2))
+    env.run(scenario)
+    assert env.api.calls["deleteMessage"] == 1
+
+
+def test_trusted_clean_message_not_credited(env):
+    make_trusted()
+    before = botmod.TRUST[(CHAT["id"], USER["id"])]
+
+    async def scenario():
+        await env.feed(env.message("кто знает как сделать ферму железа"))
+    env.run(scenario)
+    assert env.api.total_calls == 0
+    assert botmod.TRUST[(CHAT["id"], USER["id"])] == before
@@ -0,0 +1,66 @@
+import bot as botmod
+
+
+def restart():
+    # write-behind сброшен, память процесса потеряна — дальше только то, что в БД
+    botmod.flush_write_behind()
+    botmod.USERNAME_BY_ID.clear()
+    botmod.USER_ID_BY_NAME.clear()
+
+
+def test_lookup_from_traffic_without_db(env):
+    botmod.username_observe(1, "Steve")
+    assert botmod.username_lookup("@steve") == 1
+    assert botmod.username_lookup("STEVE") == 1
+    assert botmod.username_of(1) == "Steve"
+    assert botmod._known_users_wb.pending   # в БД ещё не писали
+
+
+def test_flush_persists_index(env):
+    botmod.username_observe(1, "steve")
+    botmod.username_observe(2, "alex")
+    restart()
+    assert botmod.username_lookup("steve") == 1
+    assert botmod.username_of(2) == "alex"
+
+
+def test_rename_drops_old_name(env):
+    botmod.username_observe(1, "steve")
+    restart()
+    botmod.username_lookup("steve")
+    botmod.username_observe(1, "steve2")
+    # новый username ещё в write-behind, в БД старый — он уже не должен находиться
+    assert botmod.username_lookup("steve") is None
+    assert botmod.username_lookup("steve2") == 1
+    restart()
+    assert botmod.username_lookup("steve") is None
+    assert botmod.username_lookup("steve2") == 1
+
+
+def test_removed_username_no_longer_resolves(env):
+    botmod.username_observe(1, "steve")
+    botmod.username_observe(1, None)
+    assert botmod.username_lookup("steve") is None
+    assert botmod.username_of(1) is None
+    restart()
+    assert botmod.username_lookup("steve") is None
+
+
+def test_removed_username_noticed_after_restart(env):
+    botmod.username_observe(1, "steve")
+    restart()
+    botmod.username_observe(1, None)
+    assert botmod.username_lookup("steve") is None
+    restart()
+    assert botmod.username_lookup("steve") is None
+
+
+def test_resolve_username_uses_index_then_api(env):
+    botmod.username_observe(1, "steve")
+
+    async def scenario():
+        return await botmod.resolve_username("@steve"), await botmod.resolve_username("@unknown_user")
+    known, fallback = env.run(scenario)
+    assert known == 1
+    assert env.api.calls["getChat"] == 1   # только для неизвестного
+    assert fallback is not None